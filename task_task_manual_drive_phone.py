@@ -5,14 +5,29 @@
 #   pip install aiohttp
 #   python task_task_manual_drive_phone.py --host 0.0.0.0 --port 8000 --rate 50
 
-import argparse, asyncio, json, os, time, csv
-from datetime import datetime
+import argparse, asyncio, hmac, json, math, os, time
+from functools import partial
 from typing import Dict, Any
-import numpy as np
 from aiohttp import web, WSMsgType
 
-from pal.products.qcar import QCar
-from pal.utilities.math import Calculus
+from touchdrive.backends import open_backend
+from touchdrive.control import battery_pct, led_table, led_index
+from touchdrive.logwriter import open_log
+from touchdrive.rtloop import ControlThread
+from touchdrive.ctlproc import ControlLink
+from touchdrive.scheduler import DeadlineScheduler
+from touchdrive.metrics import render_all
+from touchdrive.clients import ClientWriter
+from touchdrive import protocol
+from touchdrive.fleet import Car, car_ids, car_path
+from touchdrive.replay import SessionRecorder
+from touchdrive.bus import open_bus, bus_name
+from touchdrive.assets import StaticSite
+from touchdrive.history import TelemetryHistory, parse_query
+from touchdrive.estimator import open_estimator
+from touchdrive.filters import CommandFilter, TickClock
+from touchdrive.ratetune import LoopRate, parse_request, retime
+from touchdrive.trajectory import TrajectoryRunner, load_spec, upload_pool, LOAD, LOAD_START, START, ABORT, RUNNING
 
 HTML = r"""<!doctype html>
 <html lang="en"><head><meta charset="utf-8">
@@ -65,7 +80,7 @@ HTML = r"""<!doctype html>
     position:absolute;left:50%;top:50%;transform:translate(-50%,-50%);
     width:38%;aspect-ratio:1;border-radius:50%;background:#18202b;border:2px solid var(--accent);
     box-shadow:0 0 0 2px rgba(77,163,255,0.15), inset 0 0 12px rgba(0,0,0,0.35);
-    display:block; overflow:hidden;
+    display:block; overflow:hidden; will-change:transform;  /* moved with transform only (compositor) */
     font-size:clamp(28px, 7.5vmin, 64px); /* hint arrow size */
   }
   .stick-hint{position:absolute;inset:0;pointer-events:none;color:#d9ecff;opacity:0.95;
@@ -94,6 +109,8 @@ HTML = r"""<!doctype html>
   button.disarm.active{background:#3c3c46; border-color:#68688a; box-shadow:0 0 0 2px rgba(150,150,200,0.2) inset}
   button.estop.active{background:var(--warn); border-color:var(--warn-br); box-shadow:0 0 0 2px rgba(224,75,75,0.25) inset}
   button:disabled{opacity:.6}
+  .traj{display:flex;align-items:center;gap:10px;margin-top:10px;font-size:12px;color:var(--mut)}
+  .traj[hidden]{display:none}
 
   input[type=range]{width:100%}
   label{font-size:12px;color:var(--mut)}
@@ -193,6 +210,7 @@ HTML = r"""<!doctype html>
         <button id="disarmBtn" class="disarm"><span class="ico">■</span><span>DISARM</span></button>
         <button id="estopBtn" class="estop"><span class="ico">⛔</span><span>E-STOP</span></button>
       </div>
+      <div class="traj" id="trajRow" hidden><span id="trajInfo">--</span><button id="trajAbort" class="estop">ABORT RUN</button></div>
       <div style="margin-top:10px">
         <label>Max Speed (m/s): <span id="maxSpeedVal">0.20</span></label>
         <input id="maxSpeed" type="range" min="0" max="0.6" step="0.01" value="0.20">
@@ -206,7 +224,7 @@ HTML = r"""<!doctype html>
         <input id="dead" type="range" min="0" max="0.25" step="0.01" value="0.06">
       </div>
       <div>
-        <label>Smoothing (0-1): <span id="smVal">0.35</span></label>
+        <label>Smoothing (0-1): <span id="smVal">0.35 (19 ms)</span></label>
         <input id="smooth" type="range" min="0" max="1" step="0.01" value="0.35">
       </div>
       <div class="mut" style="margin-top:6px">Left pad = steer (X). Right pad = throttle (Y).</div>
@@ -218,6 +236,9 @@ HTML = r"""<!doctype html>
         <div>Speed</div><div><span id="spd">--</span> m/s</div>
         <div>Throttle</div><div><span id="thr">--</span></div>
         <div>Steering</div><div><span id="ste">--</span> rad</div>
+        <div>Touch→Car</div><div><span id="latAct">--</span> ms <span class="mut">p50/p99</span></div>
+        <div>Car→Screen</div><div><span id="latDisp">--</span> ms <span class="mut">p50/p99</span></div>
+        <div>RTT</div><div><span id="latRtt">--</span> ms</div>
       </div>
       <div style="margin-top:10px"><div class="meter"><div id="batBar" style="width:0%"></div></div></div>
       <div class="mut" style="margin-top:8px">Logging on robot.</div>
@@ -229,7 +250,12 @@ HTML = r"""<!doctype html>
 
 <script>
 (function(){
-  const ws = new WebSocket((location.protocol==='https:'?'wss://':'ws://')+location.host+'/ws');
+  // Offer the binary protocol first; the server answers 'qcar.json' (or nothing) unless started with --ws-binary.
+  const BIN = 'qcar.bin.v1';
+  const ws = new WebSocket((location.protocol==='https:'?'wss://':'ws://')+location.host+location.pathname.replace(/\/?$/, '/')+'ws'+location.search,  // e.g. /?rate=5 = lower telemetry rate
+                           [BIN, 'qcar.json']);
+  ws.binaryType = 'arraybuffer';
+  let bin = false;
 
   const hdrInfo = document.getElementById('hdrInfo');
   hdrInfo.textContent = location.host;
@@ -242,6 +268,9 @@ HTML = r"""<!doctype html>
   const armBtn = document.getElementById('armBtn');
   const disarmBtn = document.getElementById('disarmBtn');
   const estopBtn = document.getElementById('estopBtn');
+  const trajRow = document.getElementById('trajRow');
+  const trajInfo = document.getElementById('trajInfo');
+  const trajAbort = document.getElementById('trajAbort');
 
   const maxSpeed = document.getElementById('maxSpeed');
   const steerGain = document.getElementById('steerGain');
@@ -257,6 +286,9 @@ HTML = r"""<!doctype html>
   const thr = document.getElementById('thr');
   const ste = document.getElementById('ste');
   const batBar = document.getElementById('batBar');
+  const latAct = document.getElementById('latAct');
+  const latDisp = document.getElementById('latDisp');
+  const latRtt = document.getElementById('latRtt');
 
   const themeSel = document.getElementById('theme');
 
@@ -278,6 +310,10 @@ HTML = r"""<!doctype html>
   let uiState = { armed:false, estop:false };
   function setActive(btn, active){ btn.classList.toggle('active', !!active); }
   function renderArmState(armed, estop){
+    armed = !!armed; estop = !!estop;
+    if (armed !== view.arm.armed || estop !== view.arm.estop){ view.arm = {armed, estop}; view.armDirty = true; }
+  }
+  function applyArmState(armed, estop){
     uiState.armed = !!armed;
     uiState.estop = !!estop;
     setActive(armBtn,  armed && !estop);
@@ -292,18 +328,54 @@ HTML = r"""<!doctype html>
     maxSpeedVal.textContent = (+maxSpeed.value).toFixed(2);
     steerGainVal.textContent = (+steerGain.value).toFixed(2);
     deadVal.textContent = (+dead.value).toFixed(2);
-    smVal.textContent = (+smooth.value).toFixed(2);
+    // Same time constant at any loop rate (touchdrive/filters.py: the value is the per-tick weight at 50 Hz).
+    const sm = +smooth.value, tau = sm <= 0 ? 'off' : sm >= 1 ? 'hold' : Math.round(-1000/(50*Math.log(sm))) + ' ms';
+    smVal.textContent = `${sm.toFixed(2)} (${tau})`;
   }
   [maxSpeed,steerGain,dead,smooth].forEach(x=>x.addEventListener('input',labelSync)); labelSync();
 
+  // ---- view model: event handlers only write here, render() applies it once per frame ----
+  const view = {
+    tele:null, teleDirty:false,                       // newest telemetry frame
+    arm:{armed:false, estop:false}, armDirty:false,
+    traj:null, trajDirty:false,                       // scripted-run progress (touchdrive/trajectory.py)
+    lat:null,                                         // latency HUD strings, set on pong
+    sticks:new Map([[leftStick, {x:0, y:0, dirty:false}], [rightStick, {x:0, y:0, dirty:false}]]),
+  };
+  const shown = {};   // last text written per element, so unchanged values cost no DOM write
+  function setText(el, s){ if (shown[el.id] !== s){ shown[el.id] = s; el.textContent = s; } }
+
+  // Pad geometry is read once and reused until the layout changes.
+  const geom = new Map();   // pad -> {cx, cy, maxR, hw, hh}
+  function padGeom(pad){
+    let g = geom.get(pad);
+    if (!g){
+      const rect = pad.getBoundingClientRect();
+      g = { cx:rect.left + rect.width/2, cy:rect.top + rect.height/2,
+            maxR:Math.min(rect.width, rect.height) * 0.5 * 0.85, hw:rect.width/2, hh:rect.height/2 };
+      geom.set(pad, g);
+    }
+    return g;
+  }
+  const invalidateGeom = ()=>geom.clear();
+  window.addEventListener('resize', invalidateGeom);
+  window.addEventListener('orientationchange', invalidateGeom);
+  window.addEventListener('scroll', invalidateGeom, {passive:true});
+  if (window.visualViewport) visualViewport.addEventListener('resize', invalidateGeom);
+  if (window.ResizeObserver){ const ro = new ResizeObserver(invalidateGeom); ro.observe(leftPad); ro.observe(rightPad); }
+
+  function moveStick(stick, dx, dy){
+    const s = view.sticks.get(stick);
+    s.x = dx; s.y = dy; s.dirty = true;
+  }
+
   let leftId=null,rightId=null;
   let leftAxes={x:0,y:0}, rightAxes={x:0,y:0};
+  let touchTs = Date.now();   // time of the touch event behind the current stick state
 
   function handlePad(pad, stick, isLeft, ev){
-    const rect = pad.getBoundingClientRect();
-    const cx = rect.left + rect.width/2;
-    const cy = rect.top  + rect.height/2;
-    const maxR = Math.min(rect.width, rect.height) * 0.5 * 0.85;
+    const g = padGeom(pad);
+    const cx = g.cx, cy = g.cy, maxR = g.maxR;
 
     const touches = ev.changedTouches ? Array.from(ev.changedTouches) : [ev];
     touches.forEach(t=>{
@@ -316,19 +388,20 @@ HTML = r"""<!doctype html>
 
       if (['touchend','pointerup','pointercancel'].includes(ev.type)){
         if (isLeft){ leftId=null; leftAxes={x:0,y:0}; } else { rightId=null; rightAxes={x:0,y:0}; }
-        stick.style.left='50%'; stick.style.top='50%'; send(); return;
+        touchTs = Date.now();
+        moveStick(stick, 0, 0); queueSend(); return;
       }
 
       const x = (t.clientX - cx), y = (t.clientY - cy);
       const r = Math.hypot(x,y); const k = r>maxR ? maxR/r : 1;
       const sx = x*k, sy = y*k;
-      stick.style.left = (50 + 50*sx/maxR) + '%';
-      stick.style.top  = (50 + 50*sy/maxR) + '%';
+      moveStick(stick, g.hw*sx/maxR, g.hh*sy/maxR);   // full deflection reaches the pad edge
 
       const nx =  sx/maxR;     // [-1,1], right +
       const ny = -sy/maxR;     // [-1,1], up +
       if (isLeft) leftAxes={x:nx,y:ny}; else rightAxes={x:nx,y:ny};
-      send();
+      touchTs = Date.now();
+      queueSend();
     });
     ev.preventDefault();
   }
@@ -346,14 +419,99 @@ HTML = r"""<!doctype html>
   bind(rightPad,rightStick,false);
 
   // Buttons
-  armBtn.onclick   = ()=>{ renderArmState(true,  false); ws.send(JSON.stringify({type:'arm'}));   };
-  disarmBtn.onclick= ()=>{ renderArmState(false, false); ws.send(JSON.stringify({type:'disarm'}));};
-  estopBtn.onclick = ()=>{ renderArmState(false, true ); ws.send(JSON.stringify({type:'estop'})); };
+  armBtn.onclick   = ()=>{ renderArmState(true,  false); sendCmd('arm');    };
+  disarmBtn.onclick= ()=>{ renderArmState(false, false); sendCmd('disarm'); };
+  estopBtn.onclick = ()=>{ renderArmState(false, true ); sendCmd('estop');  };
+  trajAbort.onclick = ()=>{ if (ws.readyState===1) ws.send(JSON.stringify({type:'trajectory', action:'abort'})); };
+
+  ;[maxSpeed,steerGain,dead,smooth].forEach(el=>el.addEventListener('change',()=>queueSend(true)));
+
+  // Touch events can fire at 120-240 Hz; coalesce them into at most one control
+  // message per animation frame (or per 1/N s with ?hz=N). A stick held still is
+  // resent every HOLD_MS, so the server can tell "holding" from "link went quiet".
+  const sendHz = +(new URLSearchParams(location.search).get('hz')) || 0;
+  const HOLD_MS = 100;
+  let dirty=false, paramsDirty=false, lastSend=0, seq=0;
+  function queueSend(withParams){ dirty=true; if (withParams) paramsDirty=true; }
+  function frame(now){
+    if (!dirty && (leftId!==null || rightId!==null) && now - lastSend >= HOLD_MS) dirty=true;
+    if (dirty && (!sendHz || now - lastSend >= 1000/sendHz)){
+      dirty=false; lastSend=now; send(paramsDirty); paramsDirty=false;
+    }
+    render();
+    requestAnimationFrame(frame);
+  }
+  requestAnimationFrame(frame);
+
+  // The only place that touches the DOM for telemetry, latency, arm state and sticks.
+  function render(){
+    for (const [el, s] of view.sticks){
+      if (!s.dirty) continue;
+      s.dirty = false;
+      el.style.transform = 'translate(-50%,-50%) translate3d(' + s.x + 'px,' + s.y + 'px,0)';
+    }
+    if (view.teleDirty){
+      const m = view.tele; view.teleDirty = false;
+      setText(batPct, (m.battery_pct ?? 0).toFixed(1));
+      setText(spd, (m.speed_mps ?? 0).toFixed(3));
+      setText(thr, (m.throttle ?? 0).toFixed(3));
+      setText(ste, (m.steering ?? 0).toFixed(3));
+      const w = Math.round(Math.max(0, Math.min(100, m.battery_pct ?? 0))) + '%';
+      if (shown.batBar !== w){ shown.batBar = w; batBar.style.width = w; }
+      noteDisplay(m);   // car -> screen ends when the frame is actually painted
+    }
+    if (view.armDirty){ view.armDirty = false; applyArmState(view.arm.armed, view.arm.estop); }
+    if (view.trajDirty){
+      const m = view.traj; view.trajDirty = false;
+      trajRow.hidden = m.state === 'idle';
+      trajAbort.disabled = m.state !== 'running';
+      setText(trajInfo, trajText(m));
+    }
+    if (view.lat){ setText(latAct, view.lat[0]); setText(latDisp, view.lat[1]); setText(latRtt, view.lat[2]); view.lat = null; }
+  }
+
+  function trajText(m){
+    const what = m.name ? '"' + m.name + '"' : 'trajectory';
+    if (m.state==='loaded') return `${what} loaded (${m.duration.toFixed(1)} s)`;
+    if (m.state==='running') return `Run ${m.run} ${what}: ${Math.round(m.progress*100)}% of ${m.duration.toFixed(1)} s, sticks ignored`;
+    return `Run ${m.run} ${m.state}` + (m.reason ? ` (${m.reason})` : '');
+  }
 
-  ;[maxSpeed,steerGain,dead,smooth].forEach(el=>el.addEventListener('change',()=>send(true)));
+  // ---- binary frames (layouts in touchdrive/protocol.py) ----
+  const CMDS = {arm:0, disarm:1, estop:2};
+  function sendCmd(t){
+    if (!bin){ ws.send(JSON.stringify({type:t})); return; }
+    const dv = new DataView(new ArrayBuffer(2));
+    dv.setUint8(0, 0x03); dv.setUint8(1, CMDS[t]);
+    ws.send(dv.buffer);
+  }
+  function sendParams(){
+    const dv = new DataView(new ArrayBuffer(20));
+    dv.setUint8(0, 0x02);
+    dv.setFloat32(4, +maxSpeed.value, true); dv.setFloat32(8, +steerGain.value, true);
+    dv.setFloat32(12, +dead.value, true);    dv.setFloat32(16, +smooth.value, true);
+    ws.send(dv.buffer);
+  }
+  function sendAxes(){
+    const dv = new DataView(new ArrayBuffer(32));
+    dv.setUint8(0, 0x01); dv.setUint32(4, ++seq, true);
+    dv.setFloat32(8, leftAxes.x, true);   dv.setFloat32(12, leftAxes.y, true);
+    dv.setFloat32(16, rightAxes.x, true); dv.setFloat32(20, rightAxes.y, true);
+    dv.setFloat64(24, touchTs, true);
+    ws.send(dv.buffer);
+  }
+  function decodeFrame(buf){
+    const dv = new DataView(buf);
+    if (dv.getUint8(0)!==0x10) return null;
+    const f = dv.getUint8(1);
+    return { type:'telemetry', armed:!!(f&1), estop:!!(f&2),
+             battery_pct:dv.getFloat32(4,true), speed_mps:dv.getFloat32(8,true),
+             throttle:dv.getFloat32(12,true), steering:dv.getFloat32(16,true), ts:dv.getFloat64(20,true) };
+  }
 
-  function send(){
+  function send(withParams){
     if (ws.readyState!==1) return;
+    if (bin){ if (withParams) sendParams(); sendAxes(); return; }   // params only travel when they change
     ws.send(JSON.stringify({
       type:'control',
       left:leftAxes, right:rightAxes,
@@ -361,22 +519,47 @@ HTML = r"""<!doctype html>
         maxSpeed:+maxSpeed.value, steerGain:+steerGain.value,
         dead:+dead.value, smooth:+smooth.value
       },
-      ts: Date.now()
+      seq: ++seq, ts: touchTs
     }));
   }
 
-  ws.onopen = ()=>{ hdrInfo.textContent = location.host + " · Connected"; };
+  ws.onopen = ()=>{
+    bin = ws.protocol === BIN;
+    hdrInfo.textContent = location.host + " · Connected" + (bin ? " · bin" : "");
+    if (bin) sendParams();
+  };
   ws.onclose = ()=>{ hdrInfo.textContent = location.host + " · Disconnected"; };
 
+  // ---- clock sync & latency (NTP-style; offset = server - phone, from the min-RTT ping) ----
+  const clk = {samples:[], offset:null, rtt:null};
+  let dispNew = [], dispWin = [], actPct = null;
+  function pct(a, q){ if (!a.length) return null; const s=[...a].sort((x,y)=>x-y); return s[Math.min(s.length-1, Math.floor(q*s.length))]; }
+  function fmtPct(p50, p99){ return (p50==null) ? '--' : p50.toFixed(0)+' / '+p99.toFixed(0); }
+  setInterval(()=>{ if (ws.readyState===1) ws.send(JSON.stringify({type:'ping', t0:Date.now()})); }, 1000);
+  function onPong(m){
+    const t3 = Date.now();
+    const rtt = (t3 - m.t0) - (m.t2 - m.t1);
+    clk.samples.push({rtt, off:((m.t1 - m.t0) + (m.t2 - t3))/2});
+    if (clk.samples.length > 16) clk.samples.shift();
+    const best = clk.samples.reduce((a,b)=> b.rtt < a.rtt ? b : a);
+    clk.offset = best.off; clk.rtt = best.rtt; actPct = m.act;
+    ws.send(JSON.stringify({type:'clock', offset:clk.offset, rtt:clk.rtt, display:dispNew}));
+    dispNew = [];
+    view.lat = [actPct ? fmtPct(actPct[0], actPct[1]) : '--', fmtPct(pct(dispWin, 0.5), pct(dispWin, 0.99)), clk.rtt.toFixed(0)];
+  }
+  function noteDisplay(msg){
+    if (clk.offset===null || !msg.ts) return;
+    const d = Date.now() + clk.offset - msg.ts*1000;
+    dispNew.push(d); dispWin.push(d); if (dispWin.length > 256) dispWin.shift();
+  }
+
   ws.onmessage = (ev)=>{
     try{
-      const msg = JSON.parse(ev.data);
-      if (msg.type==='telemetry'){
-        batPct.textContent = (msg.battery_pct ?? 0).toFixed(1);
-        spd.textContent    = (msg.speed_mps ?? 0).toFixed(3);
-        thr.textContent    = (msg.throttle ?? 0).toFixed(3);
-        ste.textContent    = (msg.steering ?? 0).toFixed(3);
-        batBar.style.width = Math.max(0, Math.min(100, msg.battery_pct ?? 0)) + '%';
+      const msg = (ev.data instanceof ArrayBuffer) ? decodeFrame(ev.data) : JSON.parse(ev.data);
+      if (msg && msg.type==='pong'){ onPong(msg); return; }
+      if (msg && msg.type==='trajectory'){ view.traj = msg; view.trajDirty = true; return; }
+      if (msg && msg.type==='telemetry'){
+        view.tele = msg; view.teleDirty = true;   // drawn by the next render()
         if ('armed' in msg || 'estop' in msg){
           renderArmState(!!msg.armed, !!msg.estop);
         }
@@ -398,144 +581,312 @@ HTML = r"""<!doctype html>
 
 # ---------------- Python server + controller ----------------
 
-class ControllerState:
-    def __init__(self):
-        self.armed = False
-        self.estop = False
-        self.left  = {'x':0.0,'y':0.0}   # steering on X
-        self.right = {'x':0.0,'y':0.0}   # throttle on Y
-        self.params = {'maxSpeed':0.20,'steerGain':0.50,'dead':0.06,'smooth':0.35}
-        self.throttle = 0.0
-        self.steering = 0.0
-
-    @staticmethod
-    def _deadzone(v, dz): return 0.0 if abs(v) < dz else float(np.clip(v, -1.0, 1.0))
-
-    def update_from_msg(self, msg: Dict[str, Any]):
-        t = msg.get('type')
-        if t == 'arm':
-            self.armed = True; self.estop = False
-        elif t == 'disarm':
-            self.armed = False; self.throttle = 0.0; self.steering = 0.0
-        elif t == 'estop':
-            self.estop = True; self.armed = False; self.throttle = 0.0; self.steering = 0.0
-        elif t == 'control':
-            self.left = msg.get('left', self.left)
-            self.right = msg.get('right', self.right)
-            self.params.update(msg.get('params', {}))
-
-    def compute(self, prev_throttle, prev_steering):
-        dz      = float(self.params['dead'])
-        smooth  = float(self.params['smooth'])
-        vmax    = float(self.params['maxSpeed'])   # m/s cap
-        steer_k = float(self.params['steerGain'])  # rad scaling
-
-        lx = self._deadzone(float(self.left.get('x',0.0)), dz)
-        ry = self._deadzone(float(self.right.get('y',0.0)), dz)
-
-        # ===== Steering mapping (FIXED DIRECTION) =====
-        # Invert sign so moving stick RIGHT turns RIGHT on the car
-        steering_cmd = -steer_k * lx           # rad (inverted)
-        throttle_cmd =  vmax   * ry            # m/s
-
-        # simple EMA smoothing
-        alpha = np.clip(1.0 - smooth, 0.0, 1.0)
-        throttle = (1-alpha)*prev_throttle + alpha*throttle_cmd
-        steering = (1-alpha)*prev_steering + alpha*steering_cmd
-
-        if not self.armed or self.estop:
-            throttle = 0.0; steering = 0.0
-
-        # Clamp to sane bounds
-        throttle = float(np.clip(throttle, -vmax, vmax))
-        steering = float(np.clip(steering, -1.2, 1.2))
-        self.throttle, self.steering = throttle, steering
-        return throttle, steering
-
-state = ControllerState()
-ws_clients = set()
-
-async def handle_index(_):
-    return web.Response(text=HTML, content_type='text/html')
+cars = {}   # car id -> Car; main() creates --cars of them (/, /ws and /metrics without /car/<id> = first car)
+client_opts = {'depth': 2, 'evict_after': 2.0}
+ws_protocols = (protocol.JSON_PROTO,)   # main() adds BIN_PROTO with --ws-binary
+site = None   # StaticSite: HTML split, minified and precompressed once by make_app()
+admin_token = None   # --admin-token; without one /admin/* only answers loopback clients
+
+def add_car(car_id):
+    car = cars[str(car_id)] = Car(car_id, push_telemetry)
+    return car
+
+def car_for(request):
+    car_id = request.match_info.get('car')
+    car = cars.get(car_id) if car_id is not None else next(iter(cars.values()), None)
+    if car is None: raise web.HTTPNotFound(text=f"no car {car_id!r}")
+    return car
+
+async def handle_index(request):
+    car_for(request)
+    if 'car' in request.match_info and not request.path.endswith('/'):
+        # The page links manifest.webmanifest relative to itself.
+        qs = request.query_string
+        raise web.HTTPPermanentRedirect(request.path + '/' + ('?' + qs if qs else ''))
+    return site.index.respond(request)
+
+async def history_query(car, q):
+    # LTTB over up to --history-sec of rows takes a few ms: keep it off the event loop.
+    if car.history is None: return {'type': 'history', 'error': 'history disabled (--history-sec 0)'}
+    body = await asyncio.get_running_loop().run_in_executor(None, partial(car.history.query, **parse_query(q)))
+    if 'id' in q: body['id'] = q['id']
+    return body
+
+async def handle_history(request):
+    # /history?sec=600&points=300&fields=speed,throttle,steering,battery
+    return web.json_response(await history_query(car_for(request), request.query))
+
+async def send_history(car, writer, q):
+    writer.offer(json.dumps(await history_query(car, q)))
+
+async def handle_metrics(request):
+    # /metrics = every car (car="<id>" label), /car/<id>/metrics = that car only
+    body = car_for(request).metrics.render() if 'car' in request.match_info else render_all([c.metrics for c in cars.values()])
+    return web.Response(body=body.encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+def admin_allowed(request):
+    if admin_token:   # constant-time: the token guards actuation
+        given = request.headers.get('Authorization', '').encode('utf-8', 'replace')
+        return hmac.compare_digest(given, f"Bearer {admin_token}".encode())
+    return request.remote in ('127.0.0.1', '::1')
+
+async def handle_admin_rate(request):
+    # GET: current loop rate and mode. POST {"rate": Hz} or {"auto": true|false}: change it live.
+    car = car_for(request)
+    if not admin_allowed(request):
+        raise web.HTTPForbidden(text="admin API: loopback only, or send Authorization: Bearer <--admin-token>")
+    if request.method == 'POST':
+        try: car.rate.request(parse_request(await request.json()))
+        except (ValueError, TypeError) as e: raise web.HTTPBadRequest(text=str(e))
+        return web.json_response({**car.rate.status(), 'requested': True}, status=202)
+    return web.json_response(car.rate.status())
+
+async def handle_trajectory(request):
+    # GET: scripted-run status. POST a trajectory (touchdrive/trajectory.py) to load it,
+    # then POST .../start or .../abort; {"start": true} in the upload starts it right away.
+    car = car_for(request)
+    if not admin_allowed(request):
+        raise web.HTTPForbidden(text="admin API: loopback only, or send Authorization: Bearer <--admin-token>")
+    runner = car.trajectory
+    if request.method != 'POST': return web.json_response(runner.status())
+    action = request.match_info.get('action', 'load')
+    if action == 'abort':
+        runner.request(ABORT)
+    elif runner.state == RUNNING:
+        raise web.HTTPConflict(text=f"run {runner.run} in progress; abort it first")
+    else:
+        traj = None
+        if action == 'load':
+            # Big uploads take a few hundred ms to parse: off the event loop, like /history,
+            # and in a worker process (see upload_pool) so the control tick keeps its GIL.
+            try: traj, start = await asyncio.get_running_loop().run_in_executor(upload_pool(), load_spec, await request.text())
+            except (ValueError, TypeError) as e: raise web.HTTPBadRequest(text=str(e))
+            if start: action = 'load+start'
+        elif runner.uploaded is None: raise web.HTTPConflict(text="no trajectory loaded")
+        # The loop checks again when it starts the run; this just gives a useful answer.
+        if action != 'load' and not car.state.cmd[0]: raise web.HTTPConflict(text="car is not armed")
+        runner.request({'load': LOAD, 'start': START, 'load+start': LOAD_START}[action], traj)
+    return web.json_response({**runner.status(), 'requested': action}, status=202)
+
+async def trajectory_progress(car, hz=5.0):
+    # Scripted-run progress to every client of the car: at hz while a run plays, else on changes.
+    runner, last = car.trajectory, None
+    while True:
+        await asyncio.sleep(1.0 / hz)
+        key = (runner.run, runner.state, runner.uploaded)
+        if key == last and runner.state != RUNNING: continue
+        last = key
+        text = json.dumps({'type': 'trajectory', **runner.status()})
+        for w in list(car.clients.values()): w.offer(text)
 
 async def handle_ws(request):
-    ws = web.WebSocketResponse()
+    car = car_for(request)
+    state, metrics, latency, telemetry, recorder = car.state, car.metrics, car.latency, car.telemetry, car.recorder
+    ws = web.WebSocketResponse(protocols=ws_protocols)
     await ws.prepare(request)
-    ws_clients.add(ws)
+    writer = ClientWriter(ws, request.remote or '?', on_error=metrics.send_errors.inc,
+                          on_evict=lambda w: metrics.evictions.inc(),
+                          binary=ws.ws_protocol == protocol.BIN_PROTO, **client_opts).start()
+    car.clients[ws] = writer
+    cid = recorder.connect() if recorder else 0
+    if 'rate' in request.query: telemetry.subscribe(ws, request.query['rate'])
     try:
         async for msg in ws:
-            if msg.type == WSMsgType.TEXT:
-                try: state.update_from_msg(json.loads(msg.data))
-                except Exception: pass
+            if msg.type not in (WSMsgType.TEXT, WSMsgType.BINARY): continue
+            if recorder: recorder.message(cid, msg.type == WSMsgType.BINARY, msg.data)
+            try:
+                data = json.loads(msg.data) if msg.type == WSMsgType.TEXT else protocol.decode(msg.data)
+                kind = data.get('type')
+                if kind == 'subscribe': telemetry.subscribe(ws, data.get('rate'))
+                elif kind == 'ping': writer.offer(json.dumps(latency.pong(ws, data, writer.name)))
+                elif kind == 'clock': latency.report(ws, data, writer.name)
+                elif kind == 'history': asyncio.ensure_future(send_history(car, writer, data))
+                elif kind == 'trajectory':   # any client may stop a scripted run
+                    if data.get('action') == 'abort': car.trajectory.request(ABORT)
+                else: (car.link or state).post(ws, data)
+            except Exception: metrics.bad_messages.inc()
     finally:
-        ws_clients.discard(ws)
+        writer.stop()
+        car.clients.pop(ws, None)
+        (car.link or state).forget(ws)
+        summary = latency.forget(ws)
+        if summary: print(summary)
+        telemetry.forget(ws)
+        if recorder: recorder.disconnect(cid)
     return ws
 
-async def push_telemetry(batt_pct, speed_mps, throttle, steering):
-    if not ws_clients: return
-    payload = json.dumps({
-        'type':'telemetry',
-        'battery_pct': batt_pct,
-        'speed_mps': speed_mps,
-        'throttle': throttle,
-        'steering': steering,
-        'armed': state.armed,
-        'estop': state.estop,
-        'ts': time.time()
-    })
-    await asyncio.gather(*[c.send_str(payload) for c in list(ws_clients) if not c.closed], return_exceptions=True)
-
-async def controller_task(sample_rate: float, log_path: str, read_mode: int):
+def push_telemetry(car, batt_pct, speed_mps, throttle, steering, armed, estop, ts, clients=None):
+    # ts = wall time of the QCar I/O this sample came from (phones measure display latency against it)
+    clients = car.clients if clients is None else clients
+    if not clients: return
+    text = packed = None   # each encoding built at most once, only if someone speaks it
+    # Non-blocking: each client's writer task does the actual send.
+    for c in list(clients):
+        w = car.clients.get(c)
+        if w is None: continue
+        if w.binary:
+            if packed is None: packed = protocol.encode_telemetry(batt_pct, speed_mps, throttle, steering, armed, estop, ts)
+            w.offer(packed)
+        else:
+            if text is None:
+                text = json.dumps({
+                    'type':'telemetry',
+                    'battery_pct': batt_pct,
+                    'speed_mps': speed_mps,
+                    'throttle': throttle,
+                    'steering': steering,
+                    'armed': armed,
+                    'estop': estop,
+                    'ts': ts
+                })
+            w.offer(text)
+
+async def controller_task(car: Car, sample_rate: float, log_path: str, read_mode: int, log_opts: Dict[str, Any] = None,
+                          loop_mode: str = 'async', rt_priority: int = 50, sched_opts: Dict[str, Any] = None,
+                          backend: str = 'pal', sim_speed: float = 1.0, start_ns: int = None,
+                          proc_opts: Dict[str, Any] = None, bus_opts: Dict[str, Any] = None,
+                          est_opts: Dict[str, Any] = None):
+    state, metrics, latency, telemetry, history = car.state, car.metrics, car.latency, car.telemetry, car.history
+    tag = "[QCar]" if len(cars) <= 1 else f"[QCar {car.id}]"
+    if car.rate is None: car.rate = LoopRate(sample_rate, sim_speed if backend == 'sim' else 1.0, tag=tag)
+    if car.trajectory is None: car.trajectory = TrajectoryRunner(tag)
+    metrics.bind(trajectory=car.trajectory)
+    if loop_mode == 'process':
+        # Scheduler, QCar I/O and log run in touchdrive.ctlproc; this task only relays
+        # commands and telemetry through shared memory.
+        opts = proc_opts or {}
+        argv = ['--rate', repr(sample_rate), '--backend', backend, '--readmode', str(read_mode),
+                '--sim-speed', repr(sim_speed), '--log', log_path, '--log-opts', json.dumps(log_opts or {}),
+                '--sched-opts', json.dumps(sched_opts or {}), '--rt-priority', str(rt_priority),
+                '--failsafe-ms', repr(opts.get('failsafe_ms', 500.0)), '--start-ns', str(start_ns or 0),
+                '--slew-throttle', repr(state.filter.slew_throttle), '--slew-steer', repr(state.filter.slew_steering)]
+        if bus_opts: argv += ['--bus', bus_opts['name'], '--bus-size', str(bus_opts['capacity'])]
+        if est_opts: argv += ['--estimator-opts', json.dumps(est_opts)]
+        argv += ['--tuner-opts', json.dumps(car.rate.tuner_opts)] + (['--auto-rate'] if car.rate.auto else [])
+        link = await ControlLink.open(f"{opts.get('shm', 'qcar-td')}-{car.id}", argv, state, latency, tag)
+        car.link = link
+        link.loop_rate, car.rate.forward = car.rate, link.set_rate   # admin requests go to the control process
+        link.runner, car.trajectory.forward = car.trajectory, link.trajectory
+        metrics.bind(sched=link, log=link, rate=car.rate)
+        relay = asyncio.ensure_future(link.run(telemetry, min(sample_rate, 100.0), history))
+        try:
+            await relay   # until cancelled, or the control process exits
+        except asyncio.CancelledError:
+            pass
+        finally:
+            relay.cancel()
+            car.link = car.rate.forward = car.trajectory.forward = None
+            await link.close()
+        return
     sample_time = 1.0 / sample_rate
-    myCar = QCar(readMode=read_mode)   # 0 = immediate I/O (Virtual Lab OK)
-    _ = Calculus().differentiator_variable(sample_time)  # kept for parity
-
-    # CSV header
-    with open(log_path, 'w', newline='') as f:
-        csv.writer(f).writerow(['Timestamp','LinearSpeed_mps','Battery_pct','Throttle_cmd','Steering_cmd','Armed','EStop'])
-
-    print(f"[QCar] {sample_rate} Hz loop started. Open the page from your phone to drive.")
+    myCar = open_backend(backend, sample_time, read_mode=read_mode, sim_speed=sim_speed)
+
+    # Log writer (background thread)
+    log = open_log(log_path, **(log_opts or {}))
+    bus = open_bus(**bus_opts, rate=sample_rate) if bus_opts else None   # shared-memory ring for local readers
+    leds = led_table()   # preallocated LED patterns, reused every tick
+    estimator = open_estimator(**est_opts) if est_opts else None   # bridges gaps between bursty control messages
+    if estimator: metrics.bind(estimator=estimator)
+    clock = TickClock(sample_time, getattr(myCar, 'time_scale', 1.0))   # filters run on measured dt, not 1/rate
+    loop_rate = car.rate   # admin API / --auto-rate; applied between ticks
+    trajectory = car.trajectory   # scripted runs, played sample by sample
+
+    def tick():
+        t0 = time.perf_counter_ns()
+        applied = state.drain()
+        est = estimator.step(time.monotonic_ns(), state.cmd, applied) if estimator else None
+        scripted = trajectory.step(state.cmd[0], 1.0 / loop_rate.rate, state.estop)
+        if scripted is not None: est = scripted
+        throttle, steering = state.compute(state.throttle, state.steering, est, clock.step(t0),
+                                           scripted is None or trajectory.traj.smooth)
+        armed, estop = state.armed, state.estop
+
+        # LED indicators
+        LEDs = leds[led_index(throttle, steering)]
+
+        t1 = time.perf_counter_ns()
+        # Perform I/O
+        myCar.read_write_std(throttle=throttle, steering=steering, LEDs=LEDs)
+        t_act = time.time()
+
+        # Telemetry
+        batteryVoltage = myCar.batteryVoltage
+        bat_pct = battery_pct(batteryVoltage)
+        linearSpeed = float(myCar.motorTach)
+        t2 = time.perf_counter_ns()
+
+        # Log
+        cmd_latency = latency.actuated(applied, t_act) if applied else math.nan
+        mono = time.monotonic_ns()
+        log.write((mono, t_act, linearSpeed, bat_pct, throttle, steering, int(armed), int(estop), cmd_latency,
+                   latency.displayed(), trajectory.tagged))
+        t3 = time.perf_counter_ns()
+
+        # Hand the latest sample to the broadcaster (sent at --telemetry-rate) and the bus
+        telemetry.publish((bat_pct, linearSpeed, throttle, steering, armed, estop, t_act))
+        if history: history.append(mono, t_act, linearSpeed, throttle, steering, bat_pct)
+        if bus: bus.publish(mono, t_act, linearSpeed, bat_pct, throttle, steering, cmd_latency, sched.last_late_ns, armed, estop)
+        t4 = time.perf_counter_ns()
+
+        metrics.compute.observe(t1 - t0); metrics.io.observe(t2 - t1); metrics.log_write.observe(t3 - t2)
+        metrics.telemetry.observe(t4 - t3); metrics.tick.observe(t4 - t0); metrics.lateness.observe(sched.last_late_ns)
+        if loop_rate.tick(sched, t4, t4 - t0, t2 - t1):
+            retime(myCar, 1.0 / loop_rate.rate)
+            if bus: bus.set_rate(loop_rate.rate)
+
+    print(f"{tag} {sample_rate} Hz loop started. Open the page from your phone to drive.")
+    # A simulator may run faster than real time: same sample_time per tick, more ticks per second.
+    sched = DeadlineScheduler(sample_rate * getattr(myCar, 'time_scale', 1.0), **(sched_opts or {}))
+    sched.start(start_ns)   # cars share an epoch with staggered phases so their ticks don't collide
+    metrics.bind(sched=sched, log=log, rate=loop_rate)
+    rt = None
     try:
-        while True:
-            t0 = time.time()
-            throttle, steering = state.compute(state.throttle, state.steering)
-
-            # LED indicators
-            LEDs = np.array([0,0,0,0,0,0,1,1])
-            if steering > 0.3: LEDs[0]=LEDs[2]=1
-            elif steering < -0.3: LEDs[1]=LEDs[3]=1
-            if throttle < 0: LEDs[5]=1
-
-            # Perform I/O
-            myCar.read_write_std(throttle=throttle, steering=steering, LEDs=LEDs)
-
-            # Telemetry
-            batteryVoltage = myCar.batteryVoltage
-            bat_pct = float(np.clip(100 - (batteryVoltage - 10.5)*100/(12.6-10.5), 0, 100))
-            linearSpeed = float(myCar.motorTach)
-
-            # Log
-            ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-            with open(log_path, 'a', newline='') as f:
-                csv.writer(f).writerow([ts, linearSpeed, bat_pct, throttle, steering, int(state.armed), int(state.estop)])
-
-            # Stream to clients
-            await push_telemetry(bat_pct, linearSpeed, throttle, steering)
-
-            # Maintain loop rate
-            elapsed = time.time() - t0
-            sleep = sample_time - (elapsed % sample_time)
-            if sleep > 0: await asyncio.sleep(sleep)
+        if loop_mode == 'thread':
+            # Tick runs on its own thread; this coroutine just waits for it to exit.
+            loop, done = asyncio.get_running_loop(), asyncio.Event()
+            rt = ControlThread(tick, sched, on_exit=lambda: loop.call_soon_threadsafe(done.set),
+                               priority=rt_priority, tag=tag).start()
+            await done.wait()
+            if rt.error: raise rt.error
+        else:
+            while True:
+                # Maintain loop rate
+                await sched.wait_async()
+                tick()
     except asyncio.CancelledError:
         pass
     finally:
+        if rt: rt.stop()
         myCar.terminate()
-        print("[QCar] Stopped.")
+        print(f"{tag} {sched.summary()}")
+        log.close()
+        if bus: bus.close()
+        if estimator: print(f"[Input] {estimator.summary()}")
+        if log.dropped: print(f"[Log] {log_path}: {log.dropped} rows dropped (writer queue full).")
+        print(f"{tag} Stopped.")
 
 def make_app():
-    app = web.Application()
+    global site
+    site = StaticSite(HTML)
+    print(f"[Server] {site.summary()}")
+    app = web.Application(client_max_size=16 << 20)   # room for a MAX_SAMPLES trajectory upload (default 1 MB)
     app.router.add_get('/', handle_index)
+    app.router.add_get('/static/{name}', site.handle_static)
+    app.router.add_get('/sw.js', site.handle_sw)
+    for path in ('/manifest.webmanifest', '/car/{car}/manifest.webmanifest'): app.router.add_get(path, site.handle_manifest)
     app.router.add_get('/ws', handle_ws)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/history', handle_history)
+    for path in ('/admin/rate', '/car/{car}/admin/rate'):
+        app.router.add_get(path, handle_admin_rate); app.router.add_post(path, handle_admin_rate)
+    for path in ('/trajectory', '/car/{car}/trajectory'):
+        app.router.add_get(path, handle_trajectory); app.router.add_post(path, handle_trajectory)
+        app.router.add_post(path + '/{action:start|abort}', handle_trajectory)
+    for path in ('/car/{car}', '/car/{car}/'): app.router.add_get(path, handle_index)
+    app.router.add_get('/car/{car}/ws', handle_ws)
+    app.router.add_get('/car/{car}/metrics', handle_metrics)
+    app.router.add_get('/car/{car}/history', handle_history)
     return app
 
 async def main():
@@ -543,38 +894,131 @@ async def main():
     ap.add_argument('--host', default='0.0.0.0')
     ap.add_argument('--port', type=int, default=8000)
     ap.add_argument('--rate', type=float, default=50.0)
+    ap.add_argument('--telemetry-rate', type=float, default=20.0)  # Hz, independent of --rate
+    ap.add_argument('--client-queue', type=int, default=2)       # telemetry frames buffered per client
+    ap.add_argument('--evict-after', type=float, default=2.0)    # s a client may stay backlogged
+    ap.add_argument('--ws-binary', action='store_true')          # offer the compact binary protocol
     ap.add_argument('--log', default='manual_drive_log.csv')
     ap.add_argument('--readmode', type=int, default=0)  # 0 immediate I/O
+    ap.add_argument('--backend', choices=['pal','sim'], default='pal')  # sim = built-in QCar model, no SDK needed
+    ap.add_argument('--sim-speed', type=float, default=1.0)  # sim: x real time (e.g. 20 for soak tests)
+    ap.add_argument('--log-queue', type=int, default=4096)    # rows buffered before dropping
+    ap.add_argument('--log-flush', type=float, default=0.5)   # s between file flushes
+    ap.add_argument('--log-fsync', type=float, default=0.0)   # s between fsyncs (0 = on close only)
+    ap.add_argument('--log-format', choices=['csv','binary'], default='csv')
+    ap.add_argument('--loop-mode', choices=['async','thread','process'], default='async')  # thread/process = I/O off the event loop
+    ap.add_argument('--rt-priority', type=int, default=50)  # SCHED_FIFO priority for --loop-mode thread
+    ap.add_argument('--spin-us', type=float, default=0.0)   # busy-wait the last N us before each deadline
+    ap.add_argument('--overrun', choices=['skip','catchup','degrade'], default='skip')
+    ap.add_argument('--log-segment-mb', type=float, default=64.0)  # binary: rotate after N MB (0 = never)
+    ap.add_argument('--log-segment-sec', type=float, default=0.0)  # binary: rotate after N s (0 = never)
+    ap.add_argument('--record', default=None)  # capture inbound /ws frames for python -m touchdrive.replay
+    ap.add_argument('--failsafe-ms', type=float, default=500.0)  # process: zero commands if the web side stalls this long
+    ap.add_argument('--shm-name', default=None)  # process: shared-memory prefix (default qcar-td-<port>)
+    ap.add_argument('--bus-size', type=int, default=4096)  # ticks kept in the shared-memory telemetry bus (0 = off)
+    ap.add_argument('--bus-name', default=None)  # bus prefix in /dev/shm (default qcar-bus-<port>)
+    ap.add_argument('--history-sec', type=float, default=600.0)  # telemetry kept in memory for /history charts (0 = off)
+    ap.add_argument('--auto-rate', action='store_true')  # pick --rate from measured tick cost and keep adjusting it
+    ap.add_argument('--auto-rate-min', type=float, default=20.0)
+    ap.add_argument('--auto-rate-max', type=float, default=1000.0)
+    ap.add_argument('--auto-overruns', type=float, default=0.01)  # auto-rate: tolerated share of overrunning ticks
+    ap.add_argument('--admin-token', default=None)  # bearer token for /admin/* (unset = loopback only)
+    ap.add_argument('--slew-throttle', type=float, default=0.0)  # max throttle change, m/s per s (0 = unlimited)
+    ap.add_argument('--slew-steer', type=float, default=0.0)     # max steering change, rad/s (0 = unlimited)
+    ap.add_argument('--estimator', choices=['off','extrapolate','interpolate'], default='off')  # bridge gaps in bursty stick input
+    ap.add_argument('--est-horizon-ms', type=float, default=100.0)  # extrapolate at most this far past the newest sample
+    ap.add_argument('--est-stale-ms', type=float, default=300.0)    # input older than this decays to zero
+    ap.add_argument('--est-decay-ms', type=float, default=150.0)    # time constant of that decay
+    ap.add_argument('--est-delay-ms', type=float, default=50.0)     # interpolate: render this far behind the newest sample
+    ap.add_argument('--cars', type=int, default=1)  # vehicles served at /car/<id>/ (more than one needs --backend sim)
     args = ap.parse_args()
 
+    client_opts.update(depth=args.client_queue, evict_after=args.evict_after)
+    global ws_protocols, admin_token
+    admin_token = args.admin_token
+    if args.ws_binary: ws_protocols = (protocol.BIN_PROTO, protocol.JSON_PROTO)
+    ids = car_ids(args.cars)
+    if len(ids) > 1 and args.backend == 'pal':
+        ap.error("PAL drives the one QCar attached to this host; use --backend sim for --cars > 1")
+    time_scale = args.sim_speed if args.backend == 'sim' else 1.0
+    for car_id in ids:
+        car = add_car(car_id)
+        car.state.filter = CommandFilter(args.slew_throttle, args.slew_steer)
+        car.rate = LoopRate(args.rate, time_scale, args.auto_rate,
+                            dict(min_rate=args.auto_rate_min, max_rate=args.auto_rate_max, overruns=args.auto_overruns),
+                            "[QCar]" if len(ids) <= 1 else f"[QCar {car_id}]")
+        car.trajectory = TrajectoryRunner(car.rate.tag)
+        if args.history_sec > 0: car.history = TelemetryHistory(args.history_sec * args.rate * time_scale)
+        if args.record:
+            car.recorder = SessionRecorder(car_path(args.record, car_id, len(ids)), args.rate, time_scale).start()
     app = make_app()
     runner = web.AppRunner(app); await runner.setup()
     site = web.TCPSite(runner, host=args.host, port=args.port); await site.start()
     print(f"[Server] http://{args.host}:{args.port}")
-
-    ctrl = asyncio.create_task(controller_task(args.rate, args.log, args.readmode))
+    if len(ids) > 1: print(f"[Server] {len(ids)} cars at /car/<id>/ (id 0..{len(ids) - 1})")
+
+    log_opts = dict(fmt=args.log_format, maxsize=args.log_queue,
+                    flush_interval=args.log_flush, fsync_interval=args.log_fsync)
+    if args.log_format == 'binary':
+        log_opts.update(segment_bytes=int(args.log_segment_mb * (1 << 20)), segment_sec=args.log_segment_sec)
+    # One broadcaster + control loop per car; tick phases spread evenly over one period.
+    period_ns = int(1e9 / (args.rate * time_scale))
+    epoch = time.monotonic_ns() + period_ns
+    stop = asyncio.get_running_loop().create_future()
+
+    def task_done(t):
+        # A broadcaster or control loop that ends on its own leaves a car without control: stop the server.
+        if t.cancelled() or stop.done(): return
+        e = t.exception()
+        print(f"[Server] {t.get_coro().__name__} for a car exited" + (f": {e!r}" if e else "") + ", stopping the server.", flush=True)
+        stop.set_result(True)
+
+    tasks = []
+    for i, car in enumerate(cars.values()):
+        tasks.append(asyncio.create_task(car.telemetry.run(args.telemetry_rate, on_send=car.metrics.broadcast.observe)))
+        tasks.append(asyncio.create_task(trajectory_progress(car)))
+        tasks.append(asyncio.create_task(controller_task(car, args.rate, car_path(args.log, car.id, len(cars)), args.readmode,
+                                                         log_opts, args.loop_mode, args.rt_priority,
+                                                         dict(spin_us=args.spin_us, policy=args.overrun),
+                                                         args.backend, args.sim_speed,
+                                                         epoch + i * period_ns // len(cars),
+                                                         dict(failsafe_ms=args.failsafe_ms,
+                                                              shm=args.shm_name or f"qcar-td-{args.port}"),
+                                                         args.bus_size and dict(
+                                                             name=bus_name(args.bus_name or f"qcar-bus-{args.port}", car.id),
+                                                             capacity=args.bus_size),
+                                                         args.estimator != 'off' and dict(
+                                                             mode=args.estimator, horizon_ms=args.est_horizon_ms,
+                                                             stale_ms=args.est_stale_ms, decay_ms=args.est_decay_ms,
+                                                             delay_ms=args.est_delay_ms))))
+    for t in tasks: t.add_done_callback(task_done)
 
     try:
         if os.name != 'nt':
             import signal
             loop = asyncio.get_running_loop()
-            stop = asyncio.Future()
             for sig in (signal.SIGINT, signal.SIGTERM):
                 loop.add_signal_handler(sig, lambda: (not stop.done()) and stop.set_result(True))
             await stop
         else:
             print("[Server] Press Ctrl+C in this window to stop.")
-            while True:
-                await asyncio.sleep(3600)
+            await stop
     except KeyboardInterrupt:
         pass
     finally:
-        ctrl.cancel()
-        try:
-            await ctrl
-        except asyncio.CancelledError:
-            pass
+        for t in tasks: t.cancel()
+        for t in tasks:
+            try:
+                await t
+            except (asyncio.CancelledError, Exception):   # failures were reported by task_done
+                pass
         await runner.cleanup()
+        for car in cars.values():
+            rec = car.recorder
+            if rec:
+                rec.close()
+                print(f"[Record] {rec.written} frames -> {rec.path}"
+                      + (f", {rec.dropped} dropped (queue full)" if rec.dropped else ""))
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,2 @@
+# touchdrive/__init__.py
+# Support modules shared by qcar_phone_drive.py and task_task_manual_drive_phone.py.
@@ -0,0 +1,199 @@
+# touchdrive/assets.py
+# Static serving for the phone UI.
+# The page is still written inline in each drive script (HTML = r"""..."""),
+# but at startup StaticSite splits it into a shell plus content-hashed CSS / JS,
+# minifies them and precompresses every asset once (gzip, plus brotli when the
+# `brotli` package is installed). Requests then only pick a stored body:
+#   /, /car/<id>/              index shell        Cache-Control: no-cache + strong ETag (304s)
+#   /static/app.<hash>.css|js  hashed assets      immutable for a year
+#   /sw.js                     service worker     no-cache; caches the shell for instant/offline start
+#   manifest.webmanifest       home-screen app    relative to the page, so each car gets its own shortcut
+# Service workers only run in a secure context (HTTPS, e.g. `tailscale serve`, or localhost).
+
+import gzip, hashlib, json, re
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+# ---- minifiers (conservative: comments and indentation only) ----
+_REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+_REGEX_WORDS = ('return', 'typeof', 'case', 'do', 'else', 'in', 'of', 'new', 'delete', 'void', 'throw', 'yield', 'await')
+
+def minify_js(src):
+    # Drops comments, indentation and blank lines; keeps every newline that
+    # separates statements, so automatic semicolon insertion is unaffected.
+    out, i, n = [], 0, len(src)
+    def prev_sig():
+        j = len(out) - 1
+        while j >= 0 and out[j] in ' \t\n': j -= 1
+        return out[j] if j >= 0 else ''
+    def prev_word():
+        tail = ''.join(out[-12:]).rstrip()
+        m = re.search(r'[A-Za-z_$]+$', tail)
+        return m.group(0) if m else ''
+    while i < n:
+        c = src[i]
+        if c in '\'"`':
+            j = i + 1
+            while j < n and src[j] != c:
+                j += 2 if src[j] == '\\' else 1
+            out.append(src[i:j + 1]); i = j + 1
+        elif src.startswith('//', i):
+            while i < n and src[i] != '\n': i += 1
+        elif src.startswith('/*', i):
+            i = src.find('*/', i + 2)
+            i = n if i < 0 else i + 2
+        elif c == '/' and (prev_sig() in _REGEX_AFTER or prev_sig() == '' or prev_word() in _REGEX_WORDS):
+            j, cls = i + 1, False
+            while j < n and (cls or src[j] != '/'):
+                if src[j] == '\\': j += 1
+                elif src[j] == '[': cls = True
+                elif src[j] == ']': cls = False
+                j += 1
+            out.append(src[i:j + 1]); i = j + 1
+        elif c == '\n':
+            while out and out[-1] in ' \t': out.pop()
+            if out and out[-1] != '\n': out.append('\n')
+            i += 1
+            while i < n and src[i] in ' \t': i += 1
+        else:
+            out.append(c); i += 1
+    return ''.join(out).strip() + '\n'
+
+def minify_css(src):
+    src = re.sub(r'/\*.*?\*/', '', src, flags=re.S)
+    src = re.sub(r'\s+', ' ', src)
+    src = re.sub(r'\s*([{};,>])\s*', r'\1', src)
+    return src.replace(';}', '}').strip()
+
+def minify_html(src):
+    src = re.sub(r'<!--.*?-->', '', src, flags=re.S)
+    return '\n'.join(line.strip() for line in src.splitlines() if line.strip())
+
+# ---- assets ----
+def _accepts(header):
+    # Accept-Encoding -> {coding: q}
+    out = {}
+    for part in header.split(','):
+        name, _, params = part.strip().partition(';')
+        m = re.search(r'q=([0-9.]+)', params)
+        try: out[name.strip().lower()] = float(m.group(1)) if m else 1.0
+        except ValueError: pass
+    return out
+
+class Asset:
+    def __init__(self, body, content_type, cache_control):
+        if isinstance(body, str): body = body.encode()
+        self.content_type, self.cache_control = content_type, cache_control
+        self.hash = hashlib.sha256(body).hexdigest()[:16]
+        self.bodies = {'identity': body}
+        gz = gzip.compress(body, 9, mtime=0)
+        if len(gz) < len(body): self.bodies['gzip'] = gz
+        if brotli is not None:
+            br = brotli.compress(body, quality=11)
+            if len(br) < len(self.bodies.get('gzip', body)): self.bodies['br'] = br
+        # Strong validators, one per representation.
+        self.etags = {enc: f'"{self.hash}"' if enc == 'identity' else f'"{self.hash}-{enc}"' for enc in self.bodies}
+
+    def encoding(self, accept_encoding):
+        q = _accepts(accept_encoding or '')
+        for enc in ('br', 'gzip'):
+            if enc in self.bodies and q.get(enc, q.get('*', 0.0)) > 0: return enc
+        return 'identity'
+
+    def respond(self, request):
+        enc = self.encoding(request.headers.get('Accept-Encoding'))
+        etag = self.etags[enc]
+        headers = {'ETag': etag, 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        inm = request.headers.get('If-None-Match')
+        if inm and (inm.strip() == '*' or etag in [t.strip().removeprefix('W/') for t in inm.split(',')]):
+            return web.Response(status=304, headers=headers)
+        if enc != 'identity': headers['Content-Encoding'] = enc
+        return web.Response(body=self.bodies[enc], headers=headers, content_type=self.content_type, charset='utf-8')
+
+SW_JS = r"""// QCar controller service worker: shell from cache first, refreshed in the background.
+const CACHE = 'qcar-%(version)s';
+const SHELL = %(shell)s;
+self.addEventListener('install', e => {
+  e.waitUntil(caches.open(CACHE).then(c => c.addAll(SHELL)).then(() => self.skipWaiting()));
+});
+self.addEventListener('activate', e => {
+  e.waitUntil(caches.keys().then(ks => Promise.all(ks.filter(k => k.startsWith('qcar-') && k !== CACHE).map(k => caches.delete(k))))
+    .then(() => self.clients.claim()));
+});
+self.addEventListener('fetch', e => {
+  const req = e.request, url = new URL(req.url);
+  if (req.method !== 'GET' || url.origin !== location.origin) return;
+  if (url.pathname.startsWith('/static/')) {
+    e.respondWith(caches.match(req).then(hit => hit || fetch(req)));
+  } else if (req.mode === 'navigate') {
+    e.respondWith(caches.open(CACHE).then(c => c.match(url.pathname).then(hit => {
+      const net = fetch(req).then(res => { if (res.ok) c.put(url.pathname, res.clone()); return res; });
+      if (hit) { e.waitUntil(net.catch(() => {})); return hit; }
+      return net.catch(() => c.match('/'));   // offline: every car uses the same shell
+    })));
+  }
+});
+"""
+
+def _collapse(html, pattern, tag, last=False):
+    # Removes every match of pattern and puts tag where the first (or last) one was.
+    ms = list(re.finditer(pattern, html, re.S))
+    if not ms: return html
+    keep, out, pos = ms[-1] if last else ms[0], [], 0
+    for m in ms:
+        out.append(html[pos:m.start()])
+        if m is keep: out.append(tag)
+        pos = m.end()
+    out.append(html[pos:])
+    return ''.join(out)
+
+SW_REGISTER = "if('serviceWorker' in navigator&&window.isSecureContext)navigator.serviceWorker.register('/sw.js').catch(()=>{});\n"
+
+class StaticSite:
+    def __init__(self, html, name='QCar Controller', short_name='QCar', theme='#0b0f14'):
+        self.raw_size = len(html.encode())
+        css = ''.join(m.group(1) for m in re.finditer(r'<style>(.*?)</style>', html, re.S))
+        js = ''.join(m.group(1) for m in re.finditer(r'<script>(.*?)</script>', html, re.S))
+        self.css = Asset(minify_css(css), 'text/css', IMMUTABLE)
+        self.js = Asset(minify_js(js) + SW_REGISTER, 'application/javascript', IMMUTABLE)
+        css_url, js_url = f'/static/app.{self.css.hash}.css', f'/static/app.{self.js.hash}.js'
+
+        # Shell: styles become one <link> where the first <style> was, scripts one <script src> where the last was.
+        shell = _collapse(html, r'<style>.*?</style>', f'<link rel="stylesheet" href="{css_url}">')
+        shell = _collapse(shell, r'<script>.*?</script>', f'<script src="{js_url}"></script>', last=True)
+        shell = shell.replace('</head>', f'<link rel="manifest" href="manifest.webmanifest">\n'
+                                         f'<meta name="theme-color" content="{theme}">\n</head>', 1)
+        self.index = Asset(minify_html(shell), 'text/html', REVALIDATE)
+
+        self.manifest = Asset(json.dumps({'name': name, 'short_name': short_name, 'start_url': './', 'scope': './',
+                                          'display': 'fullscreen', 'orientation': 'landscape',
+                                          'background_color': theme, 'theme_color': theme}),
+                              'application/manifest+json', REVALIDATE)
+        version = hashlib.sha256((self.index.hash + self.css.hash + self.js.hash).encode()).hexdigest()[:16]
+        self.sw = Asset(SW_JS % {'version': version, 'shell': json.dumps(['/', css_url, js_url])},
+                        'application/javascript', REVALIDATE)
+        self.static = {css_url.rsplit('/', 1)[1]: self.css, js_url.rsplit('/', 1)[1]: self.js}
+
+    def summary(self):
+        def sizes(a): return '/'.join(f"{len(b) / 1024:.1f}" for b in a.bodies.values()) + ' KB (' + '/'.join(a.bodies) + ')'
+        return (f"page {self.raw_size / 1024:.1f} KB inline -> shell {sizes(self.index)}, "
+                f"css {sizes(self.css)}, js {sizes(self.js)}")
+
+    async def handle_static(self, request):
+        asset = self.static.get(request.match_info['name'])
+        if asset is None: raise web.HTTPNotFound()
+        return asset.respond(request)
+
+    async def handle_sw(self, request):
+        return self.sw.respond(request)
+
+    async def handle_manifest(self, request):
+        return self.manifest.respond(request)
@@ -0,0 +1,81 @@
+# touchdrive/backends.py
+# Vehicle backends (--backend pal|sim).
+# Anything the control loop drives only needs what controller_task uses:
+#     read_write_std(throttle=, steering=, LEDs=)   one blocking I/O step
+#     batteryVoltage, motorTach                     telemetry from that step (V, m/s)
+#     terminate()
+# plus an optional time_scale (sim seconds per wall second, default 1) and
+# set_sample_time(dt) for backends that care about the tick length.
+# 'pal' is the Quanser QCar; 'sim' is a kinematic bicycle model with motor /
+# steering lag and battery discharge, so the server runs without the SDK.
+
+import math
+
+def open_backend(name, sample_time, read_mode=0, sim_speed=1.0):
+    if not isinstance(name, str): return name   # an already-built backend (benchmarks, tests)
+    if name == 'pal':
+        # Imported here so the rest of the server (and the simulator) work without PAL.
+        from pal.products.qcar import QCar
+        from pal.utilities.math import Calculus
+        car = QCar(readMode=read_mode)   # 0 = immediate I/O (hardware & Virtual Lab)
+        _ = Calculus().differentiator_variable(sample_time)
+        return car
+    if name == 'sim':
+        return SimQCar(sample_time, time_scale=sim_speed)
+    raise ValueError(f"unknown backend {name!r}")
+
+class SimQCar:
+    WHEELBASE = 0.256        # m
+    MAX_STEER = 0.5          # rad at the wheels
+    MOTOR_TAU = 0.15         # s, speed response to a throttle step
+    STEER_TAU = 0.05         # s, servo response
+    CAPACITY_AH = 3.3
+    V_EMPTY, V_FULL = 10.5, 12.6
+    IDLE_A, DRIVE_A_PER_MPS, SAG_OHM = 0.6, 5.0, 0.03
+
+    def __init__(self, sample_time, time_scale=1.0, soc=1.0):
+        # One read_write_std() advances the model by exactly sample_time, whatever the
+        # wall clock did, so runs are deterministic. time_scale > 1 asks the caller to
+        # tick that much faster than real time (soak tests).
+        self.time_scale = float(time_scale)
+        self.t = 0.0
+        self.x = self.y = self.heading = 0.0
+        self.speed = 0.0         # m/s
+        self.delta = 0.0         # rad, actual wheel angle
+        self.soc = float(soc)
+        self.current = self.IDLE_A
+        self.LEDs = None
+        self.batteryVoltage = self._voltage()
+        self.motorTach = 0.0
+        self.set_sample_time(sample_time)
+
+    def set_sample_time(self, sample_time):
+        # Live loop-rate changes: later steps advance the model by the new tick length.
+        self.dt = float(sample_time)
+        self._k_motor = 1.0 - math.exp(-self.dt / self.MOTOR_TAU)
+        self._k_steer = 1.0 - math.exp(-self.dt / self.STEER_TAU)
+
+    def _voltage(self):
+        return self.V_EMPTY + (self.V_FULL - self.V_EMPTY)*self.soc - self.SAG_OHM*self.current
+
+    def read_write_std(self, throttle=0.0, steering=0.0, LEDs=None):
+        dt = self.dt
+        self.LEDs = LEDs
+        target = max(-self.MAX_STEER, min(self.MAX_STEER, float(steering)))
+        self.delta += (target - self.delta) * self._k_steer
+        # Throttle is the commanded speed in m/s (see ControllerState); no power once flat.
+        cmd = float(throttle) if self.soc > 0 else 0.0
+        self.speed += (cmd - self.speed) * self._k_motor
+
+        self.heading += self.speed / self.WHEELBASE * math.tan(self.delta) * dt
+        self.x += self.speed * math.cos(self.heading) * dt
+        self.y += self.speed * math.sin(self.heading) * dt
+
+        self.current = self.IDLE_A + self.DRIVE_A_PER_MPS * abs(self.speed)
+        self.soc = max(0.0, self.soc - self.current * dt / 3600.0 / self.CAPACITY_AH)
+        self.batteryVoltage = self._voltage()
+        self.motorTach = self.speed
+        self.t += dt
+
+    def terminate(self):
+        self.speed = self.motorTach = 0.0
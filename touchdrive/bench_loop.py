@@ -0,0 +1,249 @@
+# touchdrive/bench_loop.py
+# Control-loop benchmark: runs the real controller_task (scheduler, tick,
+# log writer, telemetry broadcaster, per-client writers) against a stand-in
+# QCar whose I/O call blocks for a configurable latency distribution, over a
+# sweep of loop rates x client counts x I/O profiles.
+# For every configuration it reports achieved rate, actuation-period jitter
+# percentiles, overruns / missed deadlines and CPU use, and can write JSON
+# so runs on different hosts and commits can be compared.
+#   python -m touchdrive.bench_loop --rates 50 100 200 500 1000 --clients 0 8 32 --json out.json
+#   python -m touchdrive.bench_loop --cars 8 --rates 100 200 --clients 2 --loop-mode thread   # fleet
+#
+# I/O latency profiles (microseconds):
+#   none | const:US | uniform:LO:HI | normal:MEAN:SD | lognormal:MEDIAN:SIGMA
+#   append +spike:P:US to add a US stall with probability P per call, e.g. lognormal:300:0.4+spike:0.001:5000
+
+import argparse, asyncio, contextlib, importlib.util, io, json, math, os, platform, random
+import subprocess, sys, tempfile, time
+
+from touchdrive.backends import SimQCar
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PCTS = (50, 90, 99, 99.9)
+
+# ---- stand-in QCar ----
+def parse_latency(spec, seed=0):
+    # Returns a function giving the next I/O latency in ns.
+    rnd = random.Random(seed)
+    spec, _, spike = spec.partition('+spike:')
+    kind, *a = spec.split(':')
+    a = [float(x) for x in a]
+    if kind == 'none': base = lambda: 0.0
+    elif kind == 'const': base = lambda: a[0]
+    elif kind == 'uniform': base = lambda: rnd.uniform(a[0], a[1])
+    elif kind == 'normal': base = lambda: max(0.0, rnd.gauss(a[0], a[1]))
+    elif kind == 'lognormal': base = lambda: a[0] * math.exp(rnd.gauss(0.0, a[1]))
+    else: raise ValueError(f"unknown latency profile {spec!r}")
+    if spike:
+        p, us = (float(x) for x in spike.split(':'))
+        return lambda: int(((us if rnd.random() < p else 0.0) + base()) * 1e3)
+    return lambda: int(base() * 1e3)
+
+class StandInQCar(SimQCar):
+    # SimQCar whose read_write_std blocks like the real driver and records
+    # when each actuation happened.
+    def __init__(self, sample_time, latency):
+        super().__init__(sample_time)
+        self._latency = latency
+        self.stamps = []          # perf_counter_ns at the end of each I/O step
+        self.io_ns = 0
+
+    def read_write_std(self, throttle=0.0, steering=0.0, LEDs=None):
+        pc = time.perf_counter_ns
+        t = pc()
+        super().read_write_std(throttle=throttle, steering=steering, LEDs=LEDs)
+        end = t + self._latency()
+        # Sleep the bulk, spin the tail: time.sleep alone overshoots by ~50-100 us.
+        if end - t > 200_000: time.sleep((end - t - 100_000) * 1e-9)
+        while pc() < end: pass
+        now = pc()
+        self.io_ns += now - t
+        self.stamps.append(now)
+
+# ---- fake phones ----
+class NullSocket:
+    # Enough of aiohttp's WebSocketResponse for ClientWriter.
+    def __init__(self):
+        self.closed = False
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_str(self, s):
+        self.frames += 1; self.bytes += len(s)
+
+    async def send_bytes(self, b):
+        self.frames += 1; self.bytes += len(b)
+
+    async def close(self, code=1000, message=b''):
+        self.closed = True
+
+async def phone(state, ws, hz, seed):
+    # Arms, then sends stick updates like the page does (one per frame at most).
+    rnd = random.Random(seed)
+    state.post(ws, {'type': 'arm'})
+    seq, period = 0, 1.0 / hz
+    while True:
+        seq += 1
+        state.post(ws, {'type': 'control', 'seq': seq, 'ts': time.time() * 1000,
+                            'left': {'x': rnd.uniform(-1, 1), 'y': 0.0},
+                            'right': {'x': 0.0, 'y': rnd.uniform(-1, 1)}})
+        await asyncio.sleep(period)
+
+# ---- one configuration ----
+def load_server(script, tag):
+    # Fresh module per run so state, clients and metrics start empty.
+    spec = importlib.util.spec_from_file_location(f"_bench_server_{tag}", script)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+def percentiles(xs, qs=PCTS):
+    if not xs: return {str(q): None for q in qs}
+    xs = sorted(xs)
+    return {str(q): xs[min(len(xs) - 1, int(round(q / 100.0 * (len(xs) - 1))))] for q in qs}
+
+async def run_one(mod, rate, n_clients, backends, args, log_dir):
+    # One server module hosting len(backends) cars, n_clients fake phones on each.
+    clients, tasks, ctrls = [], [], []
+    period_ns = int(1e9 / rate)
+    epoch = time.monotonic_ns() + period_ns
+    for k, backend in enumerate(backends):
+        car = mod.add_car(k)
+        for i in range(n_clients):
+            ws = NullSocket()
+            car.clients[ws] = mod.ClientWriter(ws, f"bench{k}.{i}", depth=args.client_queue).start()
+            clients.append(ws)
+            if args.client_hz > 0: tasks.append(asyncio.ensure_future(phone(car.state, ws, args.client_hz, i)))
+        tasks.append(asyncio.ensure_future(car.telemetry.run(args.telemetry_rate)))
+        log_path = os.path.join(log_dir, f"bench_log.car{k}" + ('.csv' if args.log_format == 'csv' else ''))
+        ctrls.append(asyncio.ensure_future(mod.controller_task(
+            car, rate, log_path, 0, {'fmt': args.log_format}, args.loop_mode, args.rt_priority,
+            {'spin_us': args.spin_us, 'policy': args.overrun}, backend, 1.0,
+            epoch + k * period_ns // len(backends))))
+
+    await asyncio.sleep(args.warmup)
+    scheds = [c.metrics._sched for c in mod.cars.values()]
+    n0 = [len(b.stamps) for b in backends]
+    ticks0, over0, miss0 = (sum(getattr(s, a) for s in scheds) for a in ('ticks', 'overruns', 'missed'))
+    io0, frames0 = sum(b.io_ns for b in backends), sum(ws.frames for ws in clients)
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    await asyncio.sleep(args.duration)
+    cpu1, wall1 = time.process_time(), time.perf_counter()
+    stamps = [b.stamps[n:] for b, n in zip(backends, n0)]
+    ticks, over, miss = (sum(getattr(s, a) for s in scheds) - v0
+                         for a, v0 in (('ticks', ticks0), ('overruns', over0), ('missed', miss0)))
+    io_ns, frames = sum(b.io_ns for b in backends) - io0, sum(ws.frames for ws in clients) - frames0
+
+    for t in tasks + ctrls: t.cancel()
+    await asyncio.gather(*ctrls, *tasks, return_exceptions=True)
+    for car in mod.cars.values():
+        for w in list(car.clients.values()): w.stop()
+
+    # Jitter is pooled over all cars; achieved rate is the slowest car's.
+    period_us = 1e6 / rate
+    periods = [(b - a) / 1e3 for st in stamps for a, b in zip(st, st[1:])]
+    jitter = [abs(p - period_us) for p in periods]
+    spans = [((len(st) - 1), (st[-1] - st[0]) * 1e-9) for st in stamps if len(st) > 1]
+    achieved = min((n / span for n, span in spans if span > 0), default=0.0)
+    n_io = sum(len(st) for st in stamps)
+    wall = wall1 - wall0
+    return {
+        'rate_hz': rate, 'cars': len(backends), 'clients': n_clients, 'io': args.io_spec,
+        'ticks': ticks, 'achieved_hz': round(achieved, 2),
+        'overruns': over, 'missed': miss,
+        'period_mean_us': round(sum(periods) / len(periods), 1) if periods else None,
+        'period_max_us': round(max(periods), 1) if periods else None,
+        'jitter_us': {q: v if v is None else round(v, 1) for q, v in percentiles(jitter).items()},
+        'io_mean_us': round(io_ns / n_io / 1e3, 1) if n_io else None,
+        'cpu_pct': round(100.0 * (cpu1 - cpu0) / wall, 1),
+        'telemetry_frames': frames,
+        'kept_up': achieved >= args.keep_up * rate and miss <= (1.0 - args.keep_up) * max(1, ticks / len(backends)),
+    }
+
+def bench(script, rate, n_clients, args, tag):
+    mod = load_server(script, tag)
+    backends = [StandInQCar(1.0 / rate, parse_latency(args.io_spec, seed=tag * 100 + k)) for k in range(args.cars)]
+    with tempfile.TemporaryDirectory() as tmp:
+        out = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else out):
+            return asyncio.run(run_one(mod, rate, n_clients, backends, args, tmp))
+
+# ---- report ----
+def host_info(script):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except Exception: commit = None
+    return {'host': platform.node(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'cpus': os.cpu_count(), 'commit': commit, 'script': os.path.basename(script),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+def print_row(r):
+    f = lambda v, w: f"{'-':>{w}}" if v is None else f"{v:>{w}.1f}"   # None = too few ticks to tell
+    j = r['jitter_us']
+    print(f"{r['rate_hz']:>7.0f} {r['clients']:>4d} {r['achieved_hz']:>9.1f} {r['overruns']:>6d} {r['missed']:>6d} "
+          f"{f(j['50'], 8)} {f(j['99'], 8)} {f(j['99.9'], 8)} {f(r['period_max_us'], 9)} {f(r['io_mean_us'], 7)} "
+          f"{r['cpu_pct']:>6.1f}  {'ok' if r['kept_up'] else 'BEHIND'}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Control-loop jitter / max-rate sweep against a stand-in QCar.")
+    ap.add_argument('--script', default=os.path.join(ROOT, 'qcar_phone_drive.py'))
+    ap.add_argument('--rates', type=float, nargs='+', default=[50, 100, 200, 500, 1000])
+    ap.add_argument('--clients', type=int, nargs='+', default=[0, 1, 8, 32])   # fake phones per car
+    ap.add_argument('--cars', type=int, default=1)          # cars hosted by the one server process
+    ap.add_argument('--io', nargs='+', default=['lognormal:300:0.3'])  # I/O latency profiles, see header
+    ap.add_argument('--duration', type=float, default=5.0)   # s measured per configuration
+    ap.add_argument('--warmup', type=float, default=0.5)     # s discarded before measuring
+    ap.add_argument('--client-hz', type=float, default=30.0) # stick updates per fake phone
+    ap.add_argument('--client-queue', type=int, default=2)
+    ap.add_argument('--telemetry-rate', type=float, default=20.0)
+    ap.add_argument('--loop-mode', choices=['async','thread'], default='async')
+    ap.add_argument('--rt-priority', type=int, default=50)
+    ap.add_argument('--spin-us', type=float, default=0.0)
+    ap.add_argument('--overrun', choices=['skip','catchup','degrade'], default='skip')
+    ap.add_argument('--log-format', choices=['csv','binary'], default='csv')
+    ap.add_argument('--keep-up', type=float, default=0.99)   # achieved/target needed to count as sustained
+    ap.add_argument('--json', default=None)                  # write results here ('-' = stdout)
+    ap.add_argument('--verbose', action='store_true')        # show the server's own output
+    args = ap.parse_args(argv)
+
+    info = host_info(args.script)
+    results = []
+    if args.json != '-':
+        print(f"[Bench] {info['script']} @ {info['commit']} on {info['host']} ({info['cpus']} CPUs), "
+              f"{args.cars} car(s), loop-mode {args.loop_mode}, {args.duration:g} s per configuration")
+    tag = 0
+    for spec in args.io:
+        args.io_spec = spec
+        if args.json != '-':
+            print(f"\n[Bench] I/O latency {spec}")
+            print(f"{'rate':>7} {'cli':>4} {'achieved':>9} {'overr':>6} {'missed':>6} "
+                  f"{'jit p50':>8} {'jit p99':>8} {'p99.9':>8} {'max per':>9} {'io us':>7} {'cpu%':>6}")
+        for n in args.clients:
+            for rate in args.rates:
+                tag += 1
+                r = bench(args.script, rate, n, args, tag)
+                results.append(r)
+                if args.json != '-': print_row(r)
+
+    summary = {}
+    for spec in args.io:
+        for n in args.clients:
+            ok = [r['rate_hz'] for r in results if r['io'] == spec and r['clients'] == n and r['kept_up']]
+            summary.setdefault(spec, {})[str(n)] = max(ok) if ok else None
+    if args.json != '-':
+        print()
+        for spec, per in summary.items():
+            for n, hz in per.items():
+                print(f"[Bench] {spec}, {n} clients: max sustained rate "
+                      f"{'none of those tried' if hz is None else f'{hz:g} Hz'}")
+
+    doc = {'host': info, 'config': {k: v for k, v in vars(args).items() if k not in ('json', 'io_spec', 'verbose')},
+           'results': results, 'max_sustained_hz': summary}
+    if args.json == '-': json.dump(doc, sys.stdout, indent=1); print()
+    elif args.json:
+        with open(args.json, 'w') as f: json.dump(doc, f, indent=1)
+        print(f"[Bench] results written to {args.json}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+# touchdrive/bench_tick.py
+# Microbenchmark for the per-tick control math: the original NumPy-scalar
+# implementation vs touchdrive.control. Both are fed the same random message
+# stream; every tick's throttle/steering/LEDs/battery must match exactly
+# before any timing is reported. It then checks that filtering is rate
+# independent: the same stick step run at 50..1000 Hz with the measured dt.
+#   python -m touchdrive.bench_tick --ticks 200000
+
+import argparse, random, time
+import numpy as np
+
+from touchdrive.control import ControllerState, battery_pct, led_table, led_index
+from touchdrive.filters import CommandFilter, smooth_tau
+
+class ReferenceState:
+    # The controller as it was before touchdrive.control (kept verbatim for comparison).
+    def __init__(self):
+        self.armed = False
+        self.estop = False
+        self.left  = {'x':0.0,'y':0.0}
+        self.right = {'x':0.0,'y':0.0}
+        self.params = {'maxSpeed':0.20,'steerGain':0.50,'dead':0.06,'smooth':0.35}
+        self.throttle = 0.0
+        self.steering = 0.0
+
+    @staticmethod
+    def _deadzone(v, dz): return 0.0 if abs(v) < dz else float(np.clip(v, -1.0, 1.0))
+
+    def update_from_msg(self, msg):
+        t = msg.get('type')
+        if t == 'arm':
+            self.armed = True; self.estop = False
+        elif t == 'disarm':
+            self.armed = False; self.throttle = 0.0; self.steering = 0.0
+        elif t == 'estop':
+            self.estop = True; self.armed = False; self.throttle = 0.0; self.steering = 0.0
+        elif t == 'control':
+            self.left = msg.get('left', self.left)
+            self.right = msg.get('right', self.right)
+            self.params.update(msg.get('params', {}))
+
+    def compute(self, prev_throttle, prev_steering):
+        dz      = float(self.params['dead'])
+        smooth  = float(self.params['smooth'])
+        vmax    = float(self.params['maxSpeed'])
+        steer_k = float(self.params['steerGain'])
+        lx = self._deadzone(float(self.left.get('x',0.0)), dz)
+        ry = self._deadzone(float(self.right.get('y',0.0)), dz)
+        steering_cmd = -steer_k * lx
+        throttle_cmd =  vmax   * ry
+        alpha = np.clip(1.0 - smooth, 0.0, 1.0)
+        throttle = (1-alpha)*prev_throttle + alpha*throttle_cmd
+        steering = (1-alpha)*prev_steering + alpha*steering_cmd
+        if not self.armed or self.estop:
+            throttle = 0.0; steering = 0.0
+        throttle = float(np.clip(throttle, -vmax, vmax))
+        steering = float(np.clip(steering, -1.2, 1.2))
+        self.throttle, self.steering = throttle, steering
+        return throttle, steering
+
+def reference_tick(s, voltage):
+    throttle, steering = s.compute(s.throttle, s.steering)
+    LEDs = np.array([0,0,0,0,0,0,1,1])
+    if steering > 0.3: LEDs[0]=LEDs[2]=1
+    elif steering < -0.3: LEDs[1]=LEDs[3]=1
+    if throttle < 0: LEDs[5]=1
+    bat = float(np.clip(100 - (voltage - 10.5)*100/(12.6-10.5), 0, 100))
+    return throttle, steering, LEDs, bat
+
+def make_tick(leds):
+    def tick(s, voltage):
+        throttle, steering = s.compute(s.throttle, s.steering)
+        return throttle, steering, leds[led_index(throttle, steering)], battery_pct(voltage)
+    return tick
+
+def messages(n, seed):
+    # A control message roughly every 3rd tick, occasional ARM/DISARM/E-STOP and slider moves.
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        r = rnd.random()
+        if r < 0.01: out.append({'type': rnd.choice(['arm', 'arm', 'disarm', 'estop'])})
+        elif r < 0.35:
+            m = {'type': 'control',
+                 'left': {'x': rnd.uniform(-1.2, 1.2), 'y': rnd.uniform(-1, 1)},
+                 'right': {'x': rnd.uniform(-1, 1), 'y': rnd.uniform(-1.2, 1.2)}}
+            if rnd.random() < 0.05:
+                m['params'] = {'maxSpeed': rnd.uniform(0, 0.6), 'steerGain': rnd.uniform(0, 1),
+                               'dead': rnd.uniform(0, 0.25), 'smooth': rnd.uniform(0, 1)}
+            out.append(m)
+        else: out.append(None)
+    return out
+
+def deliver(state, m, client):
+    # As the server does: ControllerState messages go through post() (WebSocket
+    # handler) and drain() (tick); the reference applied them in the handler.
+    if m is not None:
+        if hasattr(state, 'post'): state.post(client, m)
+        else: state.update_from_msg(m)
+
+def run(state, tick, msgs, volts):
+    out, client = [], object()
+    drain = getattr(state, 'drain', None)
+    for m, v in zip(msgs, volts):
+        deliver(state, m, client)
+        if drain: drain()
+        out.append(tick(state, v))
+    return out
+
+def timed(state, tick, msgs, volts):
+    # Time the work the tick pays: for ControllerState that includes drain()
+    # applying the message post() already parsed in the handler (not timed).
+    total, client = 0, object()
+    pc = time.perf_counter_ns
+    drain = getattr(state, 'drain', None)
+    for m, v in zip(msgs, volts):
+        deliver(state, m, client)
+        t = pc()
+        if drain: drain()
+        tick(state, v); total += pc() - t
+    return total / len(msgs)
+
+def step_response(rate, smooth, slew, at_ms):
+    # Full stick (throttle and steering) from rest; outputs at the given instants.
+    s = ControllerState()
+    s.filter = CommandFilter(*slew)
+    s.update_from_msg({'type': 'arm'})
+    s.update_from_msg({'type': 'control', 'left': {'x': -1.0, 'y': 0.0}, 'right': {'x': 0.0, 'y': 1.0},
+                       'params': {'maxSpeed': 1.0, 'steerGain': 1.0, 'smooth': smooth}})
+    dt, out, tick = 1.0 / rate, [], 0
+    for ms in at_ms:
+        while tick < round(ms * rate / 1000.0):
+            s.compute(s.throttle, s.steering, dt=dt); tick += 1
+        out.append((s.throttle, s.steering))
+    return out
+
+def rate_check(rates, smooth, slew):
+    at_ms = (20, 40, 60, 100, 200, 500)   # on every rate's tick grid
+    print(f"[Bench] smooth {smooth} (tau {smooth_tau(smooth) * 1e3:.1f} ms), slew {slew[0]:g} m/s^2 / {slew[1]:g} rad/s; "
+          f"throttle at " + ", ".join(f"{ms} ms" for ms in at_ms))
+    runs = {r: step_response(r, smooth, slew, at_ms) for r in rates}
+    for r, out in runs.items():
+        print(f"[Bench] {r:6g} Hz  " + "  ".join(f"{t:.4f}" for t, _ in out))
+    spread = max(max(runs[r][i][k] for r in rates) - min(runs[r][i][k] for r in rates)
+                 for i in range(len(at_ms)) for k in (0, 1))
+    print(f"[Bench] largest difference between rates: {spread:.2e}")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Per-tick control math: NumPy scalars vs touchdrive.control.")
+    ap.add_argument('--ticks', type=int, default=100000)
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--rates', default='50,100,200,500,1000')   # rate-independence check
+    args = ap.parse_args(argv)
+
+    msgs = messages(args.ticks, args.seed)
+    rnd = random.Random(args.seed + 1)
+    volts = [rnd.uniform(10.0, 13.0) for _ in msgs]
+    fast = make_tick(led_table())
+
+    ref = run(ReferenceState(), reference_tick, msgs, volts)
+    new = run(ControllerState(), fast, msgs, volts)
+    for i, (a, b) in enumerate(zip(ref, new)):
+        if a[0] != b[0] or a[1] != b[1] or a[3] != b[3] or not np.array_equal(a[2], b[2]):
+            raise SystemExit(f"mismatch at tick {i}: reference {a} vs new {b}")
+    print(f"[Bench] outputs identical over {len(msgs)} ticks")
+
+    before = timed(ReferenceState(), reference_tick, msgs, volts)
+    after = timed(ControllerState(), fast, msgs, volts)
+    print(f"[Bench] before {before:8.0f} ns/tick  (NumPy scalars, LED array per tick)")
+    print(f"[Bench] after  {after:8.0f} ns/tick  (touchdrive.control, reused LED buffers)")
+    print(f"[Bench] speed-up x{before / after:.1f}")
+
+    rates = [float(r) for r in args.rates.split(',') if r]
+    rate_check(rates, 0.35, (0.0, 0.0))
+    rate_check(rates, 0.35, (1.0, 4.0))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# touchdrive/binlog.py
+# Compact binary drive log (--log-format binary).
+# Fixed-width little-endian records in size/time-rotated segment files that
+# NumPy can memory-map directly:
+#     seg = read_segment('manual_drive_log-20250101-120000-000.0000.qlog')   # np.memmap of LOG_DTYPE
+#     seg['speed'].mean()
+# Each run writes under its own prefix, <log>-<start time>. Convert one run back to
+# the CSV schema used by the text log (a bare --log prefix picks the newest run):
+#     python -m touchdrive.binlog manual_drive_log-20250101-120000-000 -o manual_drive_log.csv
+
+import argparse, csv, glob, os, re, struct, sys, time
+
+from touchdrive.logwriter import LogWriter, LOG_HEADER, format_ts, format_ms
+
+MAGIC = b'QCARLOG\0'
+VERSION = 4
+HEADER = struct.Struct('<8sII16x')          # magic, version, record size -> 32 bytes
+RECORD = struct.Struct('<qdffffffBBI')      # mono_ns, wall, speed, battery, throttle, steering, cmd / display latency ms, armed, estop, trajectory run
+SEGMENT_EXT = '.qlog'
+
+# NumPy view of RECORD (built lazily so the writer doesn't need NumPy).
+LOG_FIELDS = [('mono_ns','<i8'), ('wall','<f8'), ('speed','<f4'), ('battery','<f4'),
+              ('throttle','<f4'), ('steering','<f4'), ('cmd_latency_ms','<f4'), ('display_latency_ms','<f4'), ('armed','u1'), ('estop','u1'),
+              ('trajectory','<u4')]
+
+def log_dtype():
+    import numpy as np
+    dt = np.dtype(LOG_FIELDS)
+    assert dt.itemsize == RECORD.size
+    return dt
+
+def segment_prefix(path):
+    root, ext = os.path.splitext(path)
+    return root if ext in ('.csv', SEGMENT_EXT) else path
+
+def segment_path(prefix, index):
+    return f"{prefix}.{index:04d}{SEGMENT_EXT}"
+
+def _indexed(prefix):
+    # [(index, path)] of one run's segments, in index order.
+    pat = re.compile(re.escape(prefix) + r'\.(\d{4,})' + re.escape(SEGMENT_EXT) + '$')
+    found = ((pat.match(p), p) for p in glob.glob(glob.escape(prefix) + '.*' + SEGMENT_EXT))
+    return sorted((int(m.group(1)), p) for m, p in found if m)
+
+def segment_paths(prefix):
+    return [p for _, p in _indexed(prefix)]
+
+def run_prefixes(prefix):
+    # Runs logged under a --log prefix, oldest first (the suffix is the start time).
+    pat = re.compile('(' + re.escape(prefix) + r'-\d{8}-\d{6}-\d{3})\.\d{4,}' + re.escape(SEGMENT_EXT) + '$')
+    found = (pat.match(p) for p in glob.glob(glob.escape(prefix) + '-*' + SEGMENT_EXT))
+    return sorted({m.group(1) for m in found if m})
+
+class BinaryLogWriter(LogWriter):
+    # Same loop-side API as LogWriter. A new segment is started once the current
+    # one reaches segment_bytes or spans segment_sec of monotonic time (0 = no limit).
+    # Each run gets its own prefix, <log>-<start time>, so runs never share segments.
+    def __init__(self, path, segment_bytes=64 << 20, segment_sec=0.0, **kw):
+        super().__init__(path, **kw)
+        t = time.time()
+        self.prefix = f"{segment_prefix(path)}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(t))}-{int(t * 1000) % 1000:03d}"
+        self.segment_bytes = max(0, int(segment_bytes))
+        self.segment_sec = max(0.0, float(segment_sec))
+        self.segments = []
+        self._seg_size = 0
+        self._seg_t0 = None
+
+    def _open(self):
+        # Never overwrite segments from an earlier run: continue after the highest index
+        # (only a run started in the same millisecond has any), and create exclusively.
+        last = _indexed(self.prefix)
+        self._open_segment(last[-1][0] + 1 if last else 0)
+        print(f"[Log] binary log {self.prefix}.*{SEGMENT_EXT}", flush=True)
+
+    def _open_segment(self, index):
+        path = segment_path(self.prefix, index)
+        self._f = open(path, 'xb')
+        self._f.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+        self.segments.append(path)
+        self._seg_index = index
+        self._seg_size = 0
+        self._seg_t0 = None
+
+    def _rotate(self):
+        self._flush(True)
+        self._f.close()
+        self._open_segment(self._seg_index + 1)
+
+    def _write_batch(self, rows):
+        if self._seg_size and (
+                (self.segment_bytes and self._seg_size + len(rows)*RECORD.size > self.segment_bytes) or
+                (self.segment_sec and (rows[-1][0] - self._seg_t0) * 1e-9 >= self.segment_sec)):
+            self._rotate()
+        if self._seg_t0 is None: self._seg_t0 = rows[0][0]
+        pack = RECORD.pack
+        # loop rows keep the CSV column order: (..., steering, armed, estop, cmd_latency_ms, display_latency_ms, run)
+        self._f.write(b''.join([pack(*r[:6], r[8], r[9], r[6], r[7], r[10]) for r in rows]))
+        self._seg_size += len(rows) * RECORD.size
+
+def read_segment(path):
+    import numpy as np
+    with open(path, 'rb') as f:
+        magic, version, size = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+        raise ValueError(f"{path}: not a v{VERSION} QCar binary log")
+    n = (os.path.getsize(path) - HEADER.size) // RECORD.size   # ignore a torn trailing record
+    if n == 0: return np.zeros(0, dtype=log_dtype())
+    return np.memmap(path, dtype=log_dtype(), mode='r', offset=HEADER.size, shape=(n,))
+
+def iter_records(path):
+    # Pure-Python reader (no NumPy), used by the CSV exporter.
+    with open(path, 'rb') as f:
+        magic, version, size = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError(f"{path}: not a v{VERSION} QCar binary log")
+        while True:
+            chunk = f.read(RECORD.size * 4096)
+            n = len(chunk) // RECORD.size
+            if n == 0: return
+            yield from RECORD.iter_unpack(chunk[:n*RECORD.size])
+
+def export_csv(paths, out):
+    w = csv.writer(out)
+    w.writerow(LOG_HEADER)
+    n = 0
+    for p in paths:
+        for _, wall, speed, bat, thr, ste, lat, disp, armed, estop, run in iter_records(p):
+            # float32 columns: 7 significant digits is all the precision they carry
+            w.writerow([format_ts(wall), f'{speed:.7g}', f'{bat:.7g}', f'{thr:.7g}', f'{ste:.7g}', armed, estop, format_ms(lat), format_ms(disp), run or ''])
+            n += 1
+    return n
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Convert QCar binary log segments to CSV.")
+    ap.add_argument('segments', nargs='+', help="segment files or a log prefix (e.g. manual_drive_log)")
+    ap.add_argument('-o', '--out', default='-', help="output CSV path (default stdout)")
+    args = ap.parse_args(argv)
+
+    paths = []
+    for s in args.segments:
+        if os.path.isfile(s): paths.append(s); continue
+        prefix = segment_prefix(s)
+        found = segment_paths(prefix)
+        if not found:   # a --log prefix: the newest run under it, never several joined
+            runs = run_prefixes(prefix)
+            if runs:
+                found = segment_paths(runs[-1])
+                if len(runs) > 1: print(f"[Log] {len(runs)} runs under {prefix}, converting the newest: {runs[-1]}", file=sys.stderr)
+        paths += found
+    if not paths: ap.error("no segments found")
+
+    if args.out == '-':
+        n = export_csv(paths, sys.stdout)
+    else:
+        with open(args.out, 'w', newline='') as f: n = export_csv(paths, f)
+    print(f"[Log] {n} rows from {len(paths)} segment(s).", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# touchdrive/bus.py
+# Shared-memory telemetry bus for local consumers (perception, recorders, plots).
+# The control loop appends one fixed-width record per tick to a ring buffer in
+# /dev/shm; readers map the same memory as a NumPy structured array, so any
+# number of them can look at the last N ticks without copying and without the
+# loop doing anything per reader.
+#     from touchdrive.bus import BusReader
+#     bus = BusReader('qcar-bus-8000-0')
+#     v = bus.latest(200)                 # view, newest last
+#     v['speed'].mean(), v['throttle'][-1]
+#     python -m touchdrive.bus qcar-bus-8000-0          # tail it from a shell
+#
+# The ring is mirrored: record k is written to slot k % capacity and again to
+# slot k % capacity + capacity, so every window of up to `capacity` recent
+# records is one contiguous slice. A view stays valid until the writer laps it;
+# check with intact() before trusting a view you held on to, or use copy().
+# Each record ends in a CRC32 of the rest: on a weakly ordered CPU (aarch64) a
+# reader may see the head bump before the record's own stores, so copy() only
+# returns records that pass it and carry consecutive ticks.
+
+import argparse, os, struct, sys, time, zlib
+
+from touchdrive import shm
+
+MAGIC = b'QCARBUS\0'
+VERSION = 2
+HEADER = struct.Struct('<8sIIQdqQ16x')   # magic, version, record size, capacity, loop rate, writer pid, head -> 64 bytes
+RATE_OFFSET = 24                        # loop rate (Hz), rewritten when it changes at runtime
+HEAD_OFFSET = 40                        # head = records written so far; bumped after each record
+_HEAD = struct.Struct('<Q')
+_RATE = struct.Struct('<d')
+RECORD = struct.Struct('<Qq6dq2B2xI')       # tick, mono_ns, wall, speed, battery, throttle, steering, cmd_latency_ms, late_ns, armed, estop, crc
+_BODY = struct.Struct(RECORD.format[:-1])   # everything the CRC covers
+_CRC = struct.Struct('<I')
+
+# NumPy view of RECORD (built lazily so the writer doesn't need NumPy).
+BUS_FIELDS = [('tick','<u8'), ('mono_ns','<i8'), ('wall','<f8'), ('speed','<f8'), ('battery','<f8'),
+              ('throttle','<f8'), ('steering','<f8'), ('cmd_latency_ms','<f8'), ('late_ns','<i8'),
+              ('armed','u1'), ('estop','u1'), ('_pad','V2'), ('crc','<u4')]
+
+def bus_dtype():
+    import numpy as np
+    dt = np.dtype(BUS_FIELDS)
+    assert dt.itemsize == RECORD.size
+    return dt
+
+def bus_name(prefix, car_id):
+    return f"{prefix}-{car_id}"
+
+# ---- writer (control loop) ----
+class TelemetryBus:
+    def __init__(self, name, capacity=4096, rate=0.0):
+        self.name = name
+        self.capacity = max(2, int(capacity))
+        self._shm = shm.create(name, HEADER.size + 2 * self.capacity * RECORD.size)
+        self._buf = self._shm.buf
+        self.head = 0
+        self._mirror = self.capacity * RECORD.size
+        HEADER.pack_into(self._buf, 0, MAGIC, VERSION, RECORD.size, self.capacity, float(rate), os.getpid(), 0)
+
+    def publish(self, mono_ns, wall, speed, battery, throttle, steering, cmd_latency_ms, late_ns, armed, estop):
+        # Two 80-byte stores (slot and its mirror) and a counter bump, ~2 us per tick.
+        k, buf = self.head, self._buf
+        off = HEADER.size + (k % self.capacity) * RECORD.size
+        body = _BODY.pack(k, mono_ns, wall, speed, battery, throttle, steering, cmd_latency_ms, late_ns, armed, estop)
+        rec = body + _CRC.pack(zlib.crc32(body))
+        m = off + self._mirror
+        buf[off:off + RECORD.size] = rec
+        buf[m:m + RECORD.size] = rec
+        self.head = k + 1
+        _HEAD.pack_into(buf, HEAD_OFFSET, self.head)
+
+    def set_rate(self, rate):
+        _RATE.pack_into(self._buf, RATE_OFFSET, float(rate))
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        try: self._shm.unlink()
+        except FileNotFoundError: pass
+
+def open_bus(name, capacity, rate):
+    # None when disabled (capacity 0) or when /dev/shm isn't usable; the loop just skips it.
+    if not name or capacity <= 0: return None
+    try: bus = TelemetryBus(name, capacity, rate)
+    except OSError as e:
+        print(f"[Bus] {name}: shared memory unavailable ({e}), bus disabled.")
+        return None
+    print(f"[Bus] {name}: last {bus.capacity} ticks in shared memory (python -m touchdrive.bus {name})")
+    return bus
+
+# ---- reader ----
+class BusReader:
+    def __init__(self, name):
+        import numpy as np
+        self.name = name
+        self._shm = shm.attach(name)
+        magic, version, rec_size, self.capacity, _, self.pid, _ = HEADER.unpack_from(self._shm.buf, 0)
+        if magic != MAGIC: raise ValueError(f"{name}: not a TouchDrive telemetry bus")
+        if version != VERSION or rec_size != RECORD.size:
+            raise ValueError(f"{name}: unsupported bus version {version} (expected {VERSION})")
+        self._head = np.ndarray((), '<u8', self._shm.buf, HEAD_OFFSET)
+        self.records = np.ndarray((2 * self.capacity,), bus_dtype(), self._shm.buf, HEADER.size)
+
+    @property
+    def rate(self):
+        # Loop rate (Hz) the writer runs at right now; it can change at runtime.
+        return _RATE.unpack_from(self._shm.buf, RATE_OFFSET)[0]
+
+    @property
+    def head(self):
+        # Ticks published so far; the newest record has tick == head - 1.
+        return int(self._head)
+
+    def latest(self, n=1):
+        # Zero-copy view of the newest min(n, available) records, oldest first.
+        h = self.head
+        n = min(int(n), h, self.capacity - 1)   # leave the slot being rewritten out
+        start = (h - n) % self.capacity
+        return self.records[start:start + n]
+
+    def since(self, tick):
+        # Zero-copy view of records with tick >= `tick` (as many as are still in the ring).
+        return self.latest(self.head - int(tick))
+
+    def intact(self, first_tick):
+        # True while the writer hasn't started overwriting first_tick (read it from
+        # view['tick'][0] right after taking the view).
+        return self.head - int(first_tick) < self.capacity
+
+    @staticmethod
+    def verify(records):
+        # True if every record passes its CRC and the ticks are consecutive.
+        import numpy as np
+        if not len(records): return True
+        if not (records['tick'] == records['tick'][0] + np.arange(len(records), dtype='<u8')).all(): return False
+        raw, n = records.tobytes(), _BODY.size
+        return all(zlib.crc32(raw[i:i + n]) == c for i, c in zip(range(0, len(raw), RECORD.size), records['crc'].tolist()))
+
+    def copy(self, n=1, retries=8):
+        # Consistent private copy of the newest n records (n well below capacity).
+        for _ in range(retries):
+            v = self.latest(n)
+            if not len(v): return v.copy()
+            first = int(v['tick'][0])
+            out = v.copy()
+            if self.intact(first) and int(out['tick'][0]) == first and self.verify(out): return out
+        raise RuntimeError(f"{self.name}: reader kept being lapped by the writer")
+
+    def wait(self, tick, timeout=None, poll=0.001):
+        # Blocks (polling) until `tick` has been published; returns False on timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.head <= tick:
+            if deadline is not None and time.monotonic() > deadline: return False
+            time.sleep(poll)
+        return True
+
+    def close(self):
+        # Views from latest()/since() must be gone before the mapping can close.
+        self._head = self.records = None
+        self._shm.close()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Tail a TouchDrive telemetry bus.")
+    ap.add_argument('name')                                 # e.g. qcar-bus-8000-0
+    ap.add_argument('--every', type=float, default=0.5)     # s between lines
+    ap.add_argument('--window', type=int, default=0)        # ticks averaged per line (0 = one interval)
+    args = ap.parse_args(argv)
+    bus = BusReader(args.name)
+    print(f"[Bus] {args.name}: {bus.capacity} records, {bus.rate:g} Hz loop, writer pid {bus.pid}", file=sys.stderr)
+    last = bus.head
+    try:
+        while True:
+            time.sleep(args.every)
+            h = bus.head
+            v = bus.latest(args.window or max(1, h - last))
+            last = h
+            if not len(v): continue
+            print(f"tick {int(v['tick'][-1])}  speed {v['speed'].mean():+.3f}  thr {v['throttle'][-1]:+.3f}  "
+                  f"ste {v['steering'][-1]:+.3f}  bat {v['battery'][-1]:.1f}%  armed {int(v['armed'][-1])}  "
+                  f"late max {v['late_ns'].max() / 1e3:.0f} us", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        v = None
+        bus.close()
+
+if __name__ == '__main__':
+    main()
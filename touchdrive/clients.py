@@ -0,0 +1,80 @@
+# touchdrive/clients.py
+# Per-client WebSocket writers.
+# The broadcaster only offer()s a payload (non-blocking); each client has its
+# own writer task and a tiny latest-wins queue, so one phone on a bad link can
+# only delay (and lose frames for) itself. A client whose queue stays
+# backlogged longer than evict_after seconds is disconnected.
+
+import asyncio, itertools, time
+from collections import deque
+
+CLOSE_TRY_AGAIN_LATER = 1013   # WebSocket close code for "overloaded, reconnect later"
+
+_ids = itertools.count(1)
+
+class ClientWriter:
+    def __init__(self, ws, peer='?', depth=2, evict_after=2.0, on_error=None, on_evict=None, binary=False):
+        self.ws = ws
+        self.binary = binary          # negotiated touchdrive.protocol frames instead of JSON
+        self.name = f"{peer}#{next(_ids)}"
+        self.depth = max(1, int(depth))
+        self.evict_after = float(evict_after)
+        self._on_error = on_error
+        self._on_evict = on_evict
+        self._q = deque()
+        self._event = asyncio.Event()
+        self._backlog_since = None    # monotonic s; set while the writer isn't keeping up
+        self.sent = 0
+        self.dropped = 0
+        self.lag = 0.0                # s between enqueue and send completion, last frame
+        self.evicted = False
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self._run())
+        return self
+
+    def stop(self):
+        if self.task: self.task.cancel()
+
+    def offer(self, payload):
+        if self.evicted: return
+        now = time.monotonic()
+        if self._q:
+            # The previous frame is still waiting: this client is behind.
+            if self._backlog_since is None: self._backlog_since = now
+            elif now - self._backlog_since > self.evict_after:
+                return self._evict()
+            if len(self._q) >= self.depth:
+                self._q.popleft(); self.dropped += 1
+        self._q.append((now, payload))
+        self._event.set()
+
+    def backlog(self, now=None):
+        # Seconds this client has been continuously behind (0 if keeping up).
+        if self._backlog_since is None: return 0.0
+        return (time.monotonic() if now is None else now) - self._backlog_since
+
+    def _evict(self):
+        self.evicted = True
+        self._q.clear()
+        self.stop()
+        if self._on_evict: self._on_evict(self)
+        asyncio.ensure_future(self.ws.close(code=CLOSE_TRY_AGAIN_LATER, message=b'slow consumer'))
+
+    async def _run(self):
+        ws, q = self.ws, self._q
+        while not ws.closed:
+            await self._event.wait()
+            self._event.clear()
+            while q:
+                t, payload = q.popleft()
+                try:
+                    if isinstance(payload, bytes): await ws.send_bytes(payload)
+                    else: await ws.send_str(payload)
+                except Exception:
+                    if self._on_error: self._on_error()
+                    return
+                self.sent += 1
+                self.lag = time.monotonic() - t
+            self._backlog_since = None
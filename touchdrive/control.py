@@ -0,0 +1,183 @@
+# touchdrive/control.py
+# Phone command state and the per-tick control math, shared by both drive scripts.
+# The hot path is allocation-free: parameters are validated and converted to
+# floats when a message arrives, stick -> command mapping is done at that
+# point too, and compute() is a handful of float operations on an immutable
+# snapshot. See touchdrive/bench_tick.py for the before/after numbers.
+
+import math, threading
+from typing import Dict, Any
+
+from touchdrive.filters import CommandFilter
+
+# name on the wire -> (attribute, min, max)
+PARAMS = {
+    'maxSpeed':  ('max_speed', 0.0, 3.0),    # m/s cap
+    'steerGain': ('steer_gain', 0.0, 2.0),   # rad scaling
+    'dead':      ('dead', 0.0, 1.0),         # stick deadzone
+    'smooth':    ('smooth', 0.0, 1.0),       # EMA smoothing (0 = none)
+}
+
+STEER_LIMIT = 1.2   # rad
+
+def _deadzone(v, dz):
+    if abs(v) < dz: return 0.0
+    return 1.0 if v > 1.0 else (-1.0 if v < -1.0 else v)
+
+def _stick(v, name):
+    # {"x": .., "y": ..} -> (x, y) floats; None when the frame doesn't carry that stick.
+    if v is None: return None
+    if not isinstance(v, dict): raise ValueError(f"{name} must be an object")
+    x, y = float(v.get('x', 0.0)), float(v.get('y', 0.0))
+    if not (math.isfinite(x) and math.isfinite(y)): raise ValueError(f"{name}=({x}, {y})")
+    return x, y
+
+def _parse_control(msg):
+    # Control frame -> (left, right, [(attr, value), ...]), converted and range-checked.
+    # Raises ValueError / TypeError for anything malformed.
+    params = msg.get('params') or {}
+    if not isinstance(params, dict): raise ValueError("params must be an object")
+    out = []
+    for k, v in params.items():
+        spec = PARAMS.get(k)
+        if spec is None: continue
+        v = float(v)
+        if not math.isfinite(v): raise ValueError(f"{k}={v}")
+        attr, lo, hi = spec
+        out.append((attr, lo if v < lo else (hi if v > hi else v)))
+    return _stick(msg.get('left'), 'left'), _stick(msg.get('right'), 'right'), out
+
+def battery_pct(voltage):
+    pct = 100 - (voltage - 10.5)*100/(12.6-10.5)
+    return 0.0 if pct < 0 else (100.0 if pct > 100 else float(pct))
+
+def led_table():
+    # The six LED patterns the loop can show, preallocated once and reused every
+    # tick: index = 2*turn + reverse, turn 0 = straight, 1 = left, 2 = right.
+    import numpy as np
+    table = []
+    for turn in range(3):
+        for reverse in range(2):
+            leds = np.array([0,0,0,0,0,0,1,1])
+            if turn == 1: leds[0] = leds[2] = 1
+            elif turn == 2: leds[1] = leds[3] = 1
+            if reverse: leds[5] = 1
+            table.append(leds)
+    return tuple(table)
+
+def led_index(throttle, steering):
+    turn = 1 if steering > 0.3 else (2 if steering < -0.3 else 0)
+    return 2*turn + (1 if throttle < 0 else 0)
+
+class ControllerState:
+    __slots__ = ('armed', 'estop', 'lx', 'ly', 'rx', 'ry', 'max_speed', 'steer_gain', 'dead', 'smooth',
+                 'throttle', 'steering', 'cmd', 'filter', 'coalesced', 'stale', '_mail', '_taken', '_posts', '_lock')
+
+    def __init__(self):
+        self.armed = False
+        self.estop = False
+        self.lx = self.ly = 0.0    # left stick: steering on X
+        self.rx = self.ry = 0.0    # right stick: throttle on Y
+        self.max_speed, self.steer_gain, self.dead, self.smooth = 0.20, 0.50, 0.06, 0.35
+        self.throttle = 0.0
+        self.steering = 0.0
+        self.filter = CommandFilter()   # low-pass + slew limit + clamp, see touchdrive/filters.py
+        self.coalesced = 0   # control messages replaced in a mailbox before the loop used them
+        self.stale = 0       # control messages dropped for an old / out-of-order seq
+        self._mail = {}      # client -> (post_id, seq, msg): newest control message
+        self._taken = {}     # client -> post_id last applied by the loop
+        self._posts = 0
+        self._lock = threading.Lock()   # handlers and a control thread may both update
+        self._publish()
+
+    @property
+    def params(self):
+        return {k: getattr(self, a) for k, (a, _, _) in PARAMS.items()}
+
+    def update_from_msg(self, msg: Dict[str, Any]):
+        t = msg.get('type')
+        # Validate everything before touching state, so a bad message changes nothing.
+        self._apply(t, _parse_control(msg) if t == 'control' else None)
+
+    def _apply(self, t, parsed):
+        # parsed: _parse_control() output for 'control' frames; nothing in here can raise.
+        with self._lock:
+            if t == 'arm':
+                self.armed = True; self.estop = False
+            elif t == 'disarm':
+                self.armed = False; self.throttle = 0.0; self.steering = 0.0
+            elif t == 'estop':
+                self.estop = True; self.armed = False; self.throttle = 0.0; self.steering = 0.0
+            elif t == 'control':
+                left, right, params = parsed
+                if left is not None: self.lx, self.ly = left
+                if right is not None: self.rx, self.ry = right
+                for attr, v in params: setattr(self, attr, v)
+            self._publish()
+
+    def post(self, client, msg: Dict[str, Any]):
+        # Inbound message from one client. Stick updates only replace that client's
+        # mailbox entry (the loop applies the newest one per tick); ARM/DISARM/E-STOP
+        # and parameter-only frames apply immediately and are never coalesced.
+        # Everything is converted and checked here, in the handler: a malformed
+        # frame raises to the caller and never reaches the control tick.
+        if msg.get('type') != 'control' or ('left' not in msg and 'right' not in msg):
+            return self.update_from_msg(msg)
+        parsed = _parse_control(msg)
+        seq, ts = msg.get('seq'), msg.get('ts')
+        if seq is not None: seq = int(seq)
+        if ts is not None:
+            ts = float(ts)
+            if not math.isfinite(ts): ts = None   # unknown touch time rather than a NaN latency
+        prev = self._mail.get(client)
+        if prev is not None:
+            if seq is not None and prev[1] is not None and seq <= prev[1]:
+                self.stale += 1; return
+            if self._taken.get(client) != prev[0]: self.coalesced += 1
+        self._posts += 1
+        # The loop reads seq / ts from the applied message: hand it the typed values.
+        self._mail[client] = (self._posts, seq, dict(msg, seq=seq, ts=ts), parsed)
+
+    def drain(self):
+        # Control loop, once per tick: apply each client's newest unapplied message.
+        # Returns [(client, msg), ...] applied this tick (an empty tuple most ticks).
+        applied = ()
+        for client, (pid, _, msg, parsed) in list(self._mail.items()):
+            if self._taken.get(client) != pid:
+                self._taken[client] = pid
+                self._apply('control', parsed)
+                applied += ((client, msg),)
+        return applied
+
+    def forget(self, client):
+        self._mail.pop(client, None); self._taken.pop(client, None)
+
+    def _publish(self):
+        # Everything compute() needs, precomputed from the latest inputs and swapped
+        # in with one reference assignment, so a control thread never sees a
+        # half-applied message and the tick does no parsing or validation.
+        vmax = self.max_speed
+        steering_cmd = -self.steer_gain * _deadzone(self.lx, self.dead)   # invert so right = right turn
+        throttle_cmd = vmax * _deadzone(self.ry, self.dead)               # m/s
+        alpha = 1.0 - self.smooth                                         # EMA weight per tick at filters.REF_RATE
+        self.cmd = (self.armed and not self.estop, throttle_cmd, steering_cmd, alpha, 1 - alpha, vmax)
+
+    def compute(self, prev_throttle, prev_steering, est=None, dt=None, smooth=True):
+        # est: (throttle_cmd, steering_cmd) from touchdrive.estimator or a trajectory run,
+        # used instead of the latest stick values (the safety gate below still comes from self.cmd).
+        # dt: measured seconds since the previous tick (None = one tick at filters.REF_RATE).
+        # smooth=False skips the Smoothing low-pass; slew limits and clamps still apply.
+        active, throttle_cmd, steering_cmd, alpha, beta, vmax = self.cmd
+
+        # Safety
+        if not active:
+            self.throttle = self.steering = 0.0
+            return 0.0, 0.0
+        if est is not None: throttle_cmd, steering_cmd = est
+        if not smooth: alpha, beta = 1.0, 0.0
+
+        # Smoothing, slew limit, clamp
+        throttle, steering = self.filter.step(prev_throttle, prev_steering, throttle_cmd, steering_cmd,
+                                              alpha, beta, vmax, STEER_LIMIT, dt)
+        self.throttle, self.steering = throttle, steering
+        return throttle, steering
@@ -0,0 +1,422 @@
+# touchdrive/ctlproc.py
+# Control loop in its own process (--loop-mode process).
+# The web process (aiohttp, JSON, WebSocket writers) and the control process
+# (scheduler, compute, QCar I/O, log) share two SeqlockSlots instead of a
+# pipe or socket:
+#   <name>.cmd   web -> control   latest command snapshot + web heartbeat
+#   <name>.tele  control -> web   latest tick's telemetry + loop stats + control heartbeat
+# Neither side ever waits for the other. The control process owns the
+# segments and starts in its own session, so it outlives a web process that
+# crashes or restarts. A restarted web process attaches to it again.
+#
+# Trajectory uploads (touchdrive.trajectory) are written to a file in a private
+# directory the web process creates (--spec-dir); the cmd slot only carries
+# load / start / abort counters, and the control process plays the run in its own tick.
+#
+# Failsafe: when the web heartbeat is older than --failsafe-ms, the control
+# process keeps ticking with zero throttle/steering and latches there
+# until the next ARM. With no web process for --orphan-sec it stops the car
+# and exits.
+#   python -m touchdrive.ctlproc --shm qcar-td-8000-0 --backend sim --rate 200    # normally spawned by the server
+
+import argparse, asyncio, gc, json, math, os, signal, subprocess, sys, threading, time
+from collections import deque
+
+from touchdrive import shm
+from touchdrive.backends import open_backend
+from touchdrive.bus import open_bus
+from touchdrive.control import ControllerState, battery_pct, led_table, led_index
+from touchdrive.estimator import open_estimator
+from touchdrive.filters import CommandFilter, TickClock
+from touchdrive.logwriter import open_log
+from touchdrive.ratetune import LoopRate, retime
+from touchdrive.rtloop import GIL_SWITCH_INTERVAL, set_thread_priority
+from touchdrive.scheduler import DeadlineScheduler
+from touchdrive.trajectory import (TrajectoryRunner, LOAD, START, ABORT, read_spec, write_spec, spec_dir, spec_path, private_dir,
+                                   remove_specs)
+
+CMD_SUFFIX, TELE_SUFFIX = '.cmd', '.tele'
+# active, armed, estop, stop, arm count, cmd seq, rate request seq, throttle_cmd, steering_cmd, alpha,
+# beta, vmax, touch time (server-clock epoch ms, NaN = unknown), rate request (ratetune setting),
+# web heartbeat (monotonic ns), trajectory load / start / abort seq, display latency ms (newest phone
+# report, LatencyMonitor.displayed), its seq
+CMD_FMT = '<4B3I7dq3IdI'
+# tick, t_act, battery %, speed, throttle, steering, armed, estop, failsafe, auto rate, latency seq,
+# latency ms, ticks, overruns, missed, last/max/total late ns, rate, log rows dropped, control heartbeat, pid,
+# trajectory run, state, abort reason, sample time, trajectory upload dir (--spec-dir, for a web process that attaches)
+TELE_FMT = '<q5d4BId6qdqqqIBBd256s'
+SAFE_CMD = (False, 0.0, 0.0, 1.0, 0.0, 0.0)   # ControllerState.cmd for "not active"
+ALIVE_NS = 1_000_000_000                      # control heartbeat younger than this = running
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))   # dir holding the touchdrive package
+
+def slot_names(name):
+    return name + CMD_SUFFIX, name + TELE_SUFFIX
+
+# ---- control process ----
+def run(args):
+    tag = args.tag
+    sample_time = 1.0 / args.rate
+    car = open_backend(args.backend, sample_time, read_mode=args.readmode, sim_speed=args.sim_speed)
+    log = open_log(args.log, **json.loads(args.log_opts))
+    bus = open_bus(args.bus, args.bus_size, args.rate)
+    leds = led_table()
+    cmd_name, tele_name = slot_names(args.shm)
+    cmd = shm.SeqlockSlot(cmd_name, CMD_FMT, owner=True)
+    cmd.write(0, 0, 0, 0, 0, 0, 0, 0.0, 0.0, 1.0, 0.0, 0.0, math.nan, 0.0, 0, 0, 0, 0, math.nan, 0)   # no web process yet
+    tele = shm.SeqlockSlot(tele_name, TELE_FMT, owner=True)
+    state = ControllerState()
+    state.filter = CommandFilter(args.slew_throttle, args.slew_steer)
+    time_scale = getattr(car, 'time_scale', 1.0)
+    clock = TickClock(sample_time, time_scale)
+    loop_rate = LoopRate(args.rate, time_scale, args.auto_rate, json.loads(args.tuner_opts), tag)
+    estimator = open_estimator(**json.loads(args.estimator_opts))
+    trajectory = TrajectoryRunner(tag)
+    spec_dir_b = os.fsencode(args.spec_dir)
+    if len(spec_dir_b) > 256 or not private_dir(args.spec_dir):
+        if args.spec_dir: print(f"{tag} {args.spec_dir} is not a private directory: trajectory uploads disabled", flush=True)
+        args.spec_dir, spec_dir_b = '', b''
+    loader = SpecLoader(trajectory, args.spec_dir)
+    sched = DeadlineScheduler(args.rate * getattr(car, 'time_scale', 1.0), **json.loads(args.sched_opts))
+    sched.start(args.start_ns or None)
+    failsafe_ns, orphan_ns = int(args.failsafe_ms * 1e6), int(args.orphan_sec * 1e9)
+
+    stopping = []
+    for sig in (signal.SIGTERM, signal.SIGINT): signal.signal(sig, lambda *_: stopping.append(1))
+    prio = set_thread_priority(args.rt_priority)
+    # The log writer and upload parser threads must not hold the GIL across a deadline.
+    sys.setswitchinterval(GIL_SWITCH_INTERVAL)
+    # Everything allocated so far lives forever; keep the collector from rescanning it every tick.
+    gc.collect(); gc.freeze()
+    print(f"{tag} control process {os.getpid()} at {args.rate} Hz ({prio}), shm {args.shm}", flush=True)
+
+    failsafe, latch, applied_seq, est_seq, rate_seq = True, 0, None, None, 0
+    traj_seqs = None   # (load, start, abort) seen last; None = take the first snapshot's as-is
+    disp_seq = None    # display report seq seen last, same rule
+    seen = time.monotonic_ns()   # last web heartbeat (or start-up, before the first one)
+    lat_seq, lat_ms = 0, math.nan
+    armed = estop = False
+    arms, last = 0, None   # ARM count and snapshot from the last good read
+    pc, mono = time.perf_counter_ns, time.monotonic_ns
+    try:
+        while not stopping:
+            sched.wait()
+            t0 = pc()
+            r = cmd.read()
+            # A failed read (the web side preempted mid-write, e.g. by this SCHED_FIFO loop on
+            # one CPU) is not a silent web process: go on with the last snapshot, whose
+            # heartbeat decides freshness as usual.
+            if r is None: r = last
+            else: last = r
+            now = mono()
+            if r is not None:
+                (active, armed, estop, stop, arms, cmd_seq, req_seq, thr_c, ste_c, alpha, beta, vmax,
+                 touch_ms, rate_req, hb, *seqs, disp_ms, disp_now) = r
+                if stop: break
+                if req_seq != rate_seq: loop_rate.request(rate_req); rate_seq = req_seq
+                if seqs != traj_seqs:
+                    if traj_seqs is not None: loader.request(traj_seqs, seqs)
+                    traj_seqs = seqs
+                if hb > seen: seen = hb
+                fresh = now - hb <= failsafe_ns
+            else: fresh = False   # nothing read yet
+            if not fresh:
+                if not failsafe:
+                    failsafe, latch = True, arms   # live again only after an ARM newer than this
+                    print(f"{tag} web process silent > {args.failsafe_ms:g} ms: holding zero commands until ARM", flush=True)
+                if orphan_ns and now - seen > orphan_ns:
+                    print(f"{tag} no web process for {args.orphan_sec:g} s, stopping", flush=True)
+                    break
+            elif failsafe and arms != latch:
+                failsafe = False
+                print(f"{tag} armed by the web process, commands live", flush=True)
+            state.cmd = SAFE_CMD if failsafe else (bool(active), thr_c, ste_c, alpha, beta, vmax)
+            est = None
+            if estimator and not failsafe:
+                # touch_ms is already on the server clock; a new cmd seq is a new stick sample.
+                if r is not None and cmd_seq != est_seq: estimator.sample(now, state.cmd, touch_ms); est_seq = cmd_seq
+                est = estimator.estimate(now, state.cmd)
+
+            loader.poll()
+            scripted = trajectory.step(state.cmd[0], 1.0 / loop_rate.rate, bool(estop), failsafe)
+            if scripted is not None: est = scripted
+            throttle, steering = state.compute(state.throttle, state.steering, est, clock.step(now),
+                                               scripted is None or trajectory.traj.smooth)
+            t1 = pc()
+            car.read_write_std(throttle=throttle, steering=steering, LEDs=leds[led_index(throttle, steering)])
+            t_act = time.time()
+            t2 = pc()
+            bat_pct = battery_pct(car.batteryVoltage)
+            speed = float(car.motorTach)
+
+            cmd_latency = disp_latency = math.nan
+            if r is not None and disp_now != disp_seq:
+                if disp_seq is not None: disp_latency = disp_ms
+                disp_seq = disp_now
+            if not failsafe and r is not None and cmd_seq != applied_seq:
+                if applied_seq is not None:   # first snapshot after (re)attach isn't a new command
+                    cmd_latency = t_act * 1000.0 - touch_ms
+                    lat_seq, lat_ms = cmd_seq, cmd_latency
+                applied_seq = cmd_seq
+            armed_now = bool(armed) and not failsafe
+            now = mono()
+            log.write((now, t_act, speed, bat_pct, throttle, steering, int(armed_now), int(bool(estop)), cmd_latency,
+                       disp_latency, trajectory.tagged))
+            if bus: bus.publish(now, t_act, speed, bat_pct, throttle, steering, cmd_latency, sched.last_late_ns, armed_now, bool(estop))
+            tele.write(sched.ticks, t_act, bat_pct, speed, throttle, steering, armed_now, bool(estop), failsafe,
+                       loop_rate.auto, lat_seq, lat_ms, sched.ticks, sched.overruns, sched.missed, sched.last_late_ns,
+                       sched.max_late_ns, sched.total_late_ns, sched.rate, log.dropped, mono(), os.getpid(),
+                       trajectory.run, trajectory.state, trajectory.reason, trajectory.t, spec_dir_b)
+            t3 = pc()
+            if loop_rate.tick(sched, t3, t3 - t0, t2 - t1):
+                retime(car, 1.0 / loop_rate.rate)
+                if bus: bus.set_rate(loop_rate.rate)
+    finally:
+        car.terminate()
+        print(f"{tag} {sched.summary()}", flush=True)
+        log.close()
+        if bus: bus.close()
+        if estimator: print(f"[Input] {estimator.summary()}", flush=True)
+        if log.dropped: print(f"[Log] {args.log}: {log.dropped} rows dropped (writer queue full).", flush=True)
+        cmd.close(); tele.close()
+        remove_specs(args.spec_dir)
+
+class SpecLoader:
+    # Trajectory requests from the cmd slot counters. Parsing a large upload takes
+    # longer than a tick, so each load is read on a helper thread; the tick only hands
+    # the parsed Trajectory over, and a start queued behind a load waits for it.
+    def __init__(self, trajectory, directory):
+        self.trajectory, self.directory = trajectory, directory
+        self._queue = deque()   # [op, Trajectory, done Event or None], in request order
+
+    def request(self, old, new):
+        # Counters that moved since the last snapshot; an abort wins over a start seen in the same tick.
+        (load0, start0, abort0), (load, start, abort) = old, new
+        if load != load0 and not self.directory:
+            print(f"{self.trajectory.tag} trajectory upload ignored: no upload directory", flush=True)
+        elif load != load0:
+            job = [LOAD, None, threading.Event()]
+            threading.Thread(target=self._load, args=(job, spec_path(self.directory, load)), name='qcar-traj-load',
+                             daemon=True).start()
+            self._queue.append(job)
+        if abort != abort0:
+            self._queue = deque(j for j in self._queue if j[0] != START)
+            self.trajectory.request(ABORT)
+        elif start != start0: self._queue.append([START, None, None])
+
+    def _load(self, job, path):
+        if hasattr(os, 'sched_setscheduler'):   # threads inherit SCHED_FIFO: parse below the tick
+            try: os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+            except OSError: pass
+        try: job[1] = read_spec(path)
+        except (OSError, ValueError, TypeError) as e: print(f"{self.trajectory.tag} trajectory upload unreadable: {e}", flush=True)
+        job[2].set()
+
+    def poll(self):
+        # Control tick: pass on what is ready, in order. A failed load drops the starts behind it.
+        q = self._queue
+        while q and (q[0][2] is None or q[0][2].is_set()):
+            op, traj, _ = q.popleft()
+            if op == LOAD and traj is None:
+                while q and q[0][0] == START: q.popleft()
+            else: self.trajectory.request(op, traj)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="TouchDrive control loop process (spawned by --loop-mode process).")
+    ap.add_argument('--shm', required=True)                   # segment name prefix
+    ap.add_argument('--rate', type=float, default=50.0)
+    ap.add_argument('--backend', choices=['pal','sim'], default='pal')
+    ap.add_argument('--readmode', type=int, default=0)
+    ap.add_argument('--sim-speed', type=float, default=1.0)
+    ap.add_argument('--log', default='manual_drive_log.csv')
+    ap.add_argument('--log-opts', default='{}')               # JSON, open_log() keywords
+    ap.add_argument('--sched-opts', default='{}')             # JSON, DeadlineScheduler keywords
+    ap.add_argument('--rt-priority', type=int, default=50)
+    ap.add_argument('--failsafe-ms', type=float, default=500.0)
+    ap.add_argument('--orphan-sec', type=float, default=60.0) # 0 = wait for a web process forever
+    ap.add_argument('--bus', default=None)                    # telemetry bus name (touchdrive.bus)
+    ap.add_argument('--bus-size', type=int, default=4096)
+    ap.add_argument('--slew-throttle', type=float, default=0.0)   # m/s per s, 0 = unlimited
+    ap.add_argument('--slew-steer', type=float, default=0.0)      # rad/s, 0 = unlimited
+    ap.add_argument('--auto-rate', action='store_true')          # start auto-tuned instead of fixed at --rate
+    ap.add_argument('--tuner-opts', default='{}')                # JSON, RateTuner keywords
+    ap.add_argument('--estimator-opts', default='{}')        # JSON, open_estimator() keywords ({} = off)
+    ap.add_argument('--start-ns', type=int, default=0)      # first deadline (monotonic ns), 0 = now
+    ap.add_argument('--tag', default='[QCar]')
+    ap.add_argument('--spec-dir', default='')               # private dir for trajectory uploads ('' = none)
+    run(ap.parse_args(argv))
+
+# ---- web process side ----
+class ControlLink:
+    # Stands in for the in-process loop: post() replaces state.post(), run()
+    # feeds the telemetry broadcaster. It also quacks like the scheduler and
+    # log for LoopMetrics (ticks, overruns, missed, rate, dropped).
+    HEARTBEAT = 0.1   # s between snapshot rewrites when no commands arrive
+
+    def __init__(self, name, state, latency, proc=None, tag='[QCar]', spec_dir=None):
+        self.name, self.state, self.latency, self.proc, self.tag = name, state, latency, proc, tag
+        cmd_name, tele_name = slot_names(name)
+        self.cmd = shm.SeqlockSlot(cmd_name, CMD_FMT)
+        self.tele = shm.SeqlockSlot(tele_name, TELE_FMT)
+        if spec_dir is None:   # attached: use the running process's upload dir if it is still private to us
+            t = self.tele.read()
+            spec_dir = os.fsdecode(t[26].rstrip(b'\0')) if t else ''
+            if spec_dir and not private_dir(spec_dir): spec_dir = ''
+        self.spec_dir = spec_dir
+        prev = self.cmd.read()
+        # Counters carry on from a previous web process, so the control side sees new values.
+        self.arms, self.cmd_seq, self.rate_seq = (prev[4], prev[5], prev[6]) if prev else (0, 0, 0)
+        self.rate_req = prev[13] if prev else 0.0
+        self.traj_seqs = list(prev[15:18]) if prev else [0, 0, 0]   # load, start, abort
+        self.display_seq = prev[19] if prev else 0
+        self.display_ms = math.nan
+        self.runner = None             # TrajectoryRunner mirrored from the control process
+        self.loop_rate = None          # LoopRate mirrored from the control process
+        self.touch_ms = math.nan
+        self._who = {}                 # cmd seq -> client whose touch it carried (recent only)
+        self._pending = False          # stick frames posted since the last flush()
+        self._flushed_tick = None      # control tick seen at the last flush()
+        self._stop = False
+        self.ticks = self.overruns = self.missed = self.dropped = 0
+        self.rate = 0.0
+        self.failsafe = False
+        self.pushed_ns = 0
+
+    @staticmethod
+    def running(name):
+        # A live control process owns <name>.tele and keeps its heartbeat fresh.
+        tele_name = slot_names(name)[1]
+        if not shm.exists(tele_name): return False
+        slot = shm.SeqlockSlot(tele_name, TELE_FMT)
+        r = slot.read()
+        slot.close()
+        return r is not None and time.monotonic_ns() - r[20] < ALIVE_NS
+
+    @classmethod
+    async def open(cls, name, argv, state, latency, tag='[QCar]', timeout=15.0):
+        if cls.running(name):
+            print(f"{tag} attached to the running control process (shm {name})")
+            return cls(name, state, latency, tag=tag)
+        # New session: Ctrl+C on the server's terminal must not kill the car's loop
+        # before the web process has asked it to stop. The server may be started from any
+        # directory, so the child gets the package on its path (relative --log paths stay as given).
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (ROOT, os.environ.get('PYTHONPATH')) if p))
+        directory = spec_dir(name)   # trajectory uploads; the control process removes it on exit
+        proc = subprocess.Popen([sys.executable, '-m', 'touchdrive.ctlproc', '--shm', name, '--tag', tag,
+                                 '--spec-dir', directory] + argv, env=env, start_new_session=True)
+        deadline = time.monotonic() + timeout
+        while not cls.running(name):
+            if proc.poll() is not None:
+                remove_specs(directory)
+                raise RuntimeError(f"control process exited with {proc.returncode}")
+            if time.monotonic() > deadline:
+                proc.terminate(); remove_specs(directory)
+                raise RuntimeError("control process did not start")
+            await asyncio.sleep(0.02)
+        return cls(name, state, latency, proc, tag, directory)
+
+    def post(self, ws, msg):
+        # Stick frames go out at most once per control tick, like drain() in the in-process
+        # loops, so a newer frame supersedes an older one in the mailbox (coalesced) instead
+        # of overwriting it in the cmd slot. Anything else (ARM, E-STOP, params) goes at once.
+        self.state.post(ws, msg)
+        if msg.get('type') == 'arm': self.arms += 1
+        self._pending = True
+        r = self.tele.read()
+        tick = r[0] if r is not None else None
+        if msg.get('type') != 'control' or tick != self._flushed_tick: self.flush(tick)
+
+    def flush(self, tick):
+        # Hands the mailbox to the control process (drain + push); tick = its newest tick.
+        self._pending, self._flushed_tick = False, tick
+        applied = self.state.drain()
+        if applied:
+            who, touch = self.latency.touch_time(applied)
+            self.cmd_seq = (self.cmd_seq + 1) & 0xFFFFFFFF
+            self.touch_ms = touch
+            if who is not None:
+                self._who[self.cmd_seq] = who
+                if len(self._who) > 64: self._who.pop(next(iter(self._who)))
+        self.push()
+
+    def forget(self, ws):
+        self.state.forget(ws)
+        for k in [k for k, v in self._who.items() if v is ws]: del self._who[k]
+
+    def set_rate(self, setting):
+        # LoopRate.forward: the control process applies the request on its next tick.
+        self.rate_seq = (self.rate_seq + 1) & 0xFFFFFFFF
+        self.rate_req = setting
+        self.push()
+
+    def trajectory(self, op, traj=None):
+        # TrajectoryRunner.forward: uploads go through a file per load, the counters through the cmd slot.
+        for i, bit in enumerate((LOAD, START, ABORT)):
+            if op & bit: self.traj_seqs[i] = (self.traj_seqs[i] + 1) & 0xFFFFFFFF
+        if op & LOAD:
+            if not self.spec_dir: raise RuntimeError("control process has no trajectory upload directory")
+            write_spec(spec_path(self.spec_dir, self.traj_seqs[0]), traj)
+        self.push()
+
+    def push(self):
+        s = self.state
+        active, thr_c, ste_c, alpha, beta, vmax = s.cmd
+        self.pushed_ns = time.monotonic_ns()
+        self.cmd.write(active, s.armed, s.estop, self._stop, self.arms & 0xFFFFFFFF, self.cmd_seq, self.rate_seq,
+                       thr_c, ste_c, alpha, beta, vmax, self.touch_ms, self.rate_req, self.pushed_ns, *self.traj_seqs,
+                       self.display_ms, self.display_seq)
+
+    async def run(self, telemetry, poll_hz=100.0, history=None):
+        # history (TelemetryHistory) only sees the ticks this poll catches, at most poll_hz.
+        # Raises RuntimeError if the control process we spawned exits.
+        last_tick, last_lat, silent = None, None, False
+        period, hb_ns = 1.0 / poll_hz, int(self.HEARTBEAT * 1e9)
+        while True:
+            d = self.latency.displayed()   # phone display reports, for the control process's log
+            if d == d:
+                self.display_seq = (self.display_seq + 1) & 0xFFFFFFFF
+                self.display_ms = d
+                self.push()
+            elif time.monotonic_ns() - self.pushed_ns >= hb_ns: self.push()
+            r = self.tele.read()
+            if self._pending and r is not None and r[0] != self._flushed_tick: self.flush(r[0])
+            if r is not None and r[0] != last_tick:
+                last_tick = r[0]
+                (_, t_act, bat, speed, thr, ste, armed, estop, failsafe, auto, lat_seq, lat_ms,
+                 self.ticks, self.overruns, self.missed, _, _, _, self.rate, self.dropped, hb, _,
+                 run, traj_state, reason, traj_t, _) = r
+                self.failsafe = bool(failsafe)
+                if self.loop_rate: self.loop_rate.observed(self.rate, auto)
+                if self.runner: self.runner.observed(run, traj_state, reason, traj_t)
+                telemetry.publish((bat, speed, thr, ste, bool(armed), bool(estop), t_act))
+                if history: history.append(hb, t_act, speed, thr, ste, bat)   # hb: control tick's monotonic ns
+                if lat_seq != last_lat:
+                    if last_lat is not None and lat_ms == lat_ms:
+                        self.latency.observe(self._who.get(lat_seq), lat_ms)
+                    last_lat = lat_seq
+            if self.proc is not None and self.proc.poll() is not None:
+                raise RuntimeError(f"control process exited with {self.proc.returncode}")
+            alive = r is not None and time.monotonic_ns() - r[20] < ALIVE_NS
+            if alive == silent:
+                silent = not alive
+                print(f"{self.tag} control process {'not responding' if silent else 'responding again'}")
+            await asyncio.sleep(period)
+
+    def summary(self):
+        return f"{self.ticks} ticks in the control process, {self.overruns} overruns, {self.missed} missed deadlines"
+
+    async def close(self, timeout=5.0):
+        # Ask the control process to stop the car and exit, then wait for it.
+        self._stop = True
+        self.push()
+        deadline = time.monotonic() + timeout
+        if self.proc is not None:
+            while self.proc.poll() is None and time.monotonic() < deadline: await asyncio.sleep(0.02)
+            if self.proc.poll() is None: self.proc.terminate()
+        else:   # attached: its output goes to whoever started it
+            while self.running(self.name) and time.monotonic() < deadline: await asyncio.sleep(0.02)
+            print(f"{self.tag} control process stopped: {self.summary()}")
+        self.cmd.close(); self.tele.close()
+        if self.proc is not None: remove_specs(self.spec_dir)   # in case it died before cleaning up
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# touchdrive/estimator.py
+# Server-side stick estimation for jittery links (--estimator).
+# Over a DERP relay control messages arrive in bursts with 50-200 ms gaps, so
+# the commands the loop sees hold still and then jump. The estimator keeps the
+# newest command samples with the phone's touch timestamp (`ts`, the time the
+# stick was actually in that position) and, every tick, produces a command for
+# "now":
+#   extrapolate  newest sample + slope x age, for at most --est-horizon-ms
+#   interpolate  linear between samples, --est-delay-ms behind the newest one
+#                (smoother, adds that much latency)
+# It never extrapolates through zero (releasing a stick can't turn into a brief
+# reverse), and once the newest sample is older than --est-stale-ms the command
+# decays to zero with time constant --est-decay-ms. The page repeats held
+# sticks every 100 ms, so only a link that has really gone quiet decays.
+#
+# Every new sample also scores the prediction the estimator would have made
+# for it, next to plain hold-last-value, so the benefit on a given link can be
+# read off /metrics or the shutdown summary.
+
+import math
+from collections import deque
+
+from touchdrive.control import STEER_LIMIT
+
+MODES = ('off', 'extrapolate', 'interpolate')
+AXES = ('throttle', 'steering')
+
+class ErrorStats:
+    __slots__ = ('n', 'sum_abs', 'sum_sq', 'max')
+
+    def __init__(self):
+        self.n = 0; self.sum_abs = self.sum_sq = self.max = 0.0
+
+    def add(self, e):
+        e = abs(e)
+        self.n += 1; self.sum_abs += e; self.sum_sq += e * e
+        if e > self.max: self.max = e
+
+    @property
+    def mae(self): return self.sum_abs / self.n if self.n else 0.0
+
+    @property
+    def rms(self): return math.sqrt(self.sum_sq / self.n) if self.n else 0.0
+
+class InputEstimator:
+    def __init__(self, mode='extrapolate', horizon_ms=100.0, stale_ms=300.0, decay_ms=150.0, delay_ms=50.0):
+        if mode not in MODES[1:]: raise ValueError(f"estimator mode {mode!r}")
+        self.mode = mode
+        self.horizon_ms, self.stale_ms = float(horizon_ms), float(stale_ms)
+        self.decay_ms, self.delay_ms = max(1e-3, float(decay_ms)), float(delay_ms)
+        self._hist = deque(maxlen=16)   # (ts_ms, throttle_cmd, steering_cmd), newest last
+        self._slope = (0.0, 0.0)        # per ms, between the two newest samples
+        self._t_ns = None               # loop clock when the newest sample was applied
+        self._src = None                # whose clock the samples' ts are on
+        self.samples = self.estimated = self.decayed = 0
+        self.err = {a: ErrorStats() for a in AXES}        # estimator vs. the next real sample
+        self.hold_err = {a: ErrorStats() for a in AXES}   # hold-last-value vs. the same
+
+    # ---- samples ----
+    def step(self, now_ns, cmd, applied):
+        # Drive scripts, once per tick: applied = ControllerState.drain(),
+        # cmd = ControllerState.cmd after it. Returns (throttle_cmd, steering_cmd) or None.
+        if applied:
+            client, msg = applied[-1]
+            ts = msg.get('ts')
+            self.sample(now_ns, cmd, float(ts) if ts is not None else None, client)
+        return self.estimate(now_ns, cmd)
+
+    def sample(self, now_ns, cmd, ts_ms=None, source=None):
+        # New command snapshot. ts_ms: when the stick was in that position, on
+        # source's ms clock (a phone's, or the server's); None = the loop clock.
+        thr, ste = cmd[1], cmd[2]
+        if ts_ms is None or not math.isfinite(ts_ms): ts_ms, source = now_ns / 1e6, '_loop'
+        hist = self._hist
+        if source != self._src:
+            hist.clear(); self._slope = (0.0, 0.0)   # another phone took over: its clock, its history
+            self._src = source
+        if hist:
+            t0, thr0, ste0 = hist[-1]
+            if ts_ms < t0: ts_ms = t0   # clock step or a second client: never run time backwards
+            # Score what we would have sent for this moment against the real value.
+            p_thr, p_ste = self._at(ts_ms)
+            self.err['throttle'].add(thr - p_thr); self.err['steering'].add(ste - p_ste)
+            self.hold_err['throttle'].add(thr - thr0); self.hold_err['steering'].add(ste - ste0)
+            dt = ts_ms - t0
+            # Same touch repeated (held stick) or a burst with no spacing: stationary.
+            self._slope = ((thr - thr0) / dt, (ste - ste0) / dt) if dt >= 1.0 else (0.0, 0.0)
+        hist.append((ts_ms, thr, ste))
+        self._t_ns = now_ns
+        self.samples += 1
+
+    # ---- per tick ----
+    def _at(self, ts_ms):
+        # Estimated (throttle_cmd, steering_cmd) at ts_ms on the sample clock, before staleness decay.
+        t1, thr1, ste1 = self._hist[-1]
+        if self.mode == 'interpolate':
+            target = ts_ms - self.delay_ms
+            if target >= t1: return thr1, ste1
+            prev = None
+            for t, thr, ste in reversed(self._hist):
+                if t <= target:
+                    if prev is None: return thr, ste
+                    tn, thrn, sten = prev
+                    k = (target - t) / (tn - t) if tn > t else 1.0
+                    return thr + k * (thrn - thr), ste + k * (sten - ste)
+                prev = (t, thr, ste)
+            return prev[1], prev[2]
+        h = ts_ms - t1
+        if h <= 0.0: return thr1, ste1
+        if h > self.horizon_ms: h = self.horizon_ms
+        return _toward(thr1, self._slope[0] * h), _toward(ste1, self._slope[1] * h)
+
+    def estimate(self, now_ns, cmd):
+        if self._t_ns is None or not cmd[0]: return None
+        age = (now_ns - self._t_ns) / 1e6
+        thr, ste = self._at(self._hist[-1][0] + age)
+        if age > self.stale_ms:
+            k = math.exp(-(age - self.stale_ms) / self.decay_ms)
+            thr *= k; ste *= k
+            self.decayed += 1
+        self.estimated += 1
+        vmax = cmd[5]
+        thr = vmax if thr > vmax else (-vmax if thr < -vmax else thr)
+        ste = STEER_LIMIT if ste > STEER_LIMIT else (-STEER_LIMIT if ste < -STEER_LIMIT else ste)
+        return thr, ste
+
+    def summary(self):
+        def axis(a):
+            e, h = self.err[a], self.hold_err[a]
+            return f"{a} mae {e.mae:.4f} / rms {e.rms:.4f} / max {e.max:.3f} (hold: {h.mae:.4f} / {h.rms:.4f} / {h.max:.3f})"
+        return (f"{self.mode} over {self.samples} samples, {self.decayed} of {self.estimated} ticks decayed as stale; "
+                + "; ".join(axis(a) for a in AXES))
+
+def _toward(x, dx):
+    # x + dx, but never past zero: a stick heading home stops there.
+    y = x + dx
+    return 0.0 if (x > 0.0 and y < 0.0) or (x < 0.0 and y > 0.0) or x == 0.0 else y
+
+def open_estimator(mode='off', **opts):
+    return None if not mode or mode == 'off' else InputEstimator(mode, **opts)
@@ -0,0 +1,41 @@
+# touchdrive/fleet.py
+# Several vehicles in one server (--cars N).
+# A Car bundles what used to be module-level singletons in the drive scripts:
+# controller state, connected clients, metrics, latency monitor, telemetry
+# broadcaster and session recorder. Each car gets its own control loop, log
+# file and /car/<id>/... routes; all of them share one aiohttp listener and
+# event loop.
+
+import os
+from functools import partial
+
+from touchdrive.control import ControllerState
+from touchdrive.latency import LatencyMonitor
+from touchdrive.metrics import LoopMetrics
+from touchdrive.telemetry import TelemetryBroadcaster
+
+class Car:
+    def __init__(self, car_id, send):
+        # send(car, *telemetry, clients=...) is the script's push_telemetry.
+        self.id = str(car_id)
+        self.state = ControllerState()
+        self.clients = {}   # ws -> ClientWriter
+        self.metrics = LoopMetrics(car=self.id)
+        self.metrics.bind(clients=self.clients, state=self.state)
+        self.latency = LatencyMonitor(self.metrics)
+        self.telemetry = TelemetryBroadcaster(self.clients, partial(send, self))
+        self.metrics.bind(telemetry=self.telemetry)
+        self.recorder = None   # SessionRecorder with --record
+        self.link = None       # touchdrive.ctlproc.ControlLink with --loop-mode process
+        self.history = None    # touchdrive.history.TelemetryHistory unless --history-sec 0
+        self.rate = None       # touchdrive.ratetune.LoopRate (live rate changes, --auto-rate)
+        self.trajectory = None # touchdrive.trajectory.TrajectoryRunner (scripted runs)
+
+def car_ids(n):
+    return [str(i) for i in range(max(1, int(n)))]
+
+def car_path(path, car_id, n_cars):
+    # manual_drive_log.csv -> manual_drive_log.car3.csv when there is more than one car.
+    if not path or n_cars <= 1: return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.car{car_id}{ext}"
@@ -0,0 +1,107 @@
+# touchdrive/history.py
+# Recent telemetry kept in memory for charts.
+# The control loop appends one row per tick to fixed-capacity column rings
+# (array('d'): one store per field, nothing allocated per tick). Charts ask for
+# a time window and a point budget; the window is cut out of the ring and each
+# series is reduced with Largest-Triangle-Three-Buckets, which keeps peaks and
+# turns that plain decimation would drop:
+#     GET /history?sec=600&points=300&fields=speed,throttle      (or /car/<id>/history)
+#     {"type":"history","sec":600,"points":300,"id":1}           over /ws, answered with the same JSON
+# 10 minutes at 50 Hz is 30,000 rows; the answer is `points` per series.
+
+import math
+from array import array
+
+import numpy as np
+
+FIELDS = ('speed', 'throttle', 'steering', 'battery')
+MAX_POINTS = 2000
+
+class TelemetryHistory:
+    def __init__(self, capacity):
+        self.capacity = max(2, int(capacity))
+        self.mono = array('d', bytes(8 * self.capacity))   # monotonic time (s) of the tick: the window index
+        self.t = array('d', bytes(8 * self.capacity))      # wall time (s) of the tick's I/O, for output only
+        self.cols = {f: array('d', bytes(8 * self.capacity)) for f in FIELDS}
+        self._cols = tuple(self.cols[f] for f in FIELDS)
+        self.head = 0       # next slot
+        self.count = 0
+
+    def append(self, mono_ns, t, speed, throttle, steering, battery):
+        # Called every control tick, from the loop or the control thread (single writer).
+        # mono_ns: time.monotonic_ns() of the tick; t: wall time, which an NTP step can move.
+        i = self.head
+        self.mono[i] = mono_ns * 1e-9
+        self.t[i] = t
+        c = self._cols
+        c[0][i] = speed; c[1][i] = throttle; c[2][i] = steering; c[3][i] = battery
+        self.head = i + 1 if i + 1 < self.capacity else 0
+        if self.count < self.capacity: self.count += 1
+
+    def window(self, sec, fields=FIELDS):
+        # -> (mono, t, {field: values}) for ticks in the last `sec` seconds, oldest first.
+        # Cut on the monotonic column: wall time goes backwards or jumps after a clock step.
+        # The writer keeps going while this copies; once the ring is full the slot
+        # it writes next (the oldest row) is left out.
+        head, count = self.head, self.count
+        def ordered(col):
+            a = np.frombuffer(col, dtype=np.float64)
+            if count < self.capacity: return a[:count].copy()
+            return np.concatenate((a[head + 1:], a[:head]))
+        m, t = ordered(self.mono), ordered(self.t)
+        cols = {f: ordered(self.cols[f]) for f in fields}
+        if len(m) and sec and sec > 0:
+            start = int(np.searchsorted(m, m[-1] - sec, side='left'))
+            m, t = m[start:], t[start:]
+            cols = {f: v[start:] for f, v in cols.items()}
+        return m, t, cols
+
+    def query(self, sec=600.0, points=300, fields=FIELDS):
+        # JSON-ready chart data: per field, LTTB-reduced time offsets (s before
+        # the newest sample, on the monotonic clock) and values; t_end is the
+        # newest sample's wall time.
+        fields = [f for f in fields if f in self.cols] or list(FIELDS)
+        points = max(3, min(int(points), MAX_POINTS))
+        m, t, cols = self.window(sec, fields)
+        out = {'type': 'history', 'rows': int(len(m)), 'points': points,
+               't_end': float(t[-1]) if len(t) else None, 'series': {}}
+        for f, v in cols.items():
+            if not len(m):
+                out['series'][f] = {'t': [], 'v': []}
+                continue
+            idx = lttb(m, v, points)
+            out['series'][f] = {'t': np.round(m[idx] - m[-1], 3).tolist(), 'v': np.round(v[idx], 4).tolist()}
+        return out
+
+def lttb(x, y, n_out):
+    # Largest-Triangle-Three-Buckets (Steinarsson 2013). Returns indices into x/y:
+    # first and last point, plus one point per bucket that forms the largest
+    # triangle with the previous pick and the average of the next bucket.
+    n = len(x)
+    if n_out >= n or n_out < 3: return np.arange(n)
+    y = np.nan_to_num(y)
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(np.int64)   # n_out - 2 buckets over x[1:-1]
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for k in range(n_out - 2):
+        lo, hi = edges[k], edges[k + 1]
+        if k + 2 < n_out - 1: nlo, nhi = edges[k + 1], edges[k + 2]
+        else: nlo, nhi = n - 1, n
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        bx, by = x[lo:hi], y[lo:hi]
+        area = np.abs((x[a] - cx) * (by - y[a]) - (x[a] - bx) * (cy - y[a]))
+        a = lo + int(area.argmax())
+        idx[k + 1] = a
+    return idx
+
+def parse_query(q):
+    # HTTP query / WS message -> query() keywords. Bad values fall back to defaults.
+    def num(key, default):
+        try:
+            v = float(q.get(key, default))
+            return v if math.isfinite(v) else default
+        except (TypeError, ValueError): return default
+    fields = q.get('fields') or FIELDS
+    if isinstance(fields, str): fields = [f.strip() for f in fields.split(',')]
+    return dict(sec=num('sec', 600.0), points=int(num('points', 300)), fields=fields)
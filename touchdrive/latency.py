@@ -0,0 +1,122 @@
+# touchdrive/latency.py
+# End-to-end latency over the existing /ws socket.
+# Clock sync is NTP-style and driven by the phone: it sends
+#   {'type':'ping', 't0': Date.now()}
+# and gets back {'type':'pong', t0, t1, t2, act} (t1/t2 = server receive/send, ms).
+# It keeps the offset from the minimum-RTT sample of the last few pings and
+# reports it back with {'type':'clock', offset, rtt, display:[ms,...]}.
+# The display samples are actuation-to-display latencies measured on the phone.
+# With the offset known, the server turns each control message's touch
+# timestamp into touch-to-actuation latency at the tick that consumed it.
+# All times are epoch milliseconds; offset = server clock - phone clock.
+
+import math, time
+from collections import deque
+
+def _ms(v, what, signed=False):
+    v = float(v)
+    if not math.isfinite(v): raise ValueError(f"{what} must be finite")
+    if v < 0.0 and not signed: raise ValueError(f"{what} must be >= 0")
+    return v
+
+class LatencyStats:
+    # Rolling window of recent samples (ms) with on-demand percentiles.
+    def __init__(self, n=256):
+        self._s = deque(maxlen=n)
+
+    def add(self, ms):
+        self._s.append(ms)
+
+    def percentiles(self, *qs):
+        s = sorted(self._s)
+        if not s: return None
+        return [s[min(len(s) - 1, int(q * len(s)))] for q in qs]
+
+class ClientClock:
+    def __init__(self, name):
+        self.name = name
+        self.offset_ms = None
+        self.rtt_ms = None
+        self.actuation = LatencyStats()   # touch -> read_write_std
+        self.display = LatencyStats()     # read_write_std -> on screen
+
+class LatencyMonitor:
+    def __init__(self, metrics=None):
+        self._clients = {}   # ws -> ClientClock
+        self._m = metrics
+        self._display = math.nan   # worst display sample reported since the last displayed()
+
+    def _get(self, ws, name='?'):
+        c = self._clients.get(ws)
+        if c is None: c = self._clients[ws] = ClientClock(name)
+        return c
+
+    def pong(self, ws, msg, name='?'):
+        t1 = time.time() * 1000.0
+        c = self._get(ws, name)
+        act = c.actuation.percentiles(0.5, 0.99)
+        return {'type': 'pong', 't0': msg.get('t0'), 't1': t1, 't2': time.time() * 1000.0, 'act': act}
+
+    def report(self, ws, msg, name='?'):
+        # All values are checked before any state changes; a bad one (ValueError /
+        # TypeError) drops the whole report.
+        off, rtt = msg.get('offset'), msg.get('rtt')
+        off = None if off is None else _ms(off, 'offset', signed=True)
+        rtt = None if rtt is None else _ms(rtt, 'rtt')
+        display = [_ms(d, 'display') for d in msg.get('display') or ()]
+        c = self._get(ws, name)
+        if off is not None: c.offset_ms = off
+        if rtt is not None:
+            c.rtt_ms = rtt
+            if self._m: self._m.rtt.observe(int(rtt * 1e6))
+        for d in display:
+            c.display.add(d)
+            if self._m: self._m.display_latency.observe(int(d * 1e6))
+            if not d <= self._display: self._display = d
+
+    def displayed(self):
+        # Control tick: worst actuation-to-display latency (ms) reported by any phone
+        # since the last call, NaN if none; it goes in the log row's DisplayLatency_ms.
+        worst, self._display = self._display, math.nan
+        return worst
+
+    def actuated(self, applied, t_act):
+        # applied: [(ws, control msg), ...] consumed by the tick whose I/O ran at
+        # t_act (epoch s). Returns the worst touch-to-actuation latency in ms, or NaN.
+        worst = math.nan
+        for ws, msg in applied:
+            c = self._clients.get(ws)
+            ts = msg.get('ts')
+            if c is None or c.offset_ms is None or ts is None: continue
+            lat = t_act * 1000.0 - (float(ts) + c.offset_ms)
+            c.actuation.add(lat)
+            if self._m and lat >= 0: self._m.touch_latency.observe(int(lat * 1e6))
+            if math.isnan(worst) or lat > worst: worst = lat
+        return worst
+
+    # Split loop (--loop-mode process): the web process converts touch times to the
+    # server clock before handing commands over; the control process reports back.
+    def touch_time(self, applied):
+        # -> (client, server-clock epoch ms) of the newest touch among applied, or (None, NaN).
+        best, who = math.nan, None
+        for ws, msg in applied:
+            c = self._clients.get(ws)
+            ts = msg.get('ts')
+            if c is None or c.offset_ms is None or ts is None: continue
+            t = float(ts) + c.offset_ms
+            if who is None or t > best: best, who = t, ws
+        return who, best
+
+    def observe(self, ws, lat):
+        c = self._clients.get(ws)
+        if c is not None: c.actuation.add(lat)
+        if self._m and lat >= 0: self._m.touch_latency.observe(int(lat * 1e6))
+
+    def forget(self, ws):
+        c = self._clients.pop(ws, None)
+        if c is None or c.offset_ms is None: return None
+        def fmt(st):
+            p = st.percentiles(0.5, 0.99)
+            return f"{p[0]:.0f}/{p[1]:.0f} ms" if p else "--"
+        return (f"[Latency] {c.name}: touch->car {fmt(c.actuation)}, car->screen {fmt(c.display)} (p50/p99), "
+                f"rtt {c.rtt_ms or 0:.0f} ms")
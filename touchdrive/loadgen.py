@@ -0,0 +1,259 @@
+# touchdrive/loadgen.py
+# Headless phones: opens N WebSocket connections to /ws and sends the same
+# traffic the embedded page does (control messages with sticks + params,
+# a ping every second), while consuming telemetry.
+# Reports, per client and overall: connect/accept time, telemetry
+# inter-arrival and jitter, estimated lost frames (gaps in the stream) and
+# telemetry age; with /metrics reachable, also the server's own counters for
+# coalesced/stale control messages, dropped telemetry and evictions.
+#   python -m touchdrive.loadgen ws://127.0.0.1:8000/ws --clients 40 --drivers 2 --hz 60 --duration 20
+#
+# Patterns (--pattern): steady = every 1/hz; burst = --burst messages
+# back-to-back, same average rate; poisson = exponential gaps, mean 1/hz.
+# The car is never armed unless --arm is given.
+
+import argparse, asyncio, json, math, random, sys, time
+from urllib.parse import urlsplit, urlunsplit
+
+import aiohttp
+
+from touchdrive import protocol
+from touchdrive.bench_loop import percentiles
+
+PARAMS = {'maxSpeed': 0.20, 'steerGain': 0.50, 'dead': 0.06, 'smooth': 0.35}   # the page's slider defaults
+
+class Phone:
+    def __init__(self, idx, driver):
+        self.idx = idx
+        self.driver = driver
+        self.protocol = None
+        self.accept_ms = None
+        self.error = None
+        self.close_code = None
+        self.sent = 0
+        self.pongs = 0
+        self.arrivals = []     # perf_counter s of each telemetry frame
+        self.ages = []         # ms between server actuation (ts) and arrival; same-host clocks only
+
+    # ---- traffic ----
+    def sticks(self, t):
+        # Slow sweeps, phase-shifted per client: smooth like a thumb, not noise.
+        ph = self.idx * 0.7
+        return (0.8 * math.sin(2 * math.pi * 0.3 * t + ph), 0.0,
+                0.0, 0.6 * math.sin(2 * math.pi * 0.1 * t + ph))
+
+    def gaps(self, args, rnd):
+        if args.pattern == 'burst':
+            while True:
+                for _ in range(args.burst - 1): yield 0.0
+                yield args.burst / args.hz
+        while True:
+            yield rnd.expovariate(args.hz) if args.pattern == 'poisson' else 1.0 / args.hz
+
+    async def drive(self, ws, args, t_start):
+        binary = self.protocol == protocol.BIN_PROTO
+        rnd = random.Random(self.idx)
+        if args.arm:
+            if binary: await ws.send_bytes(protocol.encode_command('arm'))
+            else: await ws.send_str(json.dumps({'type': 'arm'}))
+        seq, params_at = 0, -1.0
+        for gap in self.gaps(args, rnd):
+            t = time.perf_counter() - t_start
+            lx, ly, rx, ry = self.sticks(t)
+            seq += 1
+            ts = time.time() * 1000
+            if binary:
+                if t - params_at >= 5.0:   # the page only sends params when a slider moves
+                    await ws.send_bytes(protocol.encode_params(*PARAMS.values())); params_at = t
+                await ws.send_bytes(protocol.encode_axes(seq, lx, ly, rx, ry, ts))
+            else:
+                await ws.send_str(json.dumps({'type': 'control', 'left': {'x': lx, 'y': ly},
+                                              'right': {'x': rx, 'y': ry}, 'params': PARAMS, 'seq': seq, 'ts': ts}))
+            self.sent += 1
+            if gap: await asyncio.sleep(gap)
+
+    async def ping(self, ws):
+        while True:
+            await ws.send_str(json.dumps({'type': 'ping', 't0': time.time() * 1000}))
+            await asyncio.sleep(1.0)
+
+    async def receive(self, ws):
+        async for msg in ws:
+            now = time.perf_counter()
+            if msg.type == aiohttp.WSMsgType.BINARY:
+                data = protocol.decode_telemetry(msg.data) if msg.data[:1] == bytes([protocol.TELEMETRY]) else None
+            elif msg.type == aiohttp.WSMsgType.TEXT:
+                data = json.loads(msg.data)
+            else: continue
+            if data is None: continue
+            if data.get('type') == 'telemetry':
+                self.arrivals.append(now)
+                self.ages.append(time.time() * 1000 - data['ts'] * 1000)
+            elif data.get('type') == 'pong': self.pongs += 1
+
+    async def run(self, session, url, args, t_start, stop):
+        protos = (protocol.BIN_PROTO, protocol.JSON_PROTO) if args.binary else (protocol.JSON_PROTO,)
+        t0 = time.perf_counter()
+        try:
+            ws = await asyncio.wait_for(session.ws_connect(url, protocols=protos, heartbeat=None), args.connect_timeout)
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"
+            return
+        self.accept_ms = (time.perf_counter() - t0) * 1000
+        self.protocol = ws.protocol
+        tasks = [asyncio.ensure_future(self.receive(ws))]
+        if not args.no_ping: tasks.append(asyncio.ensure_future(self.ping(ws)))
+        if self.driver: tasks.append(asyncio.ensure_future(self.drive(ws, args, t_start)))
+        try:
+            await asyncio.wait([stop, tasks[0]], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for t in tasks[1:]: t.cancel()
+            if not ws.closed: await ws.close()   # ends the receive loop cleanly
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.close_code = ws.close_code
+
+    # ---- stats ----
+    def stats(self, window):
+        iv = [(b - a) * 1000 for a, b in zip(self.arrivals, self.arrivals[1:])]
+        med = sorted(iv)[len(iv) // 2] if iv else None
+        # A gap of k median intervals means k-1 frames never arrived.
+        lost = sum(max(0, round(d / med) - 1) for d in iv) if med else 0
+        mean = sum(iv) / len(iv) if iv else None
+        r = lambda v: None if v is None else round(v, 2)
+        return {
+            'client': self.idx, 'driver': self.driver, 'protocol': self.protocol,
+            'accept_ms': r(self.accept_ms), 'error': self.error, 'close_code': self.close_code,
+            'sent': self.sent, 'pongs': self.pongs, 'telemetry': len(self.arrivals),
+            'telemetry_hz': r(len(self.arrivals) / window) if window > 0 else None,
+            'interarrival_ms': {'median': r(med), 'mean': r(mean), 'max': r(max(iv)) if iv else None},
+            'jitter_ms': {q: r(v) for q, v in percentiles([abs(d - med) for d in iv] if med else []).items()},
+            'jitter_sd_ms': r(math.sqrt(sum((d - mean) ** 2 for d in iv) / len(iv))) if iv else None,
+            'lost_est': lost,
+            'age_ms': {q: r(v) for q, v in percentiles(self.ages).items()},
+        }
+
+# ---- server counters ----
+WATCH = ('control_coalesced_total', 'control_stale_total', 'ws_bad_messages_total', 'ws_evictions_total',
+         'client_dropped_total', 'loop_overruns_total', 'loop_missed_deadlines_total', 'ws_clients')
+
+async def scrape(session, url):
+    try:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=3)) as resp:
+            text = await resp.text()
+    except Exception:
+        return None
+    out = {}
+    for line in text.splitlines():
+        if not line or line[0] == '#': continue
+        name, _, value = line.rpartition(' ')
+        name = name.split('{', 1)[0]
+        for w in WATCH:
+            if name.endswith('_' + w):
+                out[w] = out.get(w, 0.0) + float(value)   # per-client series are summed
+    return out
+
+def metrics_url(ws_url):
+    u = urlsplit(ws_url)
+    scheme = 'https' if u.scheme == 'wss' else 'http'
+    path = u.path.rsplit('/', 1)[0] + '/metrics'
+    return urlunsplit((scheme, u.netloc, path, '', ''))
+
+# ---- run ----
+async def run(args):
+    url = args.url
+    if args.rate: url += ('&' if '?' in url else '?') + f"rate={args.rate:g}"
+    murl = args.metrics or metrics_url(args.url)
+    n_drivers = args.clients if args.drivers is None else min(args.drivers, args.clients)
+    phones = [Phone(i, i < n_drivers) for i in range(args.clients)]
+    conn = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=conn) as session:
+        before = await scrape(session, murl)
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        t_start = time.perf_counter()
+        tasks = []
+        for p in phones:
+            tasks.append(asyncio.ensure_future(p.run(session, url, args, t_start, stop)))
+            if args.ramp: await asyncio.sleep(args.ramp / args.clients)
+        t_all = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        after = await scrape(session, murl) if before is not None else None
+        t_end = time.perf_counter()
+        stop.set_result(True)
+        await asyncio.gather(*tasks)
+    window = t_end - t_all
+    per = [p.stats(window) for p in phones]
+    server = None
+    if before is not None and after is not None:
+        server = {k: after.get(k, 0.0) - (0.0 if k in ('ws_clients', 'client_dropped_total') else before.get(k, 0.0))
+                  for k in WATCH}
+    return per, server, window
+
+def summarize(per):
+    ok = [c for c in per if c['error'] is None]
+    col = lambda key, sub=None: [c[key][sub] if sub else c[key] for c in ok
+                                 if (c[key][sub] if sub else c[key]) is not None]
+    return {
+        'clients': len(per), 'connected': len(ok), 'failed': len(per) - len(ok),
+        'evicted': sum(1 for c in ok if c['close_code'] == 1013),
+        'accept_ms': percentiles(col('accept_ms')),
+        'control_sent': sum(c['sent'] for c in ok),
+        'telemetry': sum(c['telemetry'] for c in ok),
+        'lost_est': sum(c['lost_est'] for c in ok),
+        'jitter_p99_ms': percentiles(col('jitter_ms', '99')),     # distribution of per-client p99s
+        'age_p50_ms': percentiles(col('age_ms', '50')),
+        'errors': sorted({c['error'] for c in per if c['error']}),
+    }
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Emulate phones against a running TouchDrive server.")
+    ap.add_argument('url', nargs='?', default='ws://127.0.0.1:8000/ws')
+    ap.add_argument('--clients', type=int, default=10)
+    ap.add_argument('--drivers', type=int, default=None)       # how many of them send sticks (default all)
+    ap.add_argument('--hz', type=float, default=60.0)          # control messages per driver per second
+    ap.add_argument('--pattern', choices=['steady','burst','poisson'], default='steady')
+    ap.add_argument('--burst', type=int, default=5)            # messages per burst with --pattern burst
+    ap.add_argument('--rate', type=float, default=0.0)         # ask for this telemetry rate (?rate=), 0 = server's
+    ap.add_argument('--binary', action='store_true')           # offer qcar.bin.v1 (server needs --ws-binary)
+    ap.add_argument('--arm', action='store_true')              # drivers ARM the car first (it will move!)
+    ap.add_argument('--no-ping', action='store_true')          # skip the page's 1 Hz clock pings
+    ap.add_argument('--duration', type=float, default=10.0)    # s measured once all clients are connecting
+    ap.add_argument('--ramp', type=float, default=0.0)         # s over which connections are spread
+    ap.add_argument('--connect-timeout', type=float, default=10.0)
+    ap.add_argument('--metrics', default=None)                 # server /metrics URL (default: next to url)
+    ap.add_argument('--per-client', action='store_true')
+    ap.add_argument('--json', default=None)                    # write results here ('-' = stdout)
+    args = ap.parse_args(argv)
+
+    per, server, window = asyncio.run(run(args))
+    summary = summarize(per)
+    doc = {'url': args.url, 'config': {k: v for k, v in vars(args).items() if k not in ('url', 'json')},
+           'window_s': round(window, 3), 'summary': summary, 'server': server, 'clients': per}
+    if args.json == '-':
+        json.dump(doc, sys.stdout, indent=1); print()
+        return
+
+    s = summary
+    f = lambda d, q: '-' if d[q] is None else f"{d[q]:.1f}"
+    print(f"[Load] {s['connected']}/{s['clients']} connected ({s['failed']} failed, {s['evicted']} evicted), "
+          f"{window:.1f} s measured")
+    print(f"[Load] accept ms      p50 {f(s['accept_ms'], '50')}  p99 {f(s['accept_ms'], '99')}")
+    print(f"[Load] control sent   {s['control_sent']} ({args.pattern}, {args.hz:g} Hz per driver)")
+    print(f"[Load] telemetry      {s['telemetry']} frames, ~{s['lost_est']} lost (gaps)")
+    print(f"[Load] jitter p99 ms  median client {f(s['jitter_p99_ms'], '50')}  worst-ish {f(s['jitter_p99_ms'], '99')}")
+    print(f"[Load] age p50 ms     median client {f(s['age_p50_ms'], '50')}  (server ts -> arrival, same-host clocks only)")
+    for e in s['errors']: print(f"[Load] error: {e}")
+    if server:
+        print("[Load] server: " + ", ".join(f"{k} {v:g}" for k, v in server.items()))
+    if args.per_client:
+        for c in per:
+            j = c['jitter_ms']
+            print(f"  #{c['client']:<3} {'drv' if c['driver'] else 'view'} {c['protocol'] or '-':<12} "
+                  f"accept {c['accept_ms']} ms  tele {c['telemetry']} ({c['telemetry_hz']} Hz)  "
+                  f"jitter p50/p99 {j['50']}/{j['99']} ms  lost ~{c['lost_est']}  close {c['close_code']}")
+    if args.json:
+        with open(args.json, 'w') as fh: json.dump(doc, fh, indent=1)
+        print(f"[Load] results written to {args.json}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# touchdrive/logwriter.py
+# Background CSV log writer for the control loop.
+# The loop only does a non-blocking enqueue per tick; a daemon thread drains
+# the queue in batches to one long-lived file handle and flushes / fsyncs on
+# its own schedule. Rows that don't fit in the queue are counted, not waited on.
+
+import csv, os, queue, threading, time
+from datetime import datetime
+
+LOG_HEADER = ['Timestamp','LinearSpeed_mps','Battery_pct','Throttle_cmd','Steering_cmd','Armed','EStop','CmdLatency_ms','DisplayLatency_ms','Trajectory']
+
+_STOP = object()
+
+def format_ts(t: float) -> str:
+    return datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+def format_ms(v):
+    return '' if v != v else f'{v:.3f}'   # NaN -> empty cell
+
+class LogWriter:
+    # Rows are (mono_ns, wall_time, speed, battery, throttle, steering, armed, estop, cmd_latency_ms,
+    # display_latency_ms, run); the CSV drops mono_ns and formats wall_time on the writer thread.
+    # cmd_latency_ms is NaN (empty cell) on ticks that didn't consume a new phone command,
+    # display_latency_ms on ticks with no new phone report (LatencyMonitor.displayed); run is the
+    # trajectory run id (touchdrive.trajectory), 0 (empty cell) outside scripted runs.
+    def __init__(self, path, maxsize=4096, batch=256, flush_interval=0.5, fsync_interval=0.0):
+        self.path = path
+        self.batch = max(1, int(batch))
+        self.flush_interval = max(0.0, float(flush_interval))
+        self.fsync_interval = max(0.0, float(fsync_interval))   # 0 = never fsync until close
+        self.written = 0
+        self.dropped = 0
+        self.error = None   # exception that stopped the writer thread (e.g. disk full)
+        self._q = queue.Queue(maxsize=max(1, int(maxsize)))
+        self._f = None
+        self._thread = None
+
+    # ---- writer-side hooks (overridden by the binary format) ----
+    def _open(self):
+        self._f = open(self.path, 'w', newline='')
+        self._csv = csv.writer(self._f)
+        self._csv.writerow(LOG_HEADER)
+
+    def _write_batch(self, rows):
+        self._csv.writerows([(format_ts(r[1]),) + tuple(r[2:8]) + (format_ms(r[8]), format_ms(r[9]), r[10] or '') for r in rows])
+
+    def _flush(self, sync):
+        self._f.flush()
+        if sync: os.fsync(self._f.fileno())
+
+    def _close_file(self):
+        self._f.close()
+
+    # ---- loop-side API ----
+    def start(self):
+        self._open()
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+        return self
+
+    def write(self, row):
+        if self.error is not None: self.dropped += 1; return
+        try: self._q.put_nowait(row)
+        except queue.Full: self.dropped += 1
+
+    def close(self, timeout=5.0):
+        if self._thread is None: return
+        # A live writer is draining, so this only blocks briefly; a dead one never will.
+        if self._thread.is_alive():
+            try: self._q.put(_STOP, timeout=timeout)
+            except queue.Full: pass
+        self._thread.join(timeout)
+        self._thread = None
+
+    # ---- writer thread ----
+    def _run(self):
+        last_flush = last_sync = time.monotonic()
+        wait = self.flush_interval or 0.5
+        stopping = False
+        try:
+            while not stopping:
+                rows = []
+                try:
+                    item = self._q.get(timeout=wait)
+                    while True:
+                        if item is _STOP: stopping = True; break
+                        rows.append(item)
+                        if len(rows) >= self.batch: break
+                        item = self._q.get_nowait()
+                except queue.Empty:
+                    pass
+                if rows:
+                    self._write_batch(rows)
+                    self.written += len(rows)
+
+                now = time.monotonic()
+                sync = self.fsync_interval > 0 and now - last_sync >= self.fsync_interval
+                if sync or now - last_flush >= self.flush_interval:
+                    self._flush(sync)
+                    last_flush = now
+                    if sync: last_sync = now
+        except Exception as e:
+            self.error = e
+            print(f"[Log] {self.path}: writer stopped ({e!r}), dropping further rows.", flush=True)
+        finally:
+            try:
+                self._flush(True)
+                self._close_file()
+            except OSError: pass
+
+def open_log(path, fmt='csv', **kw):
+    # fmt: 'csv' (text, one file) or 'binary' (touchdrive.binlog segments).
+    if fmt == 'binary':
+        from touchdrive.binlog import BinaryLogWriter
+        return BinaryLogWriter(path, **kw).start()
+    if fmt != 'csv': raise ValueError(f"unknown log format {fmt!r}")
+    return LogWriter(path, **kw).start()
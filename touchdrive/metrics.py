@@ -0,0 +1,184 @@
+# touchdrive/metrics.py
+# Cheap in-process metrics rendered in Prometheus text format (GET /metrics).
+# Recording is a bisect + two integer adds, so the per-phase timers can stay on
+# at 500 Hz. Values owned by other objects (scheduler counters, queue drops,
+# client counts) are read only when /metrics is scraped.
+
+from bisect import bisect_left
+
+# Latency buckets (seconds): 5 us .. 100 ms.
+BUCKETS = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1)
+# Network-scale buckets (seconds): 1 ms .. 2 s.
+NET_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.0)
+
+class Histogram:
+    __slots__ = ('buckets', '_bounds_ns', 'counts', 'sum_ns')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self._bounds_ns = [int(round(b * 1e9)) for b in self.buckets]
+        self.counts = [0] * (len(self.buckets) + 1)   # last slot = +Inf
+        self.sum_ns = 0
+
+    def observe(self, ns):
+        self.counts[bisect_left(self._bounds_ns, ns)] += 1
+        self.sum_ns += ns
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self): self.value = 0
+    def inc(self, n=1): self.value += n
+
+def _labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items: return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+class _Series:
+    __slots__ = ('fn', 'const')
+    def __init__(self, fn, const=()): self.fn, self.const = fn, const
+
+def _num(v):
+    return str(v) if isinstance(v, int) else repr(float(v))
+
+class Metrics:
+    def __init__(self, prefix='qcar', **const_labels):
+        # const_labels go on every series (e.g. car="3" when one server hosts several cars).
+        self.prefix = prefix
+        self.const_labels = const_labels
+        self._families = {}   # name -> [kind, help, {labels: source}]
+
+    def _add(self, name, kind, help, labels, source):
+        fam = self._families.setdefault(f"{self.prefix}_{name}", [kind, help, {}])
+        fam[2][tuple(sorted({**self.const_labels, **labels}.items()))] = source
+        return source
+
+    def histogram(self, name, help, buckets=BUCKETS, **labels):
+        return self._add(name, 'histogram', help, labels, Histogram(buckets))
+
+    def counter(self, name, help, **labels):
+        return self._add(name, 'counter', help, labels, Counter())
+
+    def collect(self, name, kind, help, fn, **labels):
+        # fn() is called at scrape time; kind is 'counter' or 'gauge'.
+        return self._add(name, kind, help, labels, fn)
+
+    def collect_many(self, name, kind, help, fn):
+        # fn() returns [(labels_dict, value), ...] at scrape time (e.g. one series per client).
+        return self._add(name, kind, help, {}, _Series(fn, tuple(self.const_labels.items())))
+
+    def render(self):
+        return render_all([self])
+
+def render_all(registries):
+    # One exposition for several registries with the same families (one per car):
+    # HELP/TYPE once per family, then every registry's series.
+    families = {}
+    for m in registries:
+        for name, (kind, help, series) in m._families.items():
+            families.setdefault(name, [kind, help, []])[2].extend(series.items())
+    out = []
+    for name, (kind, help, series) in families.items():
+        out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} {kind}")
+        for labels, src in series:
+            if isinstance(src, Histogram):
+                counts, acc = list(src.counts), 0   # snapshot; writer may be another thread
+                for le, c in zip(src.buckets, counts):
+                    acc += c
+                    out.append(f"{name}_bucket{_labels(labels, ('le', repr(le)))} {acc}")
+                acc += counts[-1]
+                out.append(f"{name}_bucket{_labels(labels, ('le', '+Inf'))} {acc}")
+                out.append(f"{name}_sum{_labels(labels)} {_num(src.sum_ns * 1e-9)}")
+                out.append(f"{name}_count{_labels(labels)} {acc}")
+            elif isinstance(src, _Series):
+                for lab, value in src.fn():
+                    out.append(f"{name}{_labels(sorted({**dict(src.const), **lab}.items()))} {_num(value)}")
+            else:
+                value = src.value if isinstance(src, Counter) else src()
+                out.append(f"{name}{_labels(labels)} {_num(value)}")
+    return '\n'.join(out) + '\n'
+
+class LoopMetrics(Metrics):
+    # The control-loop metric set shared by both drive scripts.
+    PHASES = ('compute', 'io', 'log', 'telemetry', 'tick')
+
+    def __init__(self, prefix='qcar', **const_labels):
+        super().__init__(prefix, **const_labels)
+        self._sched = self._log = self._telemetry = self._state = self._estimator = self._rate = self._trajectory = None
+        self._clients = {}
+        ph = {p: self.histogram('loop_phase_seconds', "Time spent in each control-loop phase (tick = all of them).", phase=p)
+              for p in self.PHASES}
+        self.compute, self.io, self.log_write, self.telemetry, self.tick = (ph[p] for p in self.PHASES)
+        self.lateness = self.histogram('loop_lateness_seconds', "Tick start minus its scheduled deadline.")
+        self.touch_latency = self.histogram('touch_to_actuation_seconds',
+                                            "Phone touch event to the QCar I/O tick that applied it.", NET_BUCKETS)
+        self.display_latency = self.histogram('actuation_to_display_seconds',
+                                              "QCar I/O tick to its telemetry being shown on the phone.", NET_BUCKETS)
+        self.rtt = self.histogram('ws_rtt_seconds', "Best recent ping round-trip reported by each phone.", NET_BUCKETS)
+        self.bad_messages = self.counter('ws_bad_messages_total', "Inbound WebSocket messages that failed to parse.")
+        self.send_errors = self.counter('telemetry_send_errors_total', "Telemetry sends that raised.")
+        self.evictions = self.counter('ws_evictions_total', "Clients disconnected for staying backlogged.")
+        self.broadcast = self.histogram('telemetry_broadcast_seconds', "Time to build and enqueue one telemetry frame for all due clients.")
+
+        self.collect('loop_ticks_total', 'counter', "Control ticks executed.", lambda: self._sched.ticks if self._sched else 0)
+        self.collect('loop_overruns_total', 'counter', "Ticks that started after their deadline had passed.",
+                     lambda: self._sched.overruns if self._sched else 0)
+        self.collect('loop_missed_deadlines_total', 'counter', "Deadlines skipped without a tick.",
+                     lambda: self._sched.missed if self._sched else 0)
+        self.collect('loop_rate_hz', 'gauge', "Current scheduled loop rate.", lambda: self._sched.rate if self._sched else 0.0)
+        self.collect('loop_rate_changes_total', 'counter', "Loop rate changes at runtime (admin API or auto-tuning).",
+                     lambda: self._rate.changes if self._rate else 0)
+        self.collect('loop_rate_auto', 'gauge', "1 while the loop rate is auto-tuned.",
+                     lambda: int(self._rate.auto) if self._rate else 0)
+        self.collect('trajectory_active', 'gauge', "Run id of the scripted trajectory being played, 0 when none.",
+                     lambda: self._trajectory.tagged if self._trajectory else 0)
+        self.collect_many('trajectory_runs_total', 'counter', "Finished scripted trajectory runs.",
+                          lambda: [({'result': r}, n) for r, n in zip(('done', 'aborted'), self._trajectory.runs)]
+                                  if self._trajectory else [])
+        self.collect('dropped_total', 'counter', "Items dropped under back-pressure.",
+                     lambda: self._log.dropped if self._log else 0, queue='log')
+        self.collect('telemetry_frames_total', 'counter', "Telemetry frames broadcast.",
+                     lambda: self._telemetry.sent if self._telemetry else 0)
+        self.collect('control_coalesced_total', 'counter', "Control messages superseded before the loop applied them.",
+                     lambda: self._state.coalesced if self._state else 0)
+        self.collect('control_stale_total', 'counter', "Control messages dropped for an out-of-order sequence number.",
+                     lambda: self._state.stale if self._state else 0)
+        self.collect('ws_clients', 'gauge', "Connected WebSocket clients.", lambda: len(self._clients))
+        # self._clients maps ws -> touchdrive.clients.ClientWriter
+        self.collect('input_estimated_ticks_total', 'counter', "Ticks driven by the input estimator (--estimator).",
+                     lambda: self._estimator.estimated if self._estimator else 0)
+        self.collect('input_stale_ticks_total', 'counter', "Estimator ticks decayed toward zero because input went stale.",
+                     lambda: self._estimator.decayed if self._estimator else 0)
+        self.collect_many('input_prediction_error_mean', 'gauge',
+                          "Mean absolute error of the estimate against the next real stick sample (hold = last value only).",
+                          lambda: self._estimator_errors('mae'))
+        self.collect_many('input_prediction_error_rms', 'gauge', "RMS of the same error.",
+                          lambda: self._estimator_errors('rms'))
+        self.collect_many('input_prediction_error_max', 'gauge', "Largest absolute error of the same.",
+                          lambda: self._estimator_errors('max'))
+        self.collect_many('client_sent_total', 'counter', "Telemetry frames sent, per client.",
+                          lambda: [({'client': w.name}, w.sent) for w in list(self._clients.values())])
+        self.collect_many('client_dropped_total', 'counter', "Stale telemetry frames dropped, per client.",
+                          lambda: [({'client': w.name}, w.dropped) for w in list(self._clients.values())])
+        self.collect_many('client_lag_seconds', 'gauge', "Enqueue-to-sent time of the last frame, per client.",
+                          lambda: [({'client': w.name}, w.lag) for w in list(self._clients.values())])
+        self.collect_many('client_backlog_seconds', 'gauge', "How long each client has been continuously behind.",
+                          lambda: [({'client': w.name}, w.backlog()) for w in list(self._clients.values())])
+
+    def _estimator_errors(self, stat):
+        est = self._estimator
+        if est is None: return []
+        return [({'axis': a, 'predictor': name}, getattr(errs[a], stat))
+                for name, errs in (('estimator', est.err), ('hold', est.hold_err)) for a in errs]
+
+    def bind(self, sched=None, log=None, telemetry=None, clients=None, state=None, estimator=None, rate=None, trajectory=None):
+        if sched is not None: self._sched = sched
+        if log is not None: self._log = log
+        if telemetry is not None: self._telemetry = telemetry
+        if clients is not None: self._clients = clients
+        if state is not None: self._state = state
+        if estimator is not None: self._estimator = estimator
+        if rate is not None: self._rate = rate
+        if trajectory is not None: self._trajectory = trajectory
@@ -0,0 +1,63 @@
+# touchdrive/protocol.py
+# Opt-in binary WebSocket protocol (--ws-binary).
+# Negotiated with the WebSocket subprotocol header: the page offers
+# ['qcar.bin.v1', 'qcar.json'] and falls back to JSON when the server picks
+# 'qcar.json' (or nothing). All frames are little-endian; byte 0 is the type.
+#
+#   AXES      0x01  <B3x I ffff d seq, left.x, left.y, right.x, right.y, ts (ms, Date.now())
+#   PARAMS    0x02  <B3x ffff     maxSpeed, steerGain, dead, smooth
+#   COMMAND   0x03  <BB           0 = arm, 1 = disarm, 2 = estop
+#   SUBSCRIBE 0x04  <B3x f        telemetry rate (Hz)
+#   TELEMETRY 0x10  <BB2x ffff d  flags (bit0 armed, bit1 estop), battery_pct,
+#                                 speed_mps, throttle, steering, ts (s, time.time())
+#
+# Decoded client frames are the same dicts the JSON protocol produces, so
+# ControllerState.update_from_msg doesn't care which protocol a phone speaks.
+
+import struct
+
+BIN_PROTO = 'qcar.bin.v1'
+JSON_PROTO = 'qcar.json'
+
+AXES, PARAMS, COMMAND, SUBSCRIBE, TELEMETRY = 0x01, 0x02, 0x03, 0x04, 0x10
+
+_AXES = struct.Struct('<B3xIffffd')
+_PARAMS = struct.Struct('<B3xffff')
+_COMMAND = struct.Struct('<BB')
+_SUBSCRIBE = struct.Struct('<B3xf')
+_TELEMETRY = struct.Struct('<BB2xffffd')
+
+COMMANDS = ('arm', 'disarm', 'estop')
+
+def decode(data):
+    kind = data[0]
+    if kind == AXES:
+        _, seq, lx, ly, rx, ry, ts = _AXES.unpack(data)
+        return {'type': 'control', 'left': {'x': lx, 'y': ly}, 'right': {'x': rx, 'y': ry}, 'seq': seq, 'ts': ts}
+    if kind == PARAMS:
+        _, vmax, steer_k, dz, smooth = _PARAMS.unpack(data)
+        return {'type': 'control', 'params': {'maxSpeed': vmax, 'steerGain': steer_k, 'dead': dz, 'smooth': smooth}}
+    if kind == COMMAND:
+        return {'type': COMMANDS[_COMMAND.unpack(data)[1]]}
+    if kind == SUBSCRIBE:
+        return {'type': 'subscribe', 'rate': _SUBSCRIBE.unpack(data)[1]}
+    raise ValueError(f"unknown frame type 0x{kind:02x}")
+
+def encode_telemetry(batt_pct, speed_mps, throttle, steering, armed, estop, ts):
+    return _TELEMETRY.pack(TELEMETRY, (1 if armed else 0) | (2 if estop else 0),
+                           batt_pct, speed_mps, throttle, steering, ts)
+
+def decode_telemetry(data):
+    # Client side (load generator, tests): same dict as the JSON telemetry message.
+    _, flags, batt_pct, speed_mps, throttle, steering, ts = _TELEMETRY.unpack(data)
+    return {'type': 'telemetry', 'battery_pct': batt_pct, 'speed_mps': speed_mps, 'throttle': throttle,
+            'steering': steering, 'armed': bool(flags & 1), 'estop': bool(flags & 2), 'ts': ts}
+
+def encode_axes(seq, lx, ly, rx, ry, ts):
+    return _AXES.pack(AXES, seq, lx, ly, rx, ry, ts)
+
+def encode_params(vmax, steer_k, dz, smooth):
+    return _PARAMS.pack(PARAMS, vmax, steer_k, dz, smooth)
+
+def encode_command(name):
+    return _COMMAND.pack(COMMAND, COMMANDS.index(name))
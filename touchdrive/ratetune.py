@@ -0,0 +1,153 @@
+# touchdrive/ratetune.py
+# Live loop-rate changes (admin API) and auto-tuning (--auto-rate).
+# LoopRate is the per-car handle. HTTP handlers post requests to it, and the
+# control tick applies them between two ticks (DeadlineScheduler.set_rate), so
+# phones stay connected and the car stays armed:
+#     POST /admin/rate {"rate": 200}      fixed rate (turns auto-tuning off)
+#     POST /admin/rate {"auto": true}     auto-tune again (false: stay at the current rate)
+#     GET  /admin/rate                    rate, mode and the tuner's last measurements
+# (or /car/<id>/admin/rate; loopback only unless the server has --admin-token).
+#
+# With auto-tuning on, RateTuner records every tick's total cost and its
+# read_write_std share:
+#   warm-up   WARMUP s at the current rate, then jump to the rate at which the
+#             p99 tick cost is UTIL of the period (the rest is left for the event
+#             loop, WebSocket traffic and jitter), within --auto-rate-min/max
+#   then      every WINDOW s: back off when overruns exceed the target or the
+#             p99 cost no longer fits (I/O got slower, e.g. QLabs under heavy
+#             scene load); creep back up by STEP_UP when it fits again
+
+import math
+from array import array
+
+WARMUP, WINDOW = 3.0, 2.0   # s
+UTIL = 0.5                  # share of the period the p99 tick may use
+STEP_UP, BACK_OFF = 1.25, 0.7
+RING = 4096                 # ticks kept per window (newest win)
+MIN_RATE, MAX_RATE = 5.0, 2000.0
+AUTO_ON, AUTO_OFF = -1.0, 0.0   # request settings next to a rate in Hz
+
+def parse_request(body):
+    # {"rate": Hz} | {"auto": true|false} -> setting for LoopRate.request().
+    if not isinstance(body, dict): raise ValueError("expected a JSON object")
+    if body.get('rate') is not None:
+        rate = float(body['rate'])
+        if not (MIN_RATE <= rate <= MAX_RATE): raise ValueError(f"rate must be {MIN_RATE:g}..{MAX_RATE:g} Hz")
+        return rate
+    if 'auto' in body: return AUTO_ON if body['auto'] else AUTO_OFF
+    raise ValueError("expected {\"rate\": Hz} or {\"auto\": true|false}")
+
+def _nice(rate):
+    # Rounded down to whole Hz, or to tens above 100 Hz.
+    return float(math.floor(rate / 10.0) * 10 if rate >= 100.0 else math.floor(rate))
+
+class RateTuner:
+    def __init__(self, min_rate=20.0, max_rate=1000.0, overruns=0.01, time_scale=1.0):
+        self.min_rate, self.max_rate = float(min_rate), float(max_rate)
+        self.target = float(overruns)   # tolerated share of ticks that overrun
+        self.scale = float(time_scale)
+        self._cost = array('q', bytes(8 * RING))
+        self._io = array('q', bytes(8 * RING))
+        self.tick_p99 = self.io_p99 = self.ceiling = self.overrun_share = math.nan
+        self.restart()
+
+    def restart(self):
+        self._n, self._t0, self._warm = 0, None, False
+
+    def observe(self, sched, now_ns, tick_ns, io_ns, rate):
+        # Control tick; returns a new control rate (Hz) at the end of a window, else None.
+        i = self._n & (RING - 1)
+        self._cost[i] = tick_ns; self._io[i] = io_ns
+        self._n += 1
+        if self._t0 is None:
+            self._t0, self._ticks0, self._over0 = now_ns, sched.ticks, sched.overruns
+            return None
+        if now_ns - self._t0 < (WINDOW if self._warm else WARMUP) * 1e9: return None
+        return self._decide(sched, now_ns, rate)
+
+    def _decide(self, sched, now_ns, rate):
+        import numpy as np
+        n = min(self._n, RING)
+        k = max(0, int(math.ceil(0.99 * n)) - 1)
+        self.tick_p99 = float(np.partition(np.frombuffer(self._cost, np.int64)[:n], k)[k]) * 1e-9
+        self.io_p99 = float(np.partition(np.frombuffer(self._io, np.int64)[:n], k)[k]) * 1e-9
+        ticks = sched.ticks - self._ticks0
+        self.overrun_share = (sched.overruns - self._over0) / ticks if ticks else 0.0
+        # Control Hz at which the p99 tick takes UTIL of the (wall-clock) period.
+        self.ceiling = UTIL / (max(self.tick_p99, 1e-6) * self.scale)
+        self._n, self._t0, self._ticks0, self._over0 = 0, now_ns, sched.ticks, sched.overruns
+
+        if not self._warm:
+            self._warm = True
+            new = self.ceiling if self.overrun_share <= self.target else rate * BACK_OFF
+        elif self.overrun_share > self.target: new = min(rate * BACK_OFF, self.ceiling)
+        elif self.ceiling < rate: new = self.ceiling
+        elif self.ceiling > rate * 1.05: new = min(self.ceiling, rate * STEP_UP)
+        else: return None
+        new = _nice(min(self.max_rate, max(self.min_rate, new)))
+        return new if abs(new - rate) >= 0.05 * rate else None
+
+class LoopRate:
+    def __init__(self, rate, time_scale=1.0, auto=False, tuner=None, tag='[QCar]'):
+        # auto: start auto-tuned (--auto-rate); tuner: RateTuner keywords, also used
+        # when auto-tuning is switched on later.
+        self.rate = float(rate)           # control Hz (the scheduler runs time_scale x faster)
+        self.time_scale = float(time_scale)
+        self.tag = tag
+        self.auto = bool(auto)
+        self.tuner_opts = dict(tuner or {})
+        self.tuner = RateTuner(time_scale=time_scale, **self.tuner_opts) if self.auto else None
+        self.changes = 0
+        self.forward = None      # --loop-mode process: ControlLink.set_rate takes the requests
+        self._pending = None
+
+    def request(self, setting):
+        # Any thread: a parse_request() setting, applied by the next control tick.
+        if self.forward is not None: self.forward(setting)
+        else: self._pending = setting
+
+    def tick(self, sched, now_ns, tick_ns, io_ns):
+        # Control tick, after its I/O. Returns the new control rate if it changed, else None.
+        setting, new, why = self._pending, None, 'admin'
+        if setting is not None:
+            self._pending = None
+            if setting > 0.0: self.auto, new = False, setting
+            elif setting == AUTO_ON:
+                if self.tuner is None: self.tuner = RateTuner(time_scale=self.time_scale, **self.tuner_opts)
+                self.tuner.restart()
+                self.auto = True
+                print(f"{self.tag} loop rate: auto-tuning from {self.rate:g} Hz", flush=True)
+            else: self.auto = False
+        elif self.auto:
+            new = self.tuner.observe(sched, now_ns, tick_ns, io_ns, self.rate)
+            if new is not None:
+                t = self.tuner
+                why = (f"auto: tick p99 {t.tick_p99 * 1e6:.0f} us, I/O p99 {t.io_p99 * 1e6:.0f} us, "
+                       f"overruns {t.overrun_share:.1%}")
+        if new is None or new == self.rate: return None
+        print(f"{self.tag} loop rate {self.rate:g} -> {new:g} Hz ({why})", flush=True)
+        self.rate = new
+        self.changes += 1
+        sched.set_rate(new * self.time_scale)
+        return new
+
+    def observed(self, rate, auto):
+        # --loop-mode process: what the control process reports (rate = its scheduler's Hz).
+        rate /= self.time_scale
+        if abs(rate - self.rate) > 1e-6 * rate: self.changes += 1
+        self.rate, self.auto = rate, bool(auto)
+
+    def status(self):
+        out = {'rate': round(self.rate, 3), 'auto': self.auto, 'changes': self.changes}
+        t = self.tuner
+        if t is not None and self.forward is None:
+            def num(v, k=1.0): return None if math.isnan(v) else round(v * k, 3)
+            out['tuner'] = {'min_rate': t.min_rate, 'max_rate': t.max_rate, 'overrun_target': t.target,
+                            'tick_p99_us': num(t.tick_p99, 1e6), 'io_p99_us': num(t.io_p99, 1e6),
+                            'ceiling_hz': num(t.ceiling), 'overrun_share': num(t.overrun_share)}
+        return out
+
+def retime(car, sample_time):
+    # Tell a backend its tick length changed (the simulator integrates with it; PAL doesn't care).
+    fn = getattr(car, 'set_sample_time', None)
+    if fn is not None: fn(sample_time)
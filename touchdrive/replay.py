@@ -0,0 +1,209 @@
+# touchdrive/replay.py
+# Record-and-replay of driving sessions (--record).
+# The recorder captures every frame handle_ws receives (raw text / binary,
+# plus client connect / disconnect) with its monotonic arrival time into a
+# compact binary file, on a background thread like the log writer.
+# The replayer feeds those frames back through ControllerState.post() into
+# the same drain -> compute -> LEDs -> I/O tick the server runs, against the
+# simulator, on a fixed tick grid: frames that arrived before tick k's
+# deadline are applied at tick k. The result is deterministic, so outputs
+# from two code versions can be compared tick by tick:
+#     python -m touchdrive.replay run  session.qrec -o new.csv          # as fast as possible
+#     python -m touchdrive.replay run  session.qrec -o rt.csv --speed 1 # real time (N = N x)
+#     python -m touchdrive.replay diff old.csv new.csv
+#     python -m touchdrive.replay info session.qrec
+
+import argparse, csv, json, struct, sys, time
+
+from touchdrive import protocol
+from touchdrive.backends import open_backend
+from touchdrive.control import ControllerState, battery_pct, led_table, led_index
+from touchdrive.estimator import open_estimator
+from touchdrive.filters import CommandFilter
+from touchdrive.logwriter import LogWriter
+
+MAGIC = b'QCARREC\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIddq4x')   # magic, version, loop rate (Hz), sim time_scale, mono_ns at start -> 40 bytes
+RECORD = struct.Struct('<qHBI')       # mono_ns, client id, kind, payload length; payload follows
+OPEN, TEXT, BINARY, CLOSE = 0, 1, 2, 3
+KINDS = ('open', 'text', 'binary', 'close')
+
+OUT_HEADER = ['Tick','SimTime_s','Throttle_cmd','Steering_cmd','Armed','EStop','LinearSpeed_mps','Battery_pct','Applied']
+
+# ---- recording ----
+class SessionRecorder(LogWriter):
+    # Rows are (mono_ns, client, kind, payload). Same non-blocking write() as the
+    # log; a dropped frame makes the recording incomplete, so the queue is deeper
+    # and drops are reported at shutdown.
+    def __init__(self, path, rate, time_scale=1.0, maxsize=65536, **kw):
+        super().__init__(path, maxsize=maxsize, **kw)
+        self.rate = float(rate)
+        self.time_scale = float(time_scale)
+        self._next_id = 0
+
+    def _open(self):
+        self._f = open(self.path, 'wb')
+        self._f.write(HEADER.pack(MAGIC, VERSION, self.rate, self.time_scale, time.monotonic_ns()))
+
+    def _write_batch(self, rows):
+        pack, out = RECORD.pack, []
+        for t, cid, kind, data in rows:
+            if isinstance(data, str): data = data.encode()
+            out.append(pack(t, cid, kind, len(data))); out.append(data)
+        self._f.write(b''.join(out))
+
+    # ---- handle_ws API ----
+    def connect(self):
+        self._next_id = (self._next_id + 1) & 0xFFFF
+        self.write((time.monotonic_ns(), self._next_id, OPEN, b''))
+        return self._next_id
+
+    def message(self, cid, binary, data):
+        self.write((time.monotonic_ns(), cid, BINARY if binary else TEXT, data))
+
+    def disconnect(self, cid):
+        self.write((time.monotonic_ns(), cid, CLOSE, b''))
+
+# ---- reading ----
+def read_header(f):
+    raw = f.read(HEADER.size)
+    if len(raw) < HEADER.size: raise ValueError("truncated session header")
+    magic, version, rate, time_scale, mono0 = HEADER.unpack(raw)
+    if magic != MAGIC: raise ValueError("not a TouchDrive session recording")
+    if version != VERSION: raise ValueError(f"unsupported session version {version} (expected {VERSION})")
+    return {'rate': rate, 'time_scale': time_scale, 'mono0': mono0}
+
+def iter_frames(path):
+    # Yields (mono_ns, client, kind, payload bytes). A torn last record (crash) ends the stream.
+    with open(path, 'rb') as f:
+        read_header(f)
+        unpack, size = RECORD.unpack, RECORD.size
+        while True:
+            raw = f.read(size)
+            if len(raw) < size: return
+            t, cid, kind, n = unpack(raw)
+            data = f.read(n)
+            if len(data) < n: return
+            yield t, cid, kind, data
+
+def decode(kind, data):
+    # Same parsing as handle_ws; None for frames that never reach ControllerState
+    # (trajectory runs are started over HTTP and aren't part of a recording).
+    msg = json.loads(data) if kind == TEXT else protocol.decode(data)
+    return None if msg.get('type') in ('subscribe', 'ping', 'clock', 'history', 'trajectory') else msg
+
+# ---- replay ----
+def replay(path, out, rate=None, speed=0.0, until=None, estimator='off', slew=(0.0, 0.0)):
+    with open(path, 'rb') as f: hdr = read_header(f)
+    rate = rate or hdr['rate']
+    sample_time = 1.0 / rate
+    # Messages are placed on the grid the recorded loop ran on (in wall time).
+    period_ns = int(round(1e9 / (rate * hdr['time_scale'])))
+    state, car, leds = ControllerState(), open_backend('sim', sample_time), led_table()
+    state.filter = CommandFilter(*slew)
+    est = open_estimator(estimator)   # runs on the tick grid, so replays stay deterministic
+    writer = csv.writer(out)
+    writer.writerow(OUT_HEADER)
+    frames = iter_frames(path)
+    pending = next(frames, None)
+    clients, bad, tick = {}, 0, 0
+    deadline = hdr['mono0']
+    wall0 = time.perf_counter()
+    while pending is not None or tick == 0:
+        deadline += period_ns
+        while pending is not None and pending[0] < deadline:
+            t, cid, kind, data = pending
+            if kind == OPEN: clients[cid] = object()
+            elif kind == CLOSE: state.forget(clients.pop(cid, cid))
+            else:
+                try:
+                    msg = decode(kind, data)
+                    if msg is not None: state.post(clients.setdefault(cid, object()), msg)
+                except Exception: bad += 1
+            pending = next(frames, None)
+
+        applied = state.drain()
+        throttle, steering = state.compute(state.throttle, state.steering,
+                                           est.step(deadline, state.cmd, applied) if est else None, sample_time)
+        car.read_write_std(throttle=throttle, steering=steering, LEDs=leds[led_index(throttle, steering)])
+        writer.writerow((tick, repr(car.t), repr(throttle), repr(steering), int(state.armed), int(state.estop),
+                         repr(float(car.motorTach)), repr(battery_pct(car.batteryVoltage)), len(applied)))
+        tick += 1
+        if until and car.t >= until: break
+        if speed > 0:
+            ahead = tick * sample_time / speed - (time.perf_counter() - wall0)
+            if ahead > 0: time.sleep(ahead)
+    if est: print(f"[Input] {est.summary()}", file=sys.stderr)
+    return tick, bad
+
+# ---- diff ----
+def diff(a_path, b_path, tol=0.0, show=10):
+    # Compares two replay outputs row by row; returns the number of differing ticks.
+    with open(a_path, newline='') as fa, open(b_path, newline='') as fb:
+        ra, rb = csv.reader(fa), csv.reader(fb)
+        ha, hb = next(ra), next(rb)
+        if ha != hb: raise SystemExit(f"different columns: {ha} vs {hb}")
+        cols = ha[2:]
+        worst = dict.fromkeys(cols, 0.0)
+        n = differing = 0
+        for n, (a, b) in enumerate(zip(ra, rb), 1):
+            bad = []
+            for c, x, y in zip(cols, a[2:], b[2:]):
+                d = abs(float(x) - float(y))
+                if d > worst[c]: worst[c] = d
+                if d > tol: bad.append(f"{c} {x} != {y}")
+            if bad:
+                differing += 1
+                if differing <= show: print(f"tick {a[0]}: " + "; ".join(bad))
+        rest_a, rest_b = sum(1 for _ in ra), sum(1 for _ in rb)
+    print(f"[Replay] {n} ticks compared, {differing} differ (tol {tol:g})")
+    if rest_a or rest_b: print(f"[Replay] length differs: {rest_a} extra ticks in {a_path}, {rest_b} in {b_path}")
+    print("[Replay] max abs diff: " + ", ".join(f"{c} {v:.3g}" for c, v in worst.items()))
+    return differing + (1 if rest_a or rest_b else 0)
+
+def info(path):
+    with open(path, 'rb') as f: hdr = read_header(f)
+    counts, clients, first, last, size = [0, 0, 0, 0], set(), None, None, 0
+    for t, cid, kind, data in iter_frames(path):
+        counts[kind] += 1; clients.add(cid); size += len(data)
+        if first is None: first = t
+        last = t
+    span = (last - hdr['mono0']) * 1e-9 if last is not None else 0.0
+    print(f"[Replay] {path}: loop {hdr['rate']:g} Hz x{hdr['time_scale']:g}, {span:.1f} s, {len(clients)} clients, "
+          + ", ".join(f"{counts[i]} {k}" for i, k in enumerate(KINDS)) + f", {size} payload bytes")
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Replay a recorded session (--record) against the simulator, or diff two replays.")
+    sub = ap.add_subparsers(dest='cmd', required=True)
+    r = sub.add_parser('run')
+    r.add_argument('session')
+    r.add_argument('-o', '--output', default='-')          # per-tick CSV ('-' = stdout)
+    r.add_argument('--speed', type=float, default=0.0)     # x real time; 0 = as fast as possible
+    r.add_argument('--rate', type=float, default=None)     # override the recorded loop rate
+    r.add_argument('--until', type=float, default=None)    # stop after N s of session time
+    r.add_argument('--slew-throttle', type=float, default=0.0)   # as the server's --slew-throttle / --slew-steer
+    r.add_argument('--slew-steer', type=float, default=0.0)
+    r.add_argument('--estimator', choices=['off','extrapolate','interpolate'], default='off')   # as the server's --estimator
+    d = sub.add_parser('diff')
+    d.add_argument('a'); d.add_argument('b')
+    d.add_argument('--tol', type=float, default=0.0)
+    d.add_argument('--show', type=int, default=10)         # differing ticks to print
+    i = sub.add_parser('info')
+    i.add_argument('session')
+    args = ap.parse_args(argv)
+
+    if args.cmd == 'info': return info(args.session)
+    if args.cmd == 'diff': sys.exit(1 if diff(args.a, args.b, args.tol, args.show) else 0)
+    t0 = time.perf_counter()
+    slew = (args.slew_throttle, args.slew_steer)
+    if args.output == '-': ticks, bad = replay(args.session, sys.stdout, args.rate, args.speed, args.until, args.estimator, slew)
+    else:
+        with open(args.output, 'w', newline='') as out:
+            ticks, bad = replay(args.session, out, args.rate, args.speed, args.until, args.estimator, slew)
+    dt = time.perf_counter() - t0
+    print(f"[Replay] {ticks} ticks in {dt:.2f} s ({ticks / dt:.0f} ticks/s)"
+          + (f", {bad} unparseable frames" if bad else ""), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# touchdrive/rtloop.py
+# Dedicated control thread (--loop-mode thread).
+# The tick (compute -> read_write_std -> telemetry capture -> log) runs on its own
+# OS thread at elevated priority, so aiohttp handlers and WebSocket sends can
+# never delay actuation. Telemetry goes back through TelemetryBroadcaster.publish,
+# which is a plain reference swap.
+
+import os, sys, threading, traceback
+
+# Max time the event-loop thread can hold the GIL before the control thread gets it.
+GIL_SWITCH_INTERVAL = 0.0005
+
+def set_thread_priority(priority):
+    # Called from the thread itself. SCHED_FIFO needs CAP_SYS_NICE (or an rtprio
+    # limit); otherwise try a nice bump for this thread, otherwise leave it alone.
+    if priority and hasattr(os, 'sched_setscheduler'):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(int(priority)))
+            return f"SCHED_FIFO {int(priority)}"
+        except (PermissionError, OSError):
+            pass
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), -10)
+        return "nice -10"
+    except (PermissionError, OSError, AttributeError):
+        return "default priority"
+
+class ControlThread:
+    def __init__(self, tick, sched, on_exit=None, priority=50, tag='[QCar]'):
+        self._tick = tick
+        self.sched = sched   # touchdrive.scheduler.DeadlineScheduler
+        self._on_exit = on_exit
+        self.priority = priority
+        self.tag = tag
+        self.error = None
+        self._switch = None   # interpreter switch interval before start(), restored by stop()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='qcar-control', daemon=True)
+
+    def start(self):
+        self._switch = sys.getswitchinterval()
+        sys.setswitchinterval(min(self._switch, GIL_SWITCH_INTERVAL))
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=2.0):
+        self._stop.set()
+        if self._thread.is_alive(): self._thread.join(timeout)
+        if self._switch is not None: sys.setswitchinterval(self._switch); self._switch = None
+
+    def _run(self):
+        print(f"{self.tag} Control thread running ({set_thread_priority(self.priority)}).")
+        try:
+            while True:
+                self.sched.wait(self._stop.wait)
+                if self._stop.is_set(): break
+                self._tick()
+        except Exception as e:
+            self.error = e
+            traceback.print_exc()
+        finally:
+            if self._on_exit: self._on_exit()
@@ -0,0 +1,140 @@
+# touchdrive/scheduler.py
+# Drift-free deadline scheduler for the control loop.
+# Deadlines are absolute points on time.monotonic_ns() (immune to NTP steps),
+# spaced one period apart, so sleep error never accumulates. Optionally the
+# last spin_us of each wait is a busy-wait, which beats the OS / asyncio timer
+# granularity at 200-1000 Hz.
+#
+# An overrun is a tick that was already past its deadline when wait() was
+# called (the previous tick took too long). What happens next is the policy:
+#   skip     run now, then resume on the original grid (missed slots are dropped)
+#   catchup  run the missed slots back-to-back (at most max_catchup of them)
+#   degrade  run now and stretch the period (up to degrade_max x); it shrinks
+#            back toward the requested rate after recover_ticks clean ticks
+# set_rate() changes the rate while running (admin API, auto-tuning); the new
+# period starts at the next deadline.
+
+import asyncio, time
+
+POLICIES = ('skip', 'catchup', 'degrade')
+
+class DeadlineScheduler:
+    def __init__(self, rate, spin_us=0.0, policy='skip', max_catchup=5, degrade_max=4.0, recover_ticks=100):
+        if policy not in POLICIES: raise ValueError(f"unknown overrun policy {policy!r}")
+        self.base_period_ns = int(round(1e9 / rate))
+        self.period_ns = self.base_period_ns
+        self.spin_ns = int(spin_us * 1000)
+        self.policy = policy
+        self.max_catchup = max(0, int(max_catchup))
+        self.max_period_ns = int(self.base_period_ns * max(1.0, degrade_max))
+        self.recover_ticks = max(1, int(recover_ticks))
+        self.next_ns = None
+        self.started_ns = None
+        # stats
+        self.ticks = 0
+        self.overruns = 0
+        self.missed = 0            # whole deadlines that passed without a tick
+        self.last_late_ns = 0      # tick start - deadline
+        self.max_late_ns = 0
+        self.total_late_ns = 0
+        self._clean = 0
+        self._backlog = 0
+        self._new_period_ns = 0    # set_rate() request, taken by the next tick
+
+    @property
+    def period(self):
+        return self.period_ns * 1e-9
+
+    @property
+    def rate(self):
+        return 1e9 / self.period_ns
+
+    def set_rate(self, rate):
+        # Safe from another thread: a single assignment the ticking side picks up.
+        self._new_period_ns = int(round(1e9 / rate))
+
+    def start(self, at_ns=None):
+        # at_ns: first deadline (monotonic ns), so several loops can share an epoch with
+        # staggered phases. One already in the past moves forward by whole periods.
+        now = self.started_ns = time.monotonic_ns()
+        if at_ns is None: self.next_ns = now
+        else:
+            at_ns = int(at_ns)
+            if at_ns < now: at_ns += -(-(now - at_ns) // self.period_ns) * self.period_ns
+            self.next_ns = at_ns
+
+    # ---- waiting ----
+    def wait(self, sleep=time.sleep):
+        # Blocking wait for the next deadline (control thread). `sleep` may be an
+        # Event.wait so a stop request cuts the sleep short.
+        if self.next_ns is None: self.start()
+        rem = self.next_ns - time.monotonic_ns()
+        if rem > self.spin_ns: sleep((rem - self.spin_ns) * 1e-9)
+        self._spin()
+        self._begin_tick(rem <= 0)
+
+    async def wait_async(self):
+        # Same as wait() for the asyncio loop; always yields at least once so an
+        # overrunning loop can't starve the WebSocket handlers.
+        if self.next_ns is None: self.start()
+        rem = self.next_ns - time.monotonic_ns()
+        await asyncio.sleep((rem - self.spin_ns) * 1e-9 if rem > self.spin_ns else 0)
+        self._spin()
+        self._begin_tick(rem <= 0)
+
+    def _spin(self):
+        dl = self.next_ns
+        while time.monotonic_ns() < dl: pass
+
+    # ---- bookkeeping ----
+    def _begin_tick(self, overrun):
+        now = time.monotonic_ns()
+        if self._new_period_ns:
+            p, self._new_period_ns = self._new_period_ns, 0
+            self.max_period_ns = int(self.max_period_ns * p / self.base_period_ns)
+            self.base_period_ns = self.period_ns = p
+            self._clean = self._backlog = 0
+        dl, period = self.next_ns, self.period_ns
+        late = now - dl
+        self.ticks += 1
+        self.last_late_ns = late
+        self.total_late_ns += late
+        if late > self.max_late_ns: self.max_late_ns = late
+
+        if overrun and self._backlog:
+            # a catch-up slot already accounted for by the overrun that created it
+            self._backlog -= 1
+            self.next_ns = dl + period
+            return
+        if not overrun:
+            self.next_ns = dl + period
+            if self.policy == 'degrade' and period > self.base_period_ns:
+                self._clean += 1
+                if self._clean >= self.recover_ticks:
+                    self._clean = 0
+                    self.period_ns = max(self.base_period_ns, int(period * 0.9))
+                    self.next_ns = dl + self.period_ns
+            return
+
+        self.overruns += 1
+        self._clean = 0
+        missed = late // period
+        if self.policy == 'skip':
+            self.missed += missed
+            self.next_ns = dl + (missed + 1) * period
+        elif self.policy == 'catchup':
+            self._backlog = min(missed, self.max_catchup)
+            self.missed += missed - self._backlog
+            self.next_ns = dl + (missed - self._backlog + 1) * period
+        else:
+            self.missed += missed
+            self.period_ns = min(self.max_period_ns, int(period * 1.25))
+            self.next_ns = now + self.period_ns
+
+    def summary(self):
+        ticks = max(1, self.ticks)
+        span = (time.monotonic_ns() - self.started_ns) * 1e-9 if self.started_ns else 0.0
+        achieved = self.ticks / span if span > 0 else 0.0
+        return (f"{self.ticks} ticks, {achieved:.1f} Hz achieved, {self.overruns} overruns, "
+                f"{self.missed} missed deadlines, lateness mean {self.total_late_ns / ticks / 1e3:.0f} us "
+                f"/ max {self.max_late_ns / 1e3:.0f} us")
@@ -0,0 +1,85 @@
+# touchdrive/shm.py
+# Shared-memory building blocks for talking to other local processes.
+#
+# SeqlockSlot: one fixed-layout record that a single writer overwrites and
+# any number of readers poll without locks. The first 8 bytes are a sequence
+# counter: odd while a write is in progress, even when the record is stable.
+# A reader copies the record and retries if the counter changed underneath
+# it. Python has no memory barriers, and on a weakly ordered CPU (the Jetson's
+# aarch64) another core may see the final counter before the payload stores,
+# so the record ends in a CRC32 of counter + payload: a copy that fails it is
+# retried too. A reader never sees a half-written record and never blocks the writer.
+
+import struct, zlib
+from multiprocessing import shared_memory
+
+_SEQ = struct.Struct('<Q')
+_CRC = struct.Struct('<I')
+
+def create(name, size):
+    # Creates (or takes over a stale) segment owned by this process.
+    try:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+        old = attach(name)
+        old.close(); old.unlink()
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+def attach(name):
+    # Attaches to a segment another process owns. Before 3.13 the resource tracker
+    # would unlink it when *this* process exits; the owner decides that instead.
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        try: resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception: pass
+        return shm
+
+def exists(name):
+    try: attach(name).close()
+    except FileNotFoundError: return False
+    return True
+
+class SeqlockSlot:
+    def __init__(self, name, fmt, owner=False):
+        self.record = struct.Struct(fmt)
+        self.name = name
+        self.owner = owner
+        self.shm = create(name, _SEQ.size + self.record.size + _CRC.size) if owner else attach(name)
+        self.buf = self.shm.buf
+        self._seq = _SEQ.unpack_from(self.buf, 0)[0] & ~1   # writer side; resumes after a restart
+        self.last_seq = None                               # reader side: seq of the last read()
+
+    def write(self, *values):
+        # Single writer only.
+        buf, seq, n = self.buf, self._seq + 1, self.record.size
+        _SEQ.pack_into(buf, 0, seq)
+        data = self.record.pack(*values)
+        buf[_SEQ.size:_SEQ.size + n] = data
+        _CRC.pack_into(buf, _SEQ.size + n, zlib.crc32(data, zlib.crc32(_SEQ.pack(seq + 1))))
+        self._seq = seq + 1
+        _SEQ.pack_into(buf, 0, self._seq)
+
+    def read(self, retries=64):
+        # Latest consistent record as a tuple, or None if the writer stayed mid-write
+        # (it died there, or we were very unlucky `retries` times in a row).
+        buf, unpack_seq, n = self.buf, _SEQ.unpack_from, self.record.size
+        end = _SEQ.size + n + _CRC.size
+        for _ in range(retries):
+            s1 = unpack_seq(buf, 0)[0]
+            if s1 & 1: continue
+            raw = bytes(buf[_SEQ.size:end])
+            if unpack_seq(buf, 0)[0] != s1: continue
+            if zlib.crc32(raw[:n], zlib.crc32(_SEQ.pack(s1))) != _CRC.unpack_from(raw, n)[0]: continue
+            self.last_seq = s1
+            return self.record.unpack_from(raw)
+        return None
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            try: self.shm.unlink()
+            except FileNotFoundError: pass
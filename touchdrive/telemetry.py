@@ -0,0 +1,66 @@
+# touchdrive/telemetry.py
+# Telemetry broadcast decoupled from the control loop rate.
+# The loop (or control thread) only stores its latest telemetry tuple with
+# publish(); a separate asyncio task sends the newest one at --telemetry-rate.
+# Each client may ask for a lower rate (?rate=N on /ws, or a
+# {'type':'subscribe','rate':N} message); it is then sent every 1/N s at most.
+
+import time
+
+from touchdrive.scheduler import DeadlineScheduler
+
+class TelemetryBroadcaster:
+    def __init__(self, clients, send):
+        self.clients = clients     # live ws -> ClientWriter mapping
+        self._send = send          # send(*telemetry, clients=[...]), non-blocking enqueue
+        self._rates = {}           # ws -> [interval_ns, next_due_ns] for clients below full rate
+        self.latest = None
+        self.seq = 0
+        self.sent = 0
+        self.rate = 0.0
+        self._slack_ns = 0         # half a broadcast period: tick-time jitter never skips a due client
+
+    def publish(self, tele):
+        # Called every control tick, from any thread: one reference swap, no I/O.
+        self.latest = tele
+        self.seq += 1
+
+    def subscribe(self, ws, rate):
+        try: rate = float(rate)
+        except (TypeError, ValueError): rate = 0.0
+        if rate <= 0 or (self.rate and rate >= self.rate):
+            self._rates.pop(ws, None)
+        else:
+            self._rates[ws] = [int(1e9 / rate), 0]
+
+    def forget(self, ws):
+        self._rates.pop(ws, None)
+
+    def due_clients(self, now_ns):
+        out = []
+        for ws in list(self.clients.keys()):
+            if ws.closed: continue
+            r = self._rates.get(ws)
+            if r is not None:
+                if now_ns < r[1] - self._slack_ns: continue
+                nxt = r[1] + r[0]                  # stay on the client's own grid, never burst
+                r[1] = nxt if nxt > now_ns else now_ns + r[0]
+            out.append(ws)
+        return out
+
+    async def run(self, rate, on_send=None):
+        self.rate = float(rate)
+        sched = DeadlineScheduler(self.rate)
+        self._slack_ns = sched.period_ns // 2
+        last_seq = None
+        while True:
+            await sched.wait_async()
+            tele, seq = self.latest, self.seq
+            if tele is None or seq == last_seq: continue   # nothing new from the loop
+            last_seq = seq
+            targets = self.due_clients(time.monotonic_ns())
+            if not targets: continue
+            t = time.perf_counter_ns()
+            self._send(*tele, clients=targets)
+            self.sent += 1
+            if on_send: on_send(time.perf_counter_ns() - t)
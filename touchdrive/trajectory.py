@@ -0,0 +1,274 @@
+# touchdrive/trajectory.py
+# Scripted runs: timed command sequences executed by the control loop.
+# A trajectory is uploaded over HTTP (admin API, like /admin/rate) and played
+# by the control tick itself, one sample per tick at t = k x sample_time from
+# the tick it started on, so a run is sample-exact at the loop rate and the
+# same upload gives the same command sequence every time:
+#     POST /trajectory         {"samples": [[t, throttle, steering], ...], "interp": "linear"}
+#                              {"segments": [{"duration": 2, "throttle": 0.3, "steering": {"type": "sine", ...}}, ...]}
+#                              + optional "name", "smooth" (apply the Smoothing slider), "start": true
+#     POST /trajectory/start   /trajectory/abort      GET /trajectory    (or /car/<id>/...)
+# Commands are in command units (m/s, rad). They replace the phone sticks for
+# the length of the run and go through the same ControllerState.compute() as
+# the sticks do: the arm / E-STOP gate, the slew limits and the Max speed /
+# steering clamps all still apply. A run only starts while the car is armed,
+# and DISARM, E-STOP or the process-mode failsafe abort it on the spot; any
+# WebSocket client can abort it with {"type": "trajectory", "action": "abort"}.
+# Every log row written during a run carries its run id.
+
+import bisect, json, math, multiprocessing, os, shutil, stat, tempfile
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+MAX_DURATION = 600.0   # s per run
+MAX_SAMPLES = 200_000
+AXES = ('throttle', 'steering')
+WAVES = ('const', 'ramp', 'sine', 'chirp')
+IDLE, LOADED, RUNNING, DONE, ABORTED = range(5)
+STATES = ('idle', 'loaded', 'running', 'done', 'aborted')
+REASONS = ('', 'request', 'disarmed', 'E-STOP', 'failsafe', 'not armed')   # why a run was aborted
+LOAD, START, LOAD_START, ABORT = 1, 2, 3, 4   # TrajectoryRunner.request() ops
+
+def _num(v, what):
+    v = float(v)
+    if not math.isfinite(v): raise ValueError(f"{what} must be finite")
+    return v
+
+# ---- trajectories ----
+# Plain data, no closures: a Trajectory parsed in the upload worker pickles back.
+class Wave:
+    # One axis of one segment: value at u s into the segment (d long).
+    __slots__ = ('kind', 'd', 'p')
+
+    def __init__(self, kind, d, p):
+        self.kind, self.d, self.p = kind, d, p
+
+    def __call__(self, u):
+        p = self.p
+        if self.kind == 'const': return p[0]
+        if self.kind == 'ramp': return p[0] + (p[1] - p[0]) * u / self.d
+        if self.kind == 'sine': return p[0] + p[1] * math.sin(p[2] * u + p[3])
+        return p[0] + p[1] * math.sin(2.0 * math.pi * (p[2] * u + 0.5 * p[3] * u * u))   # linear chirp
+
+class Trajectory:
+    # at(t) -> (throttle_cmd, steering_cmd) for t in [0, duration]; built by parse_spec().
+    # Either samples = (t, throttle, steering) arrays played with interp, or
+    # segments = (start times, [(duration, throttle Wave, steering Wave)]).
+    def __init__(self, spec, duration, name='', smooth=False, samples=None, interp='linear', segments=None):
+        self.spec, self.duration, self.name, self.smooth = spec, duration, name, smooth
+        self.samples, self.interp, self.segments = samples, interp, segments
+
+    def at(self, t):
+        if self.samples is None:
+            starts, parts = self.segments
+            i = max(0, bisect.bisect_right(starts, t) - 1)
+            d, fthr, fste = parts[i]
+            u = min(t - starts[i], d)
+            return fthr(u), fste(u)
+        ts, thr, ste = self.samples
+        i = bisect.bisect_right(ts, t) - 1
+        if i < 0: return thr[0], ste[0]   # before the first sample: hold it
+        if i >= len(ts) - 1 or self.interp == 'hold': return thr[i], ste[i]
+        k = (t - ts[i]) / (ts[i+1] - ts[i])
+        return thr[i] + k * (thr[i+1] - thr[i]), ste[i] + k * (ste[i+1] - ste[i])
+
+def _samples(points):
+    if not isinstance(points, list) or not points: raise ValueError("samples must be a non-empty list of [t, throttle, steering]")
+    if len(points) > MAX_SAMPLES: raise ValueError(f"at most {MAX_SAMPLES} samples")
+    ts, thr, ste = array('d'), array('d'), array('d')
+    for i, p in enumerate(points):
+        if not isinstance(p, (list, tuple)) or len(p) != 3: raise ValueError(f"samples[{i}] is not [t, throttle, steering]")
+        t = _num(p[0], f"samples[{i}] t")
+        if t < 0.0 or (ts and t <= ts[-1]): raise ValueError(f"samples[{i}]: times must start at >= 0 and increase")
+        ts.append(t); thr.append(_num(p[1], f"samples[{i}] throttle")); ste.append(_num(p[2], f"samples[{i}] steering"))
+    return ts, thr, ste
+
+def _wave(w, d, where):
+    if w is None: w = 0.0
+    if not isinstance(w, dict): w = {'type': 'const', 'value': w}
+    kind = w.get('type', 'const')
+    if kind not in WAVES: raise ValueError(f"{where}: type must be one of {', '.join(WAVES)}")
+    def p(k, default=None):
+        if k not in w and default is None: raise ValueError(f"{where}: {kind} needs {k!r}")
+        return _num(w.get(k, default), f"{where} {k}")
+    if kind == 'const': return Wave(kind, d, (p('value'),))
+    if kind == 'ramp': return Wave(kind, d, (p('from'), p('to')))
+    off, amp = p('offset', 0.0), p('amp')
+    if kind == 'sine': return Wave(kind, d, (off, amp, 2.0 * math.pi * p('freq'), p('phase', 0.0)))
+    f0, f1 = p('f0'), p('f1')   # frequency sweeps f0 -> f1 over the segment
+    return Wave(kind, d, (off, amp, f0, (f1 - f0) / d))
+
+def _segments(segs):
+    if not isinstance(segs, list) or not segs: raise ValueError("segments must be a non-empty list")
+    starts, parts, t = [], [], 0.0
+    for i, s in enumerate(segs):
+        if not isinstance(s, dict): raise ValueError(f"segments[{i}] is not an object")
+        d = _num(s.get('duration', 0.0), f"segments[{i}] duration")
+        if d <= 0.0: raise ValueError(f"segments[{i}]: duration must be > 0")
+        starts.append(t)
+        parts.append((d, *(_wave(s.get(a), d, f"segments[{i}] {a}") for a in AXES)))
+        t += d
+    return t, (starts, parts)
+
+def _trajectory(spec, duration, **kw):
+    if duration > MAX_DURATION: raise ValueError(f"runs are limited to {MAX_DURATION:g} s")
+    return Trajectory(spec, duration, str(spec.get('name', ''))[:64], bool(spec.get('smooth', False)), **kw)
+
+def parse_spec(body):
+    # Uploaded JSON -> Trajectory; ValueError / TypeError for anything malformed.
+    if not isinstance(body, dict): raise ValueError("expected a JSON object")
+    if ('samples' in body) == ('segments' in body): raise ValueError("expected either \"samples\" or \"segments\"")
+    spec = {k: v for k, v in body.items() if k not in ('start', 'samples')}   # samples live in the arrays
+    if 'segments' in body:
+        duration, segments = _segments(body['segments'])
+        return _trajectory(spec, duration, segments=segments)
+    interp = body.get('interp', 'linear')
+    if interp not in ('linear', 'hold'): raise ValueError("interp must be 'linear' or 'hold'")
+    samples = _samples(body['samples'])
+    return _trajectory(spec, samples[0][-1], samples=samples, interp=interp)
+
+def load_spec(text):
+    # Upload body (JSON text) -> (Trajectory, "start" flag).
+    body = json.loads(text)
+    return parse_spec(body), bool(body.get('start', False))
+
+_pool = None
+
+def upload_pool():
+    # Executor for load_spec(). A 200k-sample upload takes a few hundred ms to parse,
+    # mostly inside json.loads, which holds the GIL throughout: a thread would stall
+    # the event loop and the control thread just the same, a worker process doesn't.
+    global _pool
+    if _pool is None: _pool = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+# --loop-mode process: uploads reach the control process as files in a private
+# directory (mkdtemp, 0700) the web process creates and passes to it, one file per
+# load request; the reader removes each file once parsed. Files are created with
+# O_EXCL and opened without following symlinks, so other local users can neither
+# plant a trajectory nor redirect a write. Samples follow the JSON header line as
+# raw float64 arrays, so reading them costs no parse.
+_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+def spec_dir(name):
+    return tempfile.mkdtemp(prefix=f"{name}-trajectory-")
+
+def private_dir(path):
+    # True if path is a real directory of ours that nobody else can write to.
+    try: st = os.lstat(path)
+    except (OSError, ValueError): return False
+    if not stat.S_ISDIR(st.st_mode) or st.st_mode & 0o077: return False
+    return not hasattr(os, 'getuid') or st.st_uid == os.getuid()
+
+def spec_path(directory, seq):
+    return os.path.join(directory, f"{seq}.trajectory")
+
+def remove_specs(directory):
+    # The directory and any request never read (superseded, or the control process gone).
+    if directory: shutil.rmtree(directory, ignore_errors=True)
+
+def write_spec(path, traj):
+    # The seq bump that tells the reader comes after this returns, so no temp file is needed.
+    head = traj.spec if traj.samples is None else dict(traj.spec, samples=len(traj.samples[0]))
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | _NOFOLLOW, 0o600), 'wb') as f:
+        f.write(json.dumps(head).encode() + b'\n')
+        if traj.samples is not None:
+            for a in traj.samples: a.tofile(f)
+
+def read_spec(path):
+    try:
+        with os.fdopen(os.open(path, os.O_RDONLY | _NOFOLLOW), 'rb') as f:
+            head = json.loads(f.readline())
+            if not isinstance(head, dict) or 'segments' in head: return parse_spec(head)
+            n = head.get('samples')
+            if not isinstance(n, int) or not 0 < n <= MAX_SAMPLES: raise ValueError("bad sample count")
+            samples = array('d'), array('d'), array('d')
+            try:
+                for a in samples: a.fromfile(f, n)
+            except EOFError: raise ValueError("truncated samples") from None
+        interp = head.get('interp', 'linear')
+        return _trajectory(head, samples[0][-1], samples=samples, interp='hold' if interp == 'hold' else 'linear')
+    finally:
+        try: os.remove(path)
+        except OSError: pass
+
+# ---- runner ----
+class TrajectoryRunner:
+    # Per-car handle, used like ratetune.LoopRate: HTTP / WebSocket handlers post
+    # requests, the control tick applies them and plays the run.
+    def __init__(self, tag='[QCar]'):
+        self.tag = tag
+        self.traj = None        # loaded Trajectory
+        self.uploaded = None    # newest upload, before the loop has it
+        self.state, self.reason = IDLE, 0
+        self.run = 0            # id of the current / last run
+        self.tagged = 0         # log column: run id while running, else 0
+        self.t = 0.0            # sample time of the last played sample
+        self.runs = [0, 0]      # finished runs: done, aborted
+        self.forward = None     # --loop-mode process: ControlLink.trajectory takes the requests
+        self._ops = deque()     # (op, Trajectory), in request order
+        self._k = 0; self._t0 = 0.0; self._period = None
+
+    def request(self, op, traj=None):
+        # Any thread: applied by the next control tick.
+        if op & LOAD: self.uploaded = traj
+        if self.forward is None: self._ops.append((op, traj)); return
+        self.forward(op, traj)
+        if op & LOAD: self.traj = traj   # for status(); the control process has its own copy
+
+    def step(self, active, period, estop=False, failsafe=False):
+        # Control tick, before compute(). active = ControllerState.cmd[0]; period =
+        # the tick's nominal length (s). Returns (throttle_cmd, steering_cmd) or None.
+        while self._ops: self._apply(*self._ops.popleft(), active)
+        if self.state != RUNNING: return None
+        if not active:
+            return self._finish(ABORTED, 3 if estop else (4 if failsafe else 2))
+        if period != self._period:   # new loop rate: keep counting from where we are
+            if self._k: self._t0 += self._k * self._period
+            self._k, self._period = 0, period
+        t = self._t0 + self._k * period
+        if t > self.traj.duration + 1e-9: return self._finish(DONE)
+        self._k += 1
+        self.t = t
+        return self.traj.at(t)
+
+    def _apply(self, op, traj, active):
+        if op == ABORT:
+            if self.state == RUNNING: self._finish(ABORTED, 1)
+            return
+        if op & LOAD:
+            if self.state == RUNNING:
+                print(f"{self.tag} trajectory upload ignored: run {self.run} in progress", flush=True)
+                return
+            self.traj, self.state, self.reason, self.t = traj, LOADED, 0, 0.0
+        if op & START and self.traj is not None and self.state != RUNNING:
+            self.run += 1
+            if not active:
+                self.state, self.reason = ABORTED, 5
+                self.runs[1] += 1
+                print(f"{self.tag} trajectory run {self.run} not started: car not armed", flush=True)
+                return
+            self.state, self.reason, self.tagged = RUNNING, 0, self.run
+            self._k, self._t0, self._period, self.t = 0, 0.0, None, 0.0
+            print(f"{self.tag} trajectory run {self.run} {self.traj.name!r} started ({self.traj.duration:g} s)", flush=True)
+
+    def _finish(self, state, reason=0):
+        self.state, self.reason, self.tagged = state, reason, 0
+        self.runs[state == ABORTED] += 1
+        how = 'done' if state == DONE else f"aborted at {self.t:.3f} s ({REASONS[reason]})"
+        print(f"{self.tag} trajectory run {self.run} {how}", flush=True)
+        return None
+
+    def observed(self, run, state, reason, t):
+        # --loop-mode process: what the control process reports.
+        if state in (DONE, ABORTED) and (run, state) != (self.run, self.state): self.runs[state == ABORTED] += 1
+        self.run, self.state, self.reason, self.t = run, state, reason, t
+        self.tagged = run if state == RUNNING else 0
+
+    def status(self):
+        traj = self.traj
+        d = traj.duration if traj is not None else 0.0
+        return {'state': STATES[self.state], 'run': self.run, 'name': traj.name if traj is not None else None,
+                't': round(self.t, 6), 'duration': d, 'progress': round(min(1.0, self.t / d), 4) if d else 0.0,
+                'reason': REASONS[self.reason] or None, 'smooth': traj.smooth if traj is not None else None}